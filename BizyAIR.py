@@ -1,64 +1,1231 @@
 # BizyAIR API远程调用插件
 import requests
 import json
+import re
 import os
 import base64
 import torch
+import torch.nn.functional as F
 from PIL import Image
 import numpy as np
 from io import BytesIO
 import mimetypes
 import urllib.parse
 import hashlib
+import sqlite3
 import shutil
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
+import random
+import itertools
+import heapq
+import warnings
+import functools
+import contextvars
+import asyncio
+import weakref
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
-def download_and_cache_image(image_url):
-    """下载图像并缓存到本地文件夹"""
+def _env_int(name, default):
+    """读取整数环境变量，格式错误时使用默认值"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _env_float(name, default):
+    """读取浮点数环境变量，格式错误时使用默认值"""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+# BizyAIR API地址（可通过环境变量指向本地测试服务器）
+BIZYAIR_API_BASE = os.environ.get("BIZYAIR_API_BASE", "https://api.bizyair.cn").rstrip("/")
+
+# HTTP连接池配置
+HTTP_POOL_CONNECTIONS = _env_int("BIZYAIR_HTTP_POOL_CONNECTIONS", 8)  # 缓存的主机连接池数量
+HTTP_POOL_MAXSIZE = _env_int("BIZYAIR_HTTP_POOL_SIZE", 16)  # 每个主机保持的最大连接数
+HTTP_MAX_RETRIES = _env_int("BIZYAIR_HTTP_RETRIES", 3)
+HTTP_BACKOFF_BASE = _env_float("BIZYAIR_HTTP_BACKOFF_BASE", 0.5)
+HTTP_BACKOFF_MAX = _env_float("BIZYAIR_HTTP_BACKOFF_MAX", 30.0)
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+# 非幂等请求(POST)只在服务端明确拒绝处理时重试，避免重复提交任务
+HTTP_RETRY_STATUS_UNSAFE = (429, 503)
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_stats_lock = threading.Lock()
+_http_stats = {"requests": 0, "new_connections": 0, "retries": 0, "hosts": {}}
+
+def _record_http_stat(host, field):
+    """更新连接统计计数"""
+    with _http_stats_lock:
+        _http_stats[field] += 1
+        host_stats = _http_stats["hosts"].setdefault(host, {"requests": 0, "new_connections": 0, "retries": 0})
+        host_stats[field] += 1
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _record_http_stat(self.host, "new_connections")
+        return super()._new_conn()
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _record_http_stat(self.host, "new_connections")
+        return super()._new_conn()
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """统计新建连接数量的连接池适配器，用于确认keep-alive是否生效"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+def configure_http_client(pool_connections=None, pool_maxsize=None):
+    """(重新)创建共享HTTP会话，可调整连接池大小"""
+    global _http_session, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE
+    with _http_session_lock:
+        if pool_connections:
+            HTTP_POOL_CONNECTIONS = int(pool_connections)
+        if pool_maxsize:
+            HTTP_POOL_MAXSIZE = int(pool_maxsize)
+        session = requests.Session()
+        adapter = _CountingHTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        old_session, _http_session = _http_session, session
+    if old_session is not None:
+        old_session.close()
+    ASYNC_TRANSPORT.reset()
+    return session
+
+def get_http_session():
+    """获取模块级共享HTTP会话（按主机复用连接）"""
+    session = _http_session
+    if session is None:
+        session = configure_http_client()
+    return session
+
+def get_http_stats():
+    """返回请求数、新建连接数和连接复用数统计"""
+    with _http_stats_lock:
+        stats = {
+            "requests": _http_stats["requests"],
+            "new_connections": _http_stats["new_connections"],
+            "retries": _http_stats["retries"],
+            "hosts": {host: dict(values) for host, values in _http_stats["hosts"].items()},
+        }
+    stats["reused_connections"] = max(stats["requests"] - stats["new_connections"], 0)
+    stats["transport"] = ASYNC_TRANSPORT.stats()
+    for values in stats["hosts"].values():
+        values["reused_connections"] = max(values["requests"] - values["new_connections"], 0)
+    return stats
+
+def _parse_retry_after(response):
+    """解析Retry-After响应头（秒数或HTTP日期），返回等待秒数"""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_delay(attempt, retry_after=None):
+    """计算带随机抖动的指数退避时间，优先使用服务端给出的Retry-After"""
+    if retry_after is not None:
+        return min(retry_after, HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+# 全局准入控制配置（所有BizyAIR请求共用）
+ADMISSION_MAX_IN_FLIGHT = _env_int("BIZYAIR_MAX_IN_FLIGHT", 32)  # 同时进行的请求上限，0为不限
+ADMISSION_QUEUE_TIMEOUT = _env_float("BIZYAIR_ADMISSION_TIMEOUT", 300.0)  # 排队超过该秒数则放弃请求
+ADMISSION_BURST_SECONDS = 2.0  # 令牌桶容量 = 速率 × 该秒数
+# 各类接口每秒请求数上限，0为不限
+ADMISSION_ENDPOINT_RATES = {
+    "create": _env_float("BIZYAIR_RATE_CREATE", 5.0),
+    "status": _env_float("BIZYAIR_RATE_STATUS", 10.0),
+    "upload": _env_float("BIZYAIR_RATE_UPLOAD", 0.0),
+    "download": _env_float("BIZYAIR_RATE_DOWNLOAD", 0.0),
+}
+ADMISSION_KEY_RATE = _env_float("BIZYAIR_RATE_PER_KEY", 10.0)  # 每个API Key每秒请求数上限，0为不限
+
+class TokenBucket:
+    """令牌桶；blocked_until 记录429/Retry-After后的暂停时间（调用方持锁）"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate * ADMISSION_BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.strikes = 0  # 连续被限流次数，决定没有Retry-After时的暂停时间
+    
+    def delay(self, now):
+        """还需等待多少秒才能取得令牌"""
+        wait = max(self.blocked_until - now, 0.0)
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+    
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+    
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+def classify_endpoint(method, url):
+    """按URL把请求归入 create/status/upload/download 四类接口"""
+    path = urllib.parse.urlparse(url).path
+    if path.endswith("/task/openapi/create"):
+        return "create"
+    if "/webapp/task/" in path or path.endswith("/schema"):
+        return "status"
+    if method in ("PUT", "POST"):
+        return "upload"
+    return "download"
+
+class AdmissionController:
+    """进程内所有BizyAIR请求的准入控制：按接口和API Key的令牌桶限速、限制在途请求数，
+    排队的请求按到达顺序放行（同一接口+Key内严格先进先出），429/Retry-After 后暂停对应的Key或接口"""
+    
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, endpoint_rates=None, key_rate=ADMISSION_KEY_RATE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._buckets = {}
+        self.in_flight = 0
+        self.configure(max_in_flight, endpoint_rates or ADMISSION_ENDPOINT_RATES, key_rate, queue_timeout)
+        self._stats = {"admitted": 0, "timeouts": 0, "throttled": 0, "max_queue_depth": 0, "endpoints": {}}
+    
+    def configure(self, max_in_flight=None, endpoint_rates=None, key_rate=None, queue_timeout=None):
+        """调整限制；传入的速率会重建对应的令牌桶"""
+        with self._cond:
+            if max_in_flight is not None:
+                self.max_in_flight = int(max_in_flight)
+            if endpoint_rates is not None:
+                self.endpoint_rates = dict(endpoint_rates)
+                self._buckets = {name: bucket for name, bucket in self._buckets.items() if name[0] != "endpoint"}
+            if key_rate is not None:
+                self.key_rate = key_rate
+                self._buckets = {name: bucket for name, bucket in self._buckets.items() if name[0] != "key"}
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+            self._cond.notify_all()
+    
+    def _bucket_locked(self, kind, name):
+        bucket = self._buckets.get((kind, name))
+        if bucket is None:
+            rate = self.endpoint_rates.get(name, 0.0) if kind == "endpoint" else self.key_rate
+            bucket = self._buckets[(kind, name)] = TokenBucket(rate)
+        return bucket
+    
+    def _waiter_buckets_locked(self, waiter):
+        buckets = [self._bucket_locked("endpoint", waiter["endpoint"])]
+        if waiter["key"]:
+            buckets.append(self._bucket_locked("key", waiter["key"]))
+        return buckets
+    
+    def _dispatch_locked(self, now):
+        """按排队顺序放行可以执行的请求，返回下一次需要重新检查的等待秒数（None表示只需等通知）"""
+        next_check = None
+        seen_lanes = set()
+        granted = False
+        for waiter in list(self._queue):
+            lane = (waiter["endpoint"], waiter["key"])
+            if lane in seen_lanes:
+                continue
+            buckets = self._waiter_buckets_locked(waiter)
+            delay = max(bucket.delay(now) for bucket in buckets)
+            if delay > 0:
+                # 同一接口+Key中排在后面的请求不能越过它
+                seen_lanes.add(lane)
+                next_check = delay if next_check is None else min(next_check, delay)
+                continue
+            if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+                # 空闲名额只按排队顺序分配，后到的请求不能插队
+                break
+            for bucket in buckets:
+                bucket.take()
+            self.in_flight += 1
+            waiter["granted"] = True
+            self._queue.remove(waiter)
+            granted = True
+            if waiter["wake"] is not None:
+                waiter["wake"]()
+        if granted:
+            self._cond.notify_all()
+        return next_check
+    
+    def _enqueue_locked(self, endpoint, api_key, wake=None):
+        waiter = {"endpoint": endpoint, "key": key_fingerprint(api_key) if api_key else "", "granted": False,
+                  "wake": wake, "start": time.monotonic()}
+        self._queue.append(waiter)
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+        return waiter
+    
+    def _wait_step_locked(self, waiter):
+        """调度一次；已放行返回None，否则返回最多还需等待的秒数；排队超时抛出TimeoutError"""
+        next_check = self._dispatch_locked(time.monotonic())
+        if waiter["granted"]:
+            return None
+        remaining = waiter["start"] + self.queue_timeout - time.monotonic()
+        if remaining <= 0:
+            self._queue.remove(waiter)
+            self._stats["timeouts"] += 1
+            self._cond.notify_all()
+            raise TimeoutError(f"BizyAIR请求排队超过 {self.queue_timeout:.0f} 秒（{waiter['endpoint']}）")
+        return min(next_check, remaining) if next_check is not None else remaining
+    
+    def _admitted(self, waiter):
+        """记录排队时间，返回归还名额的函数（可重复调用）"""
+        waited = time.monotonic() - waiter["start"]
+        endpoint = waiter["endpoint"]
+        with self._cond:
+            self._stats["admitted"] += 1
+            endpoint_stats = self._stats["endpoints"].setdefault(endpoint, {"admitted": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0})
+            endpoint_stats["admitted"] += 1
+            endpoint_stats["wait_seconds"] += waited
+            endpoint_stats["max_wait_seconds"] = max(endpoint_stats["max_wait_seconds"], waited)
+        if waited >= 0.001:
+            record_metric("admission_wait", waited, endpoint=endpoint)
+        
+        released = []
+        def release():
+            with self._cond:
+                if not released:
+                    released.append(True)
+                    self.in_flight -= 1
+                    # 协程等待者不在条件变量上等待，归还名额时直接调度
+                    self._dispatch_locked(time.monotonic())
+                    self._cond.notify_all()
+        return release
+    
+    def acquire(self, endpoint, api_key=None):
+        """排队等待放行，返回归还名额的函数；排队超时抛出TimeoutError"""
+        with self._cond:
+            waiter = self._enqueue_locked(endpoint, api_key)
+            while True:
+                timeout = self._wait_step_locked(waiter)
+                if timeout is None:
+                    break
+                self._cond.wait(timeout)
+        return self._admitted(waiter)
+    
+    async def acquire_async(self, endpoint, api_key=None):
+        """acquire 的协程版本：在事件循环中等待，不占用线程"""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._cond:
+            waiter = self._enqueue_locked(endpoint, api_key, wake=lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                with self._cond:
+                    timeout = self._wait_step_locked(waiter)
+                if timeout is None:
+                    break
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        except asyncio.CancelledError:
+            with self._cond:
+                if waiter in self._queue:
+                    self._queue.remove(waiter)
+                    self._cond.notify_all()
+                    raise
+            # 取消前已被放行，归还名额
+            self._admitted(waiter)()
+            raise
+        return self._admitted(waiter)
+    
+    @contextmanager
+    def admit(self, endpoint, api_key=None):
+        """不经过 http_request 的请求（如OSS上传）用此上下文占用名额"""
+        release = self.acquire(endpoint, api_key)
+        try:
+            yield
+        finally:
+            release()
+    
+    def feedback(self, endpoint, api_key, status_code, retry_after=None):
+        """根据响应调整：429（或带Retry-After的503）暂停对应的Key（无Key时暂停该接口），成功时清零退避"""
+        with self._cond:
+            bucket = self._bucket_locked("key", key_fingerprint(api_key)) if api_key else self._bucket_locked("endpoint", endpoint)
+            if status_code == 429 or (status_code == 503 and retry_after is not None):
+                pause = retry_after if retry_after is not None else min(HTTP_BACKOFF_BASE * (2 ** bucket.strikes), HTTP_BACKOFF_MAX)
+                bucket.strikes += 1
+                bucket.block(time.monotonic(), pause)
+                self._stats["throttled"] += 1
+            elif status_code is not None and status_code < 400:
+                bucket.strikes = 0
+                return
+            else:
+                return
+        if pause > 0:
+            print(f"🚦 {endpoint} 请求被限流(HTTP {status_code})，暂停 {pause:.1f} 秒")
+    
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+    
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self._stats["max_queue_depth"],
+                "admitted": self._stats["admitted"],
+                "timeouts": self._stats["timeouts"],
+                "throttled": self._stats["throttled"],
+                "endpoints": {
+                    endpoint: {**values, "wait_seconds": round(values["wait_seconds"], 3),
+                               "max_wait_seconds": round(values["max_wait_seconds"], 3)}
+                    for endpoint, values in self._stats["endpoints"].items()
+                },
+                "paused": {
+                    f"{kind}:{name}": round(bucket.blocked_until - now, 1)
+                    for (kind, name), bucket in self._buckets.items() if bucket.blocked_until > now
+                },
+            }
+
+ADMISSION = AdmissionController()
+
+def _release_with_response(response, release):
+    """流式响应关闭（或被回收）时才归还在途名额"""
+    response.close = functools.partial(_close_and_release, weakref.ref(response), release)
+    weakref.finalize(response, release)
+
+def _close_and_release(response_ref, release):
+    response = response_ref()
+    try:
+        if response is not None:
+            type(response).close(response)
+    finally:
+        release()
+
+# 异步传输配置：httpx + HTTP/2 在后台事件循环中执行所有请求，未安装httpx时退回requests
+HTTP_TRANSPORT = os.environ.get("BIZYAIR_TRANSPORT", "auto").lower()  # auto / httpx / requests
+HTTP2_ENABLED = os.environ.get("BIZYAIR_HTTP2", "1") != "0"
+
+async def _next_chunk(transport, chunks):
     try:
-        # 获取ComfyUI根目录
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        # 找到ComfyUI根目录 (向上回溯找到custom_nodes的上级目录)
-        comfyui_root = current_dir
-        while os.path.basename(comfyui_root) != 'custom_nodes' and comfyui_root != os.path.dirname(comfyui_root):
-            comfyui_root = os.path.dirname(comfyui_root)
-        if os.path.basename(comfyui_root) == 'custom_nodes':
-            comfyui_root = os.path.dirname(comfyui_root)
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+    except transport.httpx.TransportError as e:
+        # 读取响应体时的超时/断连与requests一样表现为 RequestException，调用方据此续传
+        raise transport.translate_error(e, body=True) from e
+
+class TransportResponse:
+    """httpx响应的同步包装，提供节点代码用到的 requests.Response 接口；
+    流式响应的响应体按块从事件循环中读取"""
+    
+    def __init__(self, transport, response, stream=False):
+        self._transport = transport
+        self._response = response
+        self._stream = stream
+        self._closed = False
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.reason = response.reason_phrase
+        self.http_version = response.http_version
+        if stream:
+            # 调用方没有关闭时，回收时在事件循环中关闭流
+            weakref.finalize(self, transport.spawn, response.aclose)
+    
+    @property
+    def ok(self):
+        return self.status_code < 400
+    
+    @property
+    def content(self):
+        if self._stream and not self._response.is_stream_consumed:
+            try:
+                self._transport.run(self._response.aread())
+            except self._transport.httpx.TransportError as e:
+                raise self._transport.translate_error(e, body=True) from e
+        return self._response.content
+    
+    @property
+    def text(self):
+        return self.content.decode(self._response.encoding or "utf-8", errors="replace")
+    
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+    
+    def iter_content(self, chunk_size=1):
+        if not self._stream or self._response.is_stream_consumed:
+            data = self.content
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+            return
+        chunks = self._response.aiter_bytes(chunk_size)
+        while True:
+            chunk = self._transport.run(_next_chunk(self._transport, chunks))
+            if chunk is None:
+                return
+            yield chunk
+    
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise requests.exceptions.HTTPError(f"{self.status_code} {kind} Error: {self.reason} for url: {self.url}", response=self)
+    
+    def close(self):
+        if self._stream and not self._closed:
+            self._closed = True
+            self._transport.run(self._response.aclose())
+    
+    async def aclose(self):
+        if self._stream and not self._closed:
+            self._closed = True
+            await self._response.aclose()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+class AsyncTransport:
+    """后台线程中的asyncio事件循环 + httpx.AsyncClient（HTTP/2多路复用）；
+    同步代码通过 run()/submit() 把协程交给事件循环，少量固定线程即可承载大量并发请求"""
+    
+    def __init__(self, mode=HTTP_TRANSPORT, http2=HTTP2_ENABLED):
+        self.httpx = None
+        if mode != "requests":
+            try:
+                import httpx
+                self.httpx = httpx
+            except ImportError:
+                if mode == "httpx":
+                    print("⚠️ 未安装httpx，改用requests")
+        self.enabled = self.httpx is not None
+        self.http2 = False
+        if self.enabled and http2:
+            try:
+                import h2  # noqa: F401
+                self.http2 = True
+            except ImportError:
+                pass
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "http2_responses": 0}
+    
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, daemon=True, name="bizyair-transport")
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+    
+    def submit(self, coro, context=None):
+        """在事件循环中执行协程（沿用调用方或指定的统计上下文），返回 concurrent.futures.Future"""
+        loop = self._ensure_loop()
+        context = context.copy() if context is not None else contextvars.copy_context()
+        future = concurrent.futures.Future()
+        
+        def on_done(task):
+            if task.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        
+        def start():
+            if future.set_running_or_notify_cancel():
+                context.run(loop.create_task, coro).add_done_callback(on_done)
+            else:
+                coro.close()
+        
+        loop.call_soon_threadsafe(start)
+        return future
+    
+    def run(self, coro, timeout=None):
+        """同步等待协程结果；不能在事件循环线程中调用"""
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("不能在传输事件循环线程中同步等待请求")
+        return self.submit(coro).result(timeout)
+    
+    def spawn(self, coro_fn):
+        """不等待结果地在事件循环中执行 coro_fn()（用于回收时关闭流）"""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(lambda: loop.create_task(coro_fn()))
+    
+    def _get_client(self):
+        """只在事件循环线程中调用"""
+        if self._client is None:
+            limits = self.httpx.Limits(max_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+                                       max_keepalive_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE)
+            self._client = self.httpx.AsyncClient(http2=self.http2, limits=limits, timeout=None)
+        return self._client
+    
+    def reset(self):
+        """丢弃当前客户端（连接池配置变化后调用），下一个请求会重新创建"""
+        loop = self._loop
+        if loop is None:
+            return
+        async def _reset():
+            client, self._client = self._client, None
+            if client is not None:
+                await client.aclose()
+        self.submit(_reset()).result()
+    
+    def translate_error(self, error, body=False):
+        """把httpx的传输错误转换为对应的requests异常"""
+        httpx = self.httpx
+        message = str(error) or type(error).__name__
+        if isinstance(error, httpx.ConnectTimeout):
+            return requests.exceptions.ConnectTimeout(message)
+        if isinstance(error, httpx.TimeoutException):
+            return requests.exceptions.ReadTimeout(message)
+        if body:
+            return requests.exceptions.ChunkedEncodingError(message)
+        return requests.exceptions.ConnectionError(message)
+    
+    def _timeout(self, timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self.httpx.Timeout(read, connect=connect)
+        return self.httpx.Timeout(timeout)
+    
+    async def send(self, method, url, stream=False, headers=None, data=None, json=None, params=None,
+                   timeout=None, allow_redirects=True):
+        """发送一次请求（不重试）；连接错误转换为对应的requests异常，重试逻辑与requests路径一致"""
+        httpx = self.httpx
+        host = urllib.parse.urlparse(url).hostname or ""
+        
+        async def trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                _record_http_stat(host, "new_connections")
+        
+        if isinstance(data, (bytes, bytearray, memoryview, str)):
+            body = {"content": bytes(data) if isinstance(data, (bytearray, memoryview)) else data}
         else:
-            # 如果找不到，使用当前目录
-            comfyui_root = current_dir
-        
-        # 创建 temp 文件夹
-        temp_dir = os.path.join(comfyui_root, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # 使用URL的哈希值作为文件名，避免重复下载
-        url_hash = hashlib.md5(image_url.encode('utf-8')).hexdigest()
-        
-        # 从 URL 获取文件扩展名
-        parsed_url = urllib.parse.urlparse(image_url)
-        original_ext = os.path.splitext(parsed_url.path)[1].lower()
-        if not original_ext:
-            original_ext = '.webp'  # 默认扩展名
-        
-        # 生成缓存文件路径
-        cache_filename = f"{url_hash}{original_ext}"
-        cache_file_path = os.path.join(temp_dir, cache_filename)
-        
-        # 检查是否已经缓存
-        if os.path.exists(cache_file_path):
-            # print(f"📋 使用缓存图像: {cache_filename}")
-            return cache_file_path
-        
-        # 下载图像
-        # print(f"🌐 下载图像: {image_url}")
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
+            body = {"data": data}
+        client = self._get_client()
+        request = client.build_request(method, url, headers=headers, params=params, json=json,
+                                       timeout=self._timeout(timeout), extensions={"trace": trace}, **body)
+        try:
+            response = await client.send(request, stream=True, follow_redirects=allow_redirects)
+        except httpx.TransportError as e:
+            raise self.translate_error(e) from e
+        self._stats["requests"] += 1
+        if response.http_version == "HTTP/2":
+            self._stats["http2_responses"] += 1
+        if not stream:
+            try:
+                await response.aread()
+            except httpx.TransportError as e:
+                raise self.translate_error(e) from e
+            finally:
+                await response.aclose()
+        return TransportResponse(self, response, stream)
+    
+    def stats(self):
+        return {"engine": "httpx" if self.enabled else "requests", "http2": self.http2, **self._stats}
+
+ASYNC_TRANSPORT = AsyncTransport()
+
+async def async_http_request(method, url, retries=None, api_key=None, on_admitted=None, **kwargs):
+    """http_request 的协程版本：在传输事件循环中排队、发送和重试，等待期间不占用线程"""
+    method = method.upper()
+    idempotent = method in ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+    retry_status = HTTP_RETRY_STATUS if idempotent else HTTP_RETRY_STATUS_UNSAFE
+    max_retries = HTTP_MAX_RETRIES if retries is None else retries
+    host = urllib.parse.urlparse(url).hostname or ""
+    endpoint = classify_endpoint(method, url)
+
+    attempt = 0
+    while True:
+        release = await ADMISSION.acquire_async(endpoint, api_key)
+        if on_admitted is not None:
+            on_admitted()
+        _record_http_stat(host, "requests")
+        try:
+            response = await ASYNC_TRANSPORT.send(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            release()
+            retryable = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+            if not retryable or attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt)
+            print(f"🔁 请求失败，{delay:.1f}秒后重试({attempt + 1}/{max_retries}): {e}")
+        except BaseException:
+            release()
+            raise
+        else:
+            ADMISSION.feedback(endpoint, api_key, response.status_code, _parse_retry_after(response))
+            if response.status_code not in retry_status or attempt >= max_retries:
+                if kwargs.get("stream"):
+                    _release_with_response(response, release)
+                else:
+                    release()
+                return response
+            release()
+            await response.aclose()
+            delay = _backoff_delay(attempt, _parse_retry_after(response))
+            print(f"🔁 HTTP {response.status_code}，{delay:.1f}秒后重试({attempt + 1}/{max_retries}): {url}")
+        _record_http_stat(host, "retries")
+        attempt += 1
+        await asyncio.sleep(delay)
+
+def http_request(method, url, retries=None, api_key=None, on_admitted=None, **kwargs):
+    """通过共享连接池发送HTTP请求，每次尝试都经过全局准入控制，失败时按指数退避重试；
+    on_admitted 在每次尝试获准发出时调用。启用httpx传输时只是 async_http_request 的同步包装"""
+    if ASYNC_TRANSPORT.enabled:
+        return ASYNC_TRANSPORT.run(async_http_request(method, url, retries=retries, api_key=api_key, on_admitted=on_admitted, **kwargs))
+    method = method.upper()
+    idempotent = method in ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+    retry_status = HTTP_RETRY_STATUS if idempotent else HTTP_RETRY_STATUS_UNSAFE
+    max_retries = HTTP_MAX_RETRIES if retries is None else retries
+    host = urllib.parse.urlparse(url).hostname or ""
+    endpoint = classify_endpoint(method, url)
+    session = get_http_session()
+
+    attempt = 0
+    while True:
+        release = ADMISSION.acquire(endpoint, api_key)
+        if on_admitted is not None:
+            on_admitted()
+        _record_http_stat(host, "requests")
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            release()
+            # POST只在连接阶段失败时重试，请求可能已被服务端接收的情况不重试
+            retryable = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+            if not retryable or attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt)
+            print(f"🔁 请求失败，{delay:.1f}秒后重试({attempt + 1}/{max_retries}): {e}")
+        except BaseException:
+            release()
+            raise
+        else:
+            ADMISSION.feedback(endpoint, api_key, response.status_code, _parse_retry_after(response))
+            if kwargs.get("stream"):
+                _release_with_response(response, release)
+            else:
+                release()
+            if response.status_code not in retry_status or attempt >= max_retries:
+                return response
+            delay = _backoff_delay(attempt, _parse_retry_after(response))
+            print(f"🔁 HTTP {response.status_code}，{delay:.1f}秒后重试({attempt + 1}/{max_retries}): {url}")
+            response.close()
+        _record_http_stat(host, "retries")
+        attempt += 1
+        time.sleep(delay)
+
+# 分阶段耗时统计配置
+METRICS_HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+METRICS_WINDOW_SIZE = _env_int("BIZYAIR_METRICS_WINDOW", 1000)  # 滚动窗口保留的最近样本数
+METRICS_FILE = os.environ.get("BIZYAIR_METRICS_FILE", "")  # 设置后每次节点执行完写出Prometheus文本格式
+
+class PhaseMetrics:
+    """进程级分阶段统计：累计直方图（Prometheus格式）+ 最近样本的滚动分位数"""
+    
+    def __init__(self, buckets=METRICS_HISTOGRAM_BUCKETS, window=METRICS_WINDOW_SIZE):
+        self.buckets = buckets
+        self.window = window
+        self._phases = {}
+        self._lock = threading.Lock()
+    
+    def _phase_locked(self, phase):
+        data = self._phases.get(phase)
+        if data is None:
+            data = {
+                "count": 0,
+                "sum": 0.0,
+                "bytes": 0,
+                "cache_hits": 0,
+                "errors": 0,
+                "buckets": [0] * len(self.buckets),
+                "recent": deque(maxlen=self.window),
+            }
+            self._phases[phase] = data
+        return data
+    
+    def observe(self, phase, seconds, nbytes=0, cache_hit=False, error=False):
+        with self._lock:
+            data = self._phase_locked(phase)
+            data["count"] += 1
+            data["sum"] += seconds
+            data["bytes"] += nbytes
+            data["cache_hits"] += int(bool(cache_hit))
+            data["errors"] += int(bool(error))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    data["buckets"][i] += 1
+            data["recent"].append(seconds)
+    
+    def percentile(self, phase, q):
+        """最近窗口内的分位数（秒），没有样本时返回None"""
+        with self._lock:
+            data = self._phases.get(phase)
+            recent = sorted(data["recent"]) if data else []
+        if not recent:
+            return None
+        return recent[min(int(q * len(recent)), len(recent) - 1)]
+    
+    def snapshot(self):
+        with self._lock:
+            phases = {phase: (dict(data), sorted(data["recent"])) for phase, data in self._phases.items()}
+        result = {}
+        for phase, (data, recent) in phases.items():
+            pick = lambda q: round(recent[min(int(q * len(recent)), len(recent) - 1)], 4) if recent else None
+            result[phase] = {
+                "count": data["count"],
+                "seconds_total": round(data["sum"], 4),
+                "bytes_total": data["bytes"],
+                "cache_hits": data["cache_hits"],
+                "errors": data["errors"],
+                "p50": pick(0.5),
+                "p95": pick(0.95),
+                "p99": pick(0.99),
+            }
+        return result
+    
+    def render_prometheus(self):
+        """Prometheus 文本格式"""
+        lines = [
+            "# HELP bizyair_phase_seconds BizyAIR client phase duration in seconds",
+            "# TYPE bizyair_phase_seconds histogram",
+        ]
+        with self._lock:
+            phases = {phase: dict(data) for phase, data in self._phases.items()}
+        for phase, data in sorted(phases.items()):
+            for bound, count in zip(self.buckets, data["buckets"]):
+                lines.append(f'bizyair_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+            lines.append(f'bizyair_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {data["count"]}')
+            lines.append(f'bizyair_phase_seconds_sum{{phase="{phase}"}} {data["sum"]:.6f}')
+            lines.append(f'bizyair_phase_seconds_count{{phase="{phase}"}} {data["count"]}')
+        for name, field, help_text in (
+            ("bizyair_phase_bytes_total", "bytes", "Bytes transferred per phase"),
+            ("bizyair_phase_cache_hits_total", "cache_hits", "Cache hits per phase"),
+            ("bizyair_phase_errors_total", "errors", "Failed spans per phase"),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for phase, data in sorted(phases.items()):
+                lines.append(f'{name}{{phase="{phase}"}} {data[field]}')
+        http_stats = get_http_stats()
+        lines.append("# TYPE bizyair_http_requests_total counter")
+        lines.append(f"bizyair_http_requests_total {http_stats['requests']}")
+        lines.append("# TYPE bizyair_http_new_connections_total counter")
+        lines.append(f"bizyair_http_new_connections_total {http_stats['new_connections']}")
+        lines.append("# TYPE bizyair_http_retries_total counter")
+        lines.append(f"bizyair_http_retries_total {http_stats['retries']}")
+        admission = ADMISSION.stats()
+        for name, kind, value in (
+            ("bizyair_admission_in_flight", "gauge", admission["in_flight"]),
+            ("bizyair_admission_queue_depth", "gauge", admission["queue_depth"]),
+            ("bizyair_admission_admitted_total", "counter", admission["admitted"]),
+            ("bizyair_admission_throttled_total", "counter", admission["throttled"]),
+            ("bizyair_admission_timeouts_total", "counter", admission["timeouts"]),
+        ):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        lines.append("# TYPE bizyair_admission_wait_seconds_total counter")
+        for endpoint, values in sorted(admission["endpoints"].items()):
+            lines.append(f'bizyair_admission_wait_seconds_total{{endpoint="{endpoint}"}} {values["wait_seconds"]}')
+        return "\n".join(lines) + "\n"
+
+PHASE_METRICS = PhaseMetrics()
+
+class MetricsCollector:
+    """单次节点执行的分阶段记录，序列化为节点的 metrics_json 输出"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+    
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+    
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+        phases = {}
+        for span in spans:
+            phase = phases.setdefault(span["phase"], {"count": 0, "seconds": 0.0, "bytes": 0, "cache_hits": 0, "errors": 0})
+            phase["count"] += 1
+            phase["seconds"] += span["seconds"]
+            phase["bytes"] += span.get("bytes", 0)
+            phase["cache_hits"] += int(bool(span.get("cache_hit")))
+            phase["errors"] += int(bool(span.get("error")))
+        for phase in phases.values():
+            phase["seconds"] = round(phase["seconds"], 4)
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "phases": phases,
+            "spans": spans[:200],
+        }
+    
+    def to_json(self):
+        return json.dumps(self.summary(), ensure_ascii=False, indent=2)
+
+_current_metrics = contextvars.ContextVar("bizyair_metrics", default=None)
+
+@contextmanager
+def metrics_span(phase, **attrs):
+    """记录一个阶段的耗时；在 with 块内可设置 span["bytes"] / span["cache_hit"]"""
+    span = {"phase": phase, "bytes": 0, "cache_hit": False}
+    span.update(attrs)
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span["error"] = True
+        raise
+    finally:
+        span["seconds"] = round(time.perf_counter() - start, 6)
+        _record_span(span)
+
+def _record_span(span):
+    PHASE_METRICS.observe(span["phase"], span["seconds"], span.get("bytes", 0), span.get("cache_hit"), span.get("error"))
+    collector = _current_metrics.get()
+    if collector is not None:
+        collector.add(span)
+
+def record_metric(phase, seconds, **attrs):
+    """记录一个在别处计时的阶段（例如远程排队时间）"""
+    span = {"phase": phase, "bytes": 0, "cache_hit": False}
+    span.update(attrs)
+    span["seconds"] = round(seconds, 6)
+    _record_span(span)
+
+def run_in_context(executor, fn, *args):
+    """把当前的统计上下文带入线程池任务"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def map_in_context(executor, fn, items):
+    """与 executor.map 相同，但每个任务都继承当前的统计上下文"""
+    futures = [run_in_context(executor, fn, item) for item in items]
+    return [future.result() for future in futures]
+
+def write_metrics_file():
+    """设置了 BIZYAIR_METRICS_FILE 时原子写出Prometheus文本，供node_exporter textfile采集"""
+    if not METRICS_FILE:
+        return
+    try:
+        tmp_path = f"{METRICS_FILE}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(PHASE_METRICS.render_prometheus())
+        os.replace(tmp_path, METRICS_FILE)
+    except OSError as e:
+        print(f"⚠️ 写出统计文件失败: {e}")
+
+def with_metrics_output(func):
+    """节点方法装饰器：在统计上下文中执行，并把 metrics_json 插入到 RETURN_NAMES 中对应的位置"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        collector = MetricsCollector()
+        token = _current_metrics.set(collector)
+        try:
+            result = list(func(self, *args, **kwargs))
+        finally:
+            _current_metrics.reset(token)
+            write_metrics_file()
+        result.insert(type(self).RETURN_NAMES.index("metrics_json"), collector.to_json())
+        return tuple(result)
+    return wrapper
+
+def _register_metrics_route():
+    """在ComfyUI服务器上注册 /bizyair/metrics（Prometheus）和 /bizyair/stats（JSON）"""
+    try:
+        from server import PromptServer
+        from aiohttp import web
+    except ImportError:
+        return
+    if getattr(PromptServer, "instance", None) is None:
+        return
+    
+    @PromptServer.instance.routes.get("/bizyair/metrics")
+    async def bizyair_metrics(request):
+        return web.Response(text=PHASE_METRICS.render_prometheus(), content_type="text/plain")
+    
+    @PromptServer.instance.routes.get("/bizyair/stats")
+    async def bizyair_stats(request):
+        return web.json_response({"phases": PHASE_METRICS.snapshot(), "http": get_http_stats(), "admission": ADMISSION.stats(),
+                                  "downloads": OBJECT_DOWNLOADER.stats()})
+
+_register_metrics_route()
+
+# 插件本地缓存目录（ComfyUI启动时会清空temp目录，持久缓存放在插件目录下）
+BIZYAIR_CACHE_DIR = os.environ.get("BIZYAIR_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+DOWNLOAD_STORE_MAX_BYTES = _env_int("BIZYAIR_DOWNLOAD_STORE_BYTES", 2 * 1024 * 1024 * 1024)
+
+class SingleFlight:
+    """相同key的并发调用只执行一次，其余调用者等待并共享结果或异常"""
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+    
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = {"event": threading.Event()}
+                self._calls[key] = call
+        
+        if not owner:
+            call["event"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+        
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+URL_FINGERPRINT_TTL = _env_float("BIZYAIR_URL_FINGERPRINT_TTL", 30.0)  # 该秒数内复用上次HEAD检查的结果，不再请求
+URL_FINGERPRINT_BUDGET = _env_float("BIZYAIR_URL_FINGERPRINT_BUDGET", 2.0)  # 排队时等待所有HEAD请求的总秒数
+
+# URL -> 服务器返回的 ETag/Last-Modified，用于判断同一URL的内容是否变化
+_url_validators = {}
+_url_checked_at = {}  # URL -> 上次HEAD检查的时间
+_url_changed = set()  # HEAD检查发现内容已变化、执行时需要丢弃本地缓存的URL
+_url_validators_lock = threading.Lock()
+_url_check_executor = None
+
+def remember_url_validator(url, headers):
+    """记录响应头中的 ETag/Last-Modified，返回该值（没有时返回空字符串）"""
+    validator = headers.get("ETag") or headers.get("Last-Modified") or ""
+    if validator:
+        with _url_validators_lock:
+            _url_validators[url] = validator
+    return validator
+
+def _check_url_validator(url, timeout=5):
+    """HEAD请求获取URL当前的ETag/Last-Modified；与上次记录不同时标记为已变化。
+    超出排队等待时间的请求在后台完成，结果留给下一次排队使用"""
+    try:
+        response = http_request("HEAD", url, retries=0, timeout=timeout, allow_redirects=True)
+        headers = response.headers if response.ok else {}
+    except Exception:
+        headers = {}
+    current = headers.get("ETag") or headers.get("Last-Modified") or ""
+    with _url_validators_lock:
+        _url_checked_at[url] = time.monotonic()
+        known = _url_validators.get(url, "")
+        if current and known and current != known:
+            print(f"🔄 URL内容已变化: {url}")
+            _url_changed.add(url)
+        if current:
+            _url_validators[url] = current
+
+def url_fingerprints(urls, budget=None):
+    """URL指纹列表：URL + 服务器当前的ETag/Last-Modified。
+    TTL内复用上次检查结果；过期的URL并发发出HEAD，总共最多等待 budget 秒，未返回或失败时使用上次记录的值"""
+    global _url_check_executor
+    budget = URL_FINGERPRINT_BUDGET if budget is None else budget
+    now = time.monotonic()
+    with _url_validators_lock:
+        stale = [url for url in dict.fromkeys(urls)
+                 if url not in _url_checked_at or now - _url_checked_at[url] > URL_FINGERPRINT_TTL]
+        if stale and _url_check_executor is None:
+            _url_check_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="bizyair-head")
+    if stale:
+        wait([_url_check_executor.submit(_check_url_validator, url) for url in stale], timeout=budget)
+    with _url_validators_lock:
+        return [f"{url}#{_url_validators.get(url, '')}" for url in urls]
+
+def discard_changed_url(url):
+    """HEAD检查发现内容已变化的URL，执行时丢弃本地下载缓存和解码缓存，下次读取会重新下载"""
+    with _url_validators_lock:
+        if url not in _url_changed:
+            return
+        _url_changed.discard(url)
+    DOWNLOAD_STORE.discard(url)
+    DECODED_OUTPUT_CACHE.discard(url)
+
+class DownloadStore:
+    """URL下载文件存储：原子写入、同URL并发下载合并、按访问时间LRU淘汰"""
+    
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # 文件名 -> 大小，按访问时间从旧到新排列
+        self._total_bytes = 0
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._loaded = False
+    
+    def _load_index_locked(self):
+        """启动时扫描一次目录建立索引，之后的存在性检查只查内存"""
+        if self._loaded:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        files = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(".tmp"):
+                    # 上次异常退出留下的未完成文件
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._index[name] = size
+            self._total_bytes += size
+        self._loaded = True
+        self._evict_locked()
+    
+    @staticmethod
+    def filename_for(url):
+        """使用URL的哈希值作为文件名，保留原扩展名"""
+        url_hash = hashlib.md5(url.encode('utf-8')).hexdigest()
+        ext = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+        return f"{url_hash}{ext or '.webp'}"
+    
+    def _touch_locked(self, name):
+        """记录访问：移到LRU末尾，并更新文件mtime供下次启动排序"""
+        self._index.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.root, name), None)
+        except OSError:
+            pass
+    
+    def _evict_locked(self):
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            name, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+    
+    def contains(self, url):
+        with self._lock:
+            self._load_index_locked()
+            return self.filename_for(url) in self._index
+    
+    def update_size(self, path):
+        """缓存文件被原地改写（例如格式转换）后重新记录其大小，保持字节预算准确"""
+        name = os.path.basename(path)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            return
+        with self._lock:
+            if name not in self._index:
+                return
+            size = os.path.getsize(path)
+            self._total_bytes += size - self._index[name]
+            self._index[name] = size
+            self._evict_locked()
+    
+    def discard(self, url):
+        """删除URL对应的缓存文件，下次 get 时重新下载"""
+        name = self.filename_for(url)
+        with self._lock:
+            self._load_index_locked()
+            size = self._index.pop(name, None)
+            if size is None:
+                return
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+    
+    def get(self, url, timeout=30):
+        """返回URL对应的本地文件路径，未缓存时下载；同一URL的并发请求共享一次下载"""
+        name = self.filename_for(url)
+        path = os.path.join(self.root, name)
+        with self._lock:
+            self._load_index_locked()
+            if name in self._index:
+                self._touch_locked(name)
+                return path
         
-        # 保存到缓存文件
-        with open(cache_file_path, 'wb') as f:
-            f.write(response.content)
+        def _fetch():
+            with self._lock:
+                if name in self._index:
+                    return path
+            size = self._download(url, path, timeout)
+            with self._lock:
+                self._index[name] = size
+                self._total_bytes += size
+                self._evict_locked()
+            return path
         
-        print(f"✅ 图像保存到: {cache_file_path}")
+        return self._flight.do(name, _fetch)
+    
+    def _download(self, url, path, timeout):
+        """下载到临时文件后重命名，读者不会看到写了一半的文件"""
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                size = OBJECT_DOWNLOADER.download(url, _FileSink(f), timeout=timeout)["size"]
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return size
+    
+    def stats(self):
+        with self._lock:
+            self._load_index_locked()
+            return {"files": len(self._index), "bytes": self._total_bytes, "max_bytes": self.max_bytes}
+
+DOWNLOAD_STORE = DownloadStore(os.path.join(BIZYAIR_CACHE_DIR, "downloads"), DOWNLOAD_STORE_MAX_BYTES)
+
+def download_and_cache_image(image_url):
+    """下载图像并缓存到本地文件夹"""
+    try:
+        discard_changed_url(image_url)
+        cached = DOWNLOAD_STORE.contains(image_url)
+        cache_file_path = DOWNLOAD_STORE.get(image_url)
+        if not cached:
+            print(f"✅ 图像保存到: {cache_file_path}")
         return cache_file_path
         
     except Exception as e:
@@ -104,138 +1271,2595 @@ def image_file_to_base64(image_path):
         print(f"❌ 图像文件转换base64失败: {e}")
         return None
 
-# 全局变量用于追踪当前的Key索引
-CURRENT_KEY_INDEX = 0
+# API Key文件路径及冷却配置
+KEY_FILE_PATH = os.path.join(os.path.dirname(__file__), "key", "siliconflow_API_key.txt")
+KEY_COOLDOWN_UNAUTHORIZED = _env_float("BIZYAIR_KEY_COOLDOWN_401", 600.0)  # 401/403 后暂停使用的秒数
+KEY_COOLDOWN_RATE_LIMITED = _env_float("BIZYAIR_KEY_COOLDOWN_429", 30.0)  # 429 且无 Retry-After 时暂停的秒数
+KEY_ERROR_WINDOW = 300.0  # 统计近期错误的时间窗口(秒)
+
+class ApiKeyPool:
+    """内存中的API Key池：文件修改后才重新加载，按在途请求数和近期错误选择Key，401/429后冷却"""
+    
+    def __init__(self, key_path):
+        self.key_path = key_path
+        self._keys = []
+        self._state = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+    
+    def _new_state(self):
+        return {"in_flight": 0, "requests": 0, "errors": deque(), "cooldown_until": 0.0, "last_selected": 0.0}
+    
+    def _reload_if_changed_locked(self):
+        try:
+            mtime = os.stat(self.key_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        keys = []
+        if mtime is not None:
+            with open(self.key_path, "r", encoding="utf-8") as f:
+                # 读取所有行并过滤空行
+                keys = [line.strip() for line in f.readlines() if line.strip()]
+        self._keys = list(dict.fromkeys(keys))
+        for key in self._keys:
+            self._state.setdefault(key, self._new_state())
+        self._mtime = mtime
+    
+    def _recent_errors_locked(self, state, now):
+        errors = state["errors"]
+        while errors and now - errors[0] > KEY_ERROR_WINDOW:
+            errors.popleft()
+        return len(errors)
+    
+    def select(self):
+        """选择在途请求最少、近期错误最少的可用Key；全部冷却中时选最早恢复的"""
+        with self._lock:
+            self._reload_if_changed_locked()
+            if not self._keys:
+                return ""
+            now = time.time()
+            healthy = [k for k in self._keys if self._state[k]["cooldown_until"] <= now]
+            if healthy:
+                # 负载相同的Key按上次选择时间轮询
+                key = min(healthy, key=lambda k: (self._state[k]["in_flight"], self._recent_errors_locked(self._state[k], now), self._state[k]["last_selected"]))
+            else:
+                key = min(self._keys, key=lambda k: self._state[k]["cooldown_until"])
+                print(f"⚠️ 所有API Key都在冷却中，使用最早恢复的Key: {key[:8]}...")
+            self._state[key]["last_selected"] = time.monotonic()
+            return key
+    
+    def begin(self, key):
+        """记录一个使用该Key的在途请求"""
+        with self._lock:
+            state = self._state.setdefault(key, self._new_state())
+            state["in_flight"] += 1
+            state["requests"] += 1
+    
+    def end(self, key, status_code=None, retry_after=None):
+        """请求结束：401/403/429 让Key进入冷却，其他错误计入近期错误"""
+        with self._lock:
+            state = self._state.setdefault(key, self._new_state())
+            state["in_flight"] = max(state["in_flight"] - 1, 0)
+            now = time.time()
+            if status_code in (401, 403):
+                state["cooldown_until"] = now + KEY_COOLDOWN_UNAUTHORIZED
+                print(f"🔒 API Key {key[:8]}... 认证失败，暂停使用 {KEY_COOLDOWN_UNAUTHORIZED:.0f} 秒")
+            elif status_code == 429:
+                cooldown = retry_after if retry_after is not None else KEY_COOLDOWN_RATE_LIMITED
+                state["cooldown_until"] = now + cooldown
+                print(f"🐢 API Key {key[:8]}... 被限流，暂停使用 {cooldown:.0f} 秒")
+            if status_code is None or status_code >= 400:
+                state["errors"].append(now)
+    
+    def contains(self, key):
+        with self._lock:
+            self._reload_if_changed_locked()
+            return key in self._keys
+    
+    def find_by_fingerprint(self, fingerprint):
+        """按 key_fingerprint 找回Key（任务日志中只保存指纹，不保存Key本身）"""
+        with self._lock:
+            self._reload_if_changed_locked()
+            return next((key for key in self._keys if key_fingerprint(key) == fingerprint), "")
+    
+    def add_key(self, key):
+        """把新Key追加到文件，已存在时不做任何文件操作；返回是否新增"""
+        with self._lock:
+            self._reload_if_changed_locked()
+            if key in self._keys:
+                return False
+            self._keys.append(key)
+            # 写回文件
+            os.makedirs(os.path.dirname(self.key_path), exist_ok=True)
+            with open(self.key_path, "w", encoding="utf-8") as f:
+                for existing_key in self._keys:
+                    f.write(f"{existing_key}\n")
+            self._state.setdefault(key, self._new_state())
+            self._mtime = os.stat(self.key_path).st_mtime_ns
+            return True
+    
+    def stats(self):
+        with self._lock:
+            self._reload_if_changed_locked()
+            now = time.time()
+            return {
+                f"{key[:8]}...": {
+                    "in_flight": self._state[key]["in_flight"],
+                    "requests": self._state[key]["requests"],
+                    "recent_errors": self._recent_errors_locked(self._state[key], now),
+                    "cooldown_remaining": round(max(self._state[key]["cooldown_until"] - now, 0.0), 1),
+                }
+                for key in self._keys
+            }
+
+KEY_POOL = ApiKeyPool(KEY_FILE_PATH)
+
+def key_fingerprint(api_key):
+    """API Key的短哈希，用于日志和统计中标识Key"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16] if api_key else ""
+
+def get_bizyair_api_key():
+    """获取BizyAIR API密钥，支持多Key负载均衡"""
+    try:
+        return KEY_POOL.select()
+    except Exception as e:
+        print(f"❌ 读取API Key失败: {e}")
+        return ""
+
+def save_bizyair_api_key(new_key):
+    """保存新的API Key到文件，自动去重"""
+    if not new_key or not new_key.strip():
+        return
+    
+    try:
+        # 添加新Key（如果不存在）
+        if KEY_POOL.add_key(new_key.strip()):
+            print(f"✅ 新API Key已保存到: {KEY_FILE_PATH}")
+            
+    except Exception as e:
+        print(f"❌ 保存API Key失败: {e}")
+
+# 图像编码器预设：名称 -> (PIL格式, MIME类型)
+IMAGE_ENCODERS = {
+    "WEBP": ("WebP", "image/webp"),
+    "WEBP_LOSSLESS": ("WebP", "image/webp"),
+    "PNG_FAST": ("PNG", "image/png"),
+    "PNG": ("PNG", "image/png"),
+    "JPEG": ("JPEG", "image/jpeg"),
+}
+DEFAULT_ENCODE_QUALITY = 80  # PIL WebP 默认质量
+DEFAULT_WEBP_METHOD = 4  # PIL WebP 默认method，0最快，6压缩率最高
+PNG_COMPRESS_LEVELS = {"PNG_FAST": 1, "PNG": 6}  # PNG压缩等级 0-9
+ENCODE_CONCURRENCY = _env_int("BIZYAIR_ENCODE_CONCURRENCY", 4)
+
+def tensor_content_hash(image_tensor):
+    """计算张量内容的哈希（包含形状和数据类型）"""
+    array = image_tensor.detach().cpu().contiguous().numpy()
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{tuple(array.shape)}{array.dtype}".encode('utf-8'))
+    hasher.update(memoryview(array).cast('B'))
+    return hasher.hexdigest()
+
+FINGERPRINT_SAMPLES = 4096  # 快速指纹抽样的元素个数
+
+def tensor_fingerprint(tensor, samples=FINGERPRINT_SAMPLES):
+    """快速张量指纹：形状、类型加上等间隔抽样元素的哈希，只读取很少的数据。
+    仅用于 IS_CHANGED 判断，编码缓存仍使用完整的 tensor_content_hash"""
+    flat = tensor.detach().reshape(-1)
+    step = max(1, flat.numel() // samples)
+    sample = flat[::step][:samples].contiguous().cpu()
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{tuple(tensor.shape)}{tensor.dtype}".encode('utf-8'))
+    hasher.update(sample.view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+def fingerprint_inputs(**inputs):
+    """节点输入的规范化哈希，张量使用 tensor_fingerprint，供 IS_CHANGED 使用"""
+    hasher = hashlib.sha256()
+    for name in sorted(inputs):
+        value = inputs[name]
+        if isinstance(value, torch.Tensor):
+            value = tensor_fingerprint(value)
+        hasher.update(f"{name}={json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)}\n".encode('utf-8'))
+    return hasher.hexdigest()
+
+def encode_pil_image(pil_image, encoder="WEBP", quality=DEFAULT_ENCODE_QUALITY, method=DEFAULT_WEBP_METHOD):
+    """按编码器预设把PIL图像编码为字节，返回 (数据, MIME类型)"""
+    pil_format, mime_type = IMAGE_ENCODERS[encoder]
+    buffer = BytesIO()
+    if encoder == "WEBP":
+        pil_image.save(buffer, format=pil_format, quality=quality, method=method)
+    elif encoder == "WEBP_LOSSLESS":
+        # 无损模式下quality表示压缩力度
+        pil_image.save(buffer, format=pil_format, lossless=True, quality=quality, method=method)
+    elif encoder in PNG_COMPRESS_LEVELS:
+        pil_image.save(buffer, format=pil_format, compress_level=PNG_COMPRESS_LEVELS[encoder])
+    else:
+        pil_image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue(), mime_type
+
+def image_to_base64(image_tensor, encoder="WEBP", quality=DEFAULT_ENCODE_QUALITY, method=DEFAULT_WEBP_METHOD):
+    """将图像张量转换为base64字符串，相同内容和编码参数只编码一次"""
+    # 确保图像张量是正确的格式 [batch, height, width, channels]
+    if len(image_tensor.shape) == 4:
+        image_tensor = image_tensor[0]  # 取第一张图
+    
+    with metrics_span("encode", encoder=encoder) as span:
+        memo_key = f"{tensor_content_hash(image_tensor)}:{encoder}:{quality}:{method}"
+        cached = ENCODE_MEMO_CACHE.get(memo_key, kind="encoded")
+        if cached is not None:
+            span["cache_hit"] = True
+            span["bytes"] = len(cached)
+            return cached
+        
+        # 转换为numpy数组并确保数据类型正确
+        if image_tensor.dtype != torch.uint8:
+            image_tensor = (image_tensor * 255).clamp(0, 255).to(torch.uint8)
+        
+        image_np = image_tensor.cpu().numpy()
+        
+        # 转换为PIL图像
+        pil_image = Image.fromarray(image_np)
+        
+        # 转换为base64
+        image_data, mime_type = encode_pil_image(pil_image, encoder, quality, method)
+        img_base64 = base64.b64encode(image_data).decode('utf-8')
+        
+        data_uri = f"data:{mime_type};base64,{img_base64}"
+        span["bytes"] = len(data_uri)
+        ENCODE_MEMO_CACHE.put(memo_key, data_uri, kind="encoded")
+        return data_uri
+
+def images_to_base64(image_tensor, encoder="WEBP", quality=DEFAULT_ENCODE_QUALITY, method=DEFAULT_WEBP_METHOD, max_workers=None):
+    """并行编码一个批次中的每张图像，按批次顺序返回base64字符串列表"""
+    if len(image_tensor.shape) == 3:
+        image_tensor = image_tensor[None,]
+    batch_size = image_tensor.shape[0]
+    if batch_size == 1:
+        return [image_to_base64(image_tensor[0], encoder, quality, method)]
+    
+    # PIL编码时会释放GIL，线程池可以真正并行
+    max_workers = max(1, min(max_workers or ENCODE_CONCURRENCY, batch_size))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bizyair-encode") as executor:
+        return map_in_context(executor, lambda i: image_to_base64(image_tensor[i], encoder, quality, method), range(batch_size))
+
+# 解码结果缓存配置（字节）
+DECODED_CACHE_MAX_BYTES = _env_int("BIZYAIR_DECODED_CACHE_BYTES", 512 * 1024 * 1024)
+
+def _estimate_value_size(value):
+    """估算缓存对象占用的内存字节数"""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(_estimate_value_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_value_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return 64
+
+def content_hash_from_headers(headers):
+    """从响应头中提取内容哈希（OSS CRC64 / ETag / Content-MD5），没有时返回None"""
+    for name in ("x-oss-hash-crc64ecma", "ETag", "Content-MD5"):
+        value = headers.get(name)
+        if value:
+            value = value.strip()
+            if value.startswith("W/"):
+                # 弱ETag不能代表内容一致
+                continue
+            return f"{name.lower()}:{value.strip(chr(34))}"
+    return None
+
+class DecodedOutputCache:
+    """进程级解码结果LRU缓存，按URL（以及可用时的内容哈希）索引，按字节预算淘汰"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size, content_hash)
+        self._hash_index = {}  # (kind, content_hash) -> key
+        self._aliases = {}  # 同一内容的其他URL -> key，不重复计入内存
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, url, kind="image"):
+        key = (kind, url)
+        with self._lock:
+            key = self._aliases.get(key, key)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def get_by_hash(self, content_hash, url=None, kind="image"):
+        """按内容哈希查找（同一对象的不同签名URL），命中时为新URL建立别名"""
+        if not content_hash:
+            return None
+        with self._lock:
+            key = self._hash_index.get((kind, content_hash))
+            entry = self._entries.get(key) if key else None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            # 之前按URL查找时已记为未命中，这里改记为命中
+            self.hits += 1
+            self.misses = max(self.misses - 1, 0)
+            if url and (kind, url) != key:
+                self._aliases[(kind, url)] = key
+            return entry[0]
+    
+    def put(self, url, value, kind="image", content_hash=None):
+        size = _estimate_value_size(value)
+        if size > self.max_bytes:
+            return
+        key = (kind, url)
+        with self._lock:
+            self._aliases.pop(key, None)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size, content_hash)
+            self.current_bytes += size
+            if content_hash:
+                self._hash_index[(kind, content_hash)] = key
+            self._evict_locked()
+    
+    def _evict_locked(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            key, (_, size, content_hash) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+            if content_hash and self._hash_index.get((key[0], content_hash)) == key:
+                del self._hash_index[(key[0], content_hash)]
+            for alias in [a for a, target in self._aliases.items() if target == key]:
+                del self._aliases[alias]
+    
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict_locked()
+    
+    def discard(self, url, kind="image"):
+        key = (kind, url)
+        with self._lock:
+            self._aliases.pop(key, None)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hash_index.clear()
+            self._aliases.clear()
+            self.current_bytes = 0
+    
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "aliases": len(self._aliases),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+DECODED_OUTPUT_CACHE = DecodedOutputCache(DECODED_CACHE_MAX_BYTES)
+
+# 编码结果缓存：张量内容哈希 -> base64字符串
+ENCODE_MEMO_CACHE = DecodedOutputCache(_env_int("BIZYAIR_ENCODE_CACHE_BYTES", 128 * 1024 * 1024))
+
+# 流式解码：每个线程复用一块下载缓冲区，避免 response.content 拼接带来的额外副本
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+_download_buffers = threading.local()
+_decode_stats_lock = threading.Lock()
+_decode_stats = {"count": 0, "bytes": 0, "megapixels": 0.0, "seconds": 0.0}
+
+class _MemoryViewReader:
+    """只读文件对象包装memoryview，PIL直接从缓冲区解码而不复制"""
+    
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+    
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+    
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._view)
+        self._pos = min(max(offset, 0), len(self._view))
+        return self._pos
+    
+    def tell(self):
+        return self._pos
+
+class _BufferSink:
+    """下载写入线程内复用的缓冲区，data() 返回指向有效数据的memoryview"""
+    
+    def __init__(self):
+        self.buffer = getattr(_download_buffers, "buffer", None)
+        if self.buffer is None:
+            self.buffer = _download_buffers.buffer = bytearray(DOWNLOAD_CHUNK_SIZE)
+        self.size = 0
+    
+    def reserve(self, total):
+        if total and total > len(self.buffer):
+            grown = bytearray(total)
+            grown[:self.size] = self.buffer[:self.size]
+            self.buffer = _download_buffers.buffer = grown
+    
+    def write(self, chunk):
+        end = self.size + len(chunk)
+        if end > len(self.buffer):
+            # 分块传输未给出长度时按倍数扩容
+            self.reserve(max(end, len(self.buffer) * 2))
+        self.buffer[self.size:end] = chunk
+        self.size = end
+    
+    def reset(self):
+        self.size = 0
+    
+    def data(self):
+        return memoryview(self.buffer)[:self.size]
+
+class _FileSink:
+    """下载写入文件（DownloadStore的临时文件）"""
+    
+    def __init__(self, f):
+        self.file = f
+        self.size = 0
+    
+    def reserve(self, total):
+        pass
+    
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+    
+    def reset(self):
+        self.file.seek(0)
+        self.file.truncate()
+        self.size = 0
+
+# 输出对象下载配置：断点续传、对冲请求、按主机熔断
+DOWNLOAD_MAX_ATTEMPTS = _env_int("BIZYAIR_DOWNLOAD_ATTEMPTS", 4)  # 每个对象最多发出的请求数（含续传）
+DOWNLOAD_READ_CHUNK = 256 * 1024  # 流式读取的块大小，也是中断时最多丢弃的数据量
+DOWNLOAD_STALL_TIMEOUT = _env_float("BIZYAIR_DOWNLOAD_STALL_TIMEOUT", 15.0)  # 连接或读取停顿超过该秒数即换一个连接续传
+DOWNLOAD_HEDGE_ENABLED = os.environ.get("BIZYAIR_DOWNLOAD_HEDGE", "1") != "0"
+DOWNLOAD_HEDGE_PERCENTILE = 0.95  # 等待响应头超过最近首字节耗时的该分位数时发出对冲请求
+DOWNLOAD_HEDGE_MIN_DELAY = 0.2
+DOWNLOAD_HEDGE_MAX_DELAY = _env_float("BIZYAIR_DOWNLOAD_HEDGE_MAX_DELAY", 5.0)  # 也是没有样本时的阈值
+BREAKER_FAILURE_THRESHOLD = _env_int("BIZYAIR_BREAKER_FAILURES", 5)  # 主机连续失败该次数后熔断
+BREAKER_COOLDOWN = _env_float("BIZYAIR_BREAKER_COOLDOWN", 30.0)  # 熔断持续秒数，之后放行一个试探请求
+_MD5_ETAG_RE = re.compile(r"^[0-9a-fA-F]{32}$")
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """目标主机处于熔断状态，请求未发出"""
+
+class HostCircuitBreaker:
+    """按主机的熔断器：连续失败达到阈值后打开，冷却后只放行一个试探请求，成功即关闭"""
+    
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._hosts = {}
+        self._lock = threading.Lock()
+    
+    def allow(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state["opened_at"] is None:
+                return True
+            if time.monotonic() - state["opened_at"] < self.cooldown or state["probing"]:
+                return False
+            state["probing"] = True
+            return True
+    
+    def release(self, host):
+        """试探请求没有得到结论（例如本地排队超时）时放弃试探，下次 allow() 重新放行一个"""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is not None:
+                state["probing"] = False
+    
+    def success(self, host):
+        with self._lock:
+            state = self._hosts.pop(host, None)
+        if state is not None and state["opened_at"] is not None:
+            print(f"✅ 主机 {host} 已恢复，解除熔断")
+    
+    def failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, {"failures": 0, "opened_at": None, "probing": False})
+            state["failures"] += 1
+            # 试探请求失败或连续失败达到阈值时（重新）打开
+            reopen = state["probing"] or (state["opened_at"] is None and state["failures"] >= self.threshold)
+            state["probing"] = False
+            if reopen:
+                state["opened_at"] = time.monotonic()
+        if reopen:
+            print(f"🔌 主机 {host} 连续失败 {state['failures']} 次，{self.cooldown:.0f}秒内暂停下载")
+    
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                host: {"failures": state["failures"],
+                       "open_remaining": round(max(state["opened_at"] + self.cooldown - now, 0.0), 1) if state["opened_at"] is not None else 0.0}
+                for host, state in self._hosts.items()
+            }
+
+def _close_response_future(future):
+    try:
+        future.result().close()
+    except Exception:
+        pass
+
+class ObjectDownloader:
+    """输出对象下载：响应头迟迟不到时发出对冲请求，中断后用Range从断点续传，校验长度和ETag，按主机熔断"""
+    
+    def __init__(self):
+        self.breaker = HostCircuitBreaker()
+        self._stats = {"downloads": 0, "resumes": 0, "restarts": 0, "hedges": 0, "hedge_wins": 0,
+                       "verify_failures": 0, "breaker_rejections": 0}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._etag_not_md5_hosts = set()  # ETag不是内容MD5的主机，不再按MD5校验
+    
+    def _count(self, field, amount=1):
+        with self._lock:
+            self._stats[field] += amount
+    
+    def _pool(self):
+        """requests传输下发起请求和关闭落选响应用的线程池"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="bizyair-fetch")
+            return self._executor
+    
+    def hedge_delay(self):
+        """对冲阈值：最近首字节耗时的p95，限制在 [MIN, MAX] 之间"""
+        recent = PHASE_METRICS.percentile("ttfb", DOWNLOAD_HEDGE_PERCENTILE)
+        if recent is None:
+            return DOWNLOAD_HEDGE_MAX_DELAY
+        return min(max(recent, DOWNLOAD_HEDGE_MIN_DELAY), DOWNLOAD_HEDGE_MAX_DELAY)
+    
+    def _start(self, url, headers, timeout, on_admitted=None):
+        if ASYNC_TRANSPORT.enabled:
+            return ASYNC_TRANSPORT.submit(async_http_request("GET", url, retries=0, on_admitted=on_admitted, headers=headers,
+                                                             timeout=timeout, stream=True))
+        return run_in_context(self._pool(), functools.partial(http_request, "GET", url, retries=0, on_admitted=on_admitted,
+                                                              headers=headers, timeout=timeout, stream=True))
+    
+    def _open(self, url, headers, timeout, hedge):
+        """发出请求并等待响应头；获准发出后超过对冲阈值仍未返回时再发一个相同请求，先返回的胜出，返回 (响应, 是否对冲)。
+        准入排队的时间不计入对冲阈值和首字节耗时；准入队列中还有请求排队时不对冲，避免过载时成倍增加请求"""
+        requested = time.monotonic()
+        delay = self.hedge_delay() if hedge else None
+        admitted = []  # 第一个请求获准发出的时间
+        started = [self._start(url, headers, timeout, lambda: admitted.append(time.monotonic()))]
+        pending = list(started)
+        error = None
+        while pending:
+            wait_time = None
+            if delay is not None and len(started) == 1:
+                # 尚在准入排队时短暂等待后再检查
+                wait_time = max(delay - (time.monotonic() - admitted[0]), 0.0) if admitted else 0.05
+            done, _ = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            if not done:
+                if not admitted:
+                    continue
+                if ADMISSION.queue_depth():
+                    delay = None
+                    continue
+                self._count("hedges")
+                started.append(self._start(url, headers, timeout))
+                pending.append(started[-1])
+                continue
+            for future in done:
+                pending.remove(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                # 落选的请求完成后在后台关闭
+                for other in started:
+                    if other is not future:
+                        other.add_done_callback(lambda f: self._pool().submit(_close_response_future, f))
+                if future is not started[0]:
+                    self._count("hedge_wins")
+                record_metric("ttfb", time.monotonic() - (admitted[0] if admitted else requested), hedged=len(started) > 1)
+                return response, len(started) > 1
+        raise error
+    
+    def download(self, url, sink, timeout=30, on_headers=None):
+        """下载对象写入 sink，返回 {"headers", "size", "resumes", "hedged", "aborted"}；
+        on_headers(headers) 返回False时不再读取响应体（例如内容已在缓存中）"""
+        host = urllib.parse.urlparse(url).netloc
+        deadline = time.monotonic() + timeout
+        info = {"headers": None, "size": 0, "resumes": 0, "hedged": False, "aborted": False}
+        validator = None  # 首个响应的ETag/Last-Modified，续传时通过 If-Range 确认仍是同一对象
+        total = None
+        md5 = expected_md5 = None
+        spliced = False
+        last_error = None
+        self._count("downloads")
+        
+        for attempt in range(DOWNLOAD_MAX_ATTEMPTS):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breaker.allow(host):
+                self._count("breaker_rejections")
+                raise CircuitOpenError(f"主机 {host} 熔断中，跳过下载: {url}")
+            if attempt and last_error is not None and sink.size == 0:
+                # 没有收到任何数据的失败按指数退避后重试
+                time.sleep(min(_backoff_delay(attempt - 1), remaining))
+            
+            headers = {}
+            if sink.size and validator:
+                headers = {"Range": f"bytes={sink.size}-", "If-Range": validator}
+            elif sink.size:
+                sink.reset()
+            request_timeout = min(DOWNLOAD_STALL_TIMEOUT, max(remaining, 1.0))
+            try:
+                response, hedged = self._open(url, headers, request_timeout, hedge=DOWNLOAD_HEDGE_ENABLED and not headers)
+            except requests.exceptions.RequestException as e:
+                self.breaker.failure(host)
+                last_error = e
+                continue
+            except BaseException:
+                self.breaker.release(host)
+                raise
+            info["hedged"] = info["hedged"] or hedged
+            received = 0  # 本次请求收到的字节数；收到过数据的中断说明主机仍在服务，不计入熔断
+            
+            try:
+                status = response.status_code
+                if status >= 500 or status == 429:
+                    self.breaker.failure(host)
+                    last_error = requests.exceptions.HTTPError(f"{status} Server Error for url: {url}", response=response)
+                    continue
+                # 主机给出了非5xx响应（包括4xx和416），说明它在正常服务，结束熔断或试探
+                self.breaker.success(host)
+                if status == 416:
+                    # 断点已超出对象长度：对象变了，从头下载
+                    sink.reset()
+                    validator = None
+                    continue
+                response.raise_for_status()
+                
+                if status == 206 and not (headers and self._range_matches(response, sink.size, total, validator)):
+                    # 返回的片段与断点对不上，放弃已下载部分从头开始
+                    sink.reset()
+                    validator = None
+                    last_error = requests.exceptions.ContentDecodingError(f"Content-Range 与断点不一致: {url}")
+                    continue
+                if status == 206:
+                    self._count("resumes")
+                    info["resumes"] += 1
+                    spliced = True
+                    print(f"🔁 从 {sink.size}/{total or '?'} 字节处续传: {url}")
+                else:
+                    if sink.size:
+                        # 服务器不支持Range或对象已变化，返回了完整对象
+                        self._count("restarts")
+                        sink.reset()
+                        spliced = False
+                    info["headers"] = response.headers
+                    remember_url_validator(url, response.headers)
+                    if on_headers is not None and on_headers(response.headers) is False:
+                        info["aborted"] = True
+                        self.breaker.success(host)
+                        return info
+                    encoded = response.headers.get("Content-Encoding", "identity").lower() != "identity"
+                    # 压缩传输时长度和Range都针对压缩后的数据，不做续传和校验
+                    total = None if encoded or not response.headers.get("Content-Length") else int(response.headers["Content-Length"])
+                    etag = (response.headers.get("ETag") or "").strip()
+                    validator = None if encoded or etag.startswith("W/") else (etag or response.headers.get("Last-Modified"))
+                    etag = etag.strip('"')
+                    expected_md5 = etag.lower() if _MD5_ETAG_RE.match(etag) and not encoded and host not in self._etag_not_md5_hosts else None
+                    md5 = hashlib.md5() if expected_md5 else None
+                    sink.reserve(total)
+                
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_READ_CHUNK):
+                    sink.write(chunk)
+                    received += len(chunk)
+                    if md5 is not None:
+                        md5.update(chunk)
+            except requests.exceptions.HTTPError:
+                raise
+            except requests.exceptions.RequestException as e:
+                if not received:
+                    self.breaker.failure(host)
+                last_error = e
+                print(f"⚠️ 下载中断（已收到 {sink.size}/{total or '?'} 字节）: {e}")
+                continue
+            finally:
+                response.close()
+            
+            if total is not None and sink.size != total:
+                # 连接提前关闭但没有报错
+                if not received:
+                    self.breaker.failure(host)
+                last_error = requests.exceptions.ChunkedEncodingError(f"响应不完整: {sink.size}/{total} 字节")
+                continue
+            if md5 is not None and md5.hexdigest() != expected_md5:
+                self._count("verify_failures")
+                if spliced:
+                    print(f"⚠️ 续传后的内容与ETag不符，重新完整下载: {url}")
+                    sink.reset()
+                    last_error = requests.exceptions.ContentDecodingError(f"MD5校验失败: {url}")
+                    continue
+                # 一次完整下载也不符，说明该主机的ETag不是内容MD5
+                self._etag_not_md5_hosts.add(host)
+            self.breaker.success(host)
+            info["size"] = sink.size
+            return info
+        raise last_error or TimeoutError(f"下载超时({timeout}秒): {url}")
+    
+    @staticmethod
+    def _range_matches(response, offset, total, validator):
+        """206响应的 Content-Range 起点、总长度和ETag是否与断点一致"""
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", response.headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != offset:
+            return False
+        if total is not None and match.group(3) != "*" and int(match.group(3)) != total:
+            return False
+        etag = response.headers.get("ETag")
+        return not (etag and validator and validator.startswith('"') and etag != validator)
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_delay"] = round(self.hedge_delay(), 3)
+        stats["breaker"] = self.breaker.stats()
+        return stats
+
+OBJECT_DOWNLOADER = ObjectDownloader()
+
+DECODE_STRIP_ROWS = 256  # 分条转换的行数，限制临时uint8数组的大小
+
+# 输出图像的存储类型：float32 与ComfyUI默认一致；float16 内存减半；
+# uint8 为延迟归一化，只占1/4内存，但ComfyUI自带的 IMAGE 节点（SaveImage、PreviewImage、VAEEncode 等）
+# 要求 [0, 1] 浮点值，只能接到本插件的编码、尺寸调整等节点，因此只能在节点上逐个选择，不能设为全局默认
+OUTPUT_DTYPES = {"float32": torch.float32, "float16": torch.float16, "uint8": torch.uint8}
+OUTPUT_UINT8_CHOICE = "uint8 (仅接BizyAIR节点)"
+OUTPUT_DTYPE_CHOICES = ["float32", "float16", OUTPUT_UINT8_CHOICE]
+OUTPUT_DTYPE = os.environ.get("BIZYAIR_OUTPUT_DTYPE", "float32").lower()
+if OUTPUT_DTYPE not in ("float32", "float16"):
+    if OUTPUT_DTYPE != "float32":
+        print(f"⚠️ BIZYAIR_OUTPUT_DTYPE 只支持 float32/float16，忽略 {OUTPUT_DTYPE}")
+    OUTPUT_DTYPE = "float32"
+OUTPUT_PIN_MEMORY = os.environ.get("BIZYAIR_PIN_MEMORY", "0") == "1"  # 输出分配在锁页内存，加快拷贝到GPU
+
+def decode_image_bytes(image_data, target_for=None):
+    """解码图像字节为 [1, H, W, C] float32 张量：按行分条直接写入目标张量，原地归一化。
+    提供 target_for(width, height) 时改为写入它返回的 [H, W, C] 张量（float32/float16/uint8），
+    返回该张量；target_for 返回None时不解码，返回None"""
+    start = time.perf_counter()
+    with Image.open(_MemoryViewReader(image_data) if isinstance(image_data, memoryview) else BytesIO(image_data)) as image:
+        print(f"🖼️ PIL图像加载成功，格式: {image.mode}, 尺寸: {image.size}")
+        
+        # 确保图像是RGB格式
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+            # print(f"🎨 图像已转换为RGB格式")
+        
+        # 分条把uint8像素拷入目标张量，不生成整图大小的uint8/float中间数组
+        width, height = image.size
+        if target_for is None:
+            image_tensor = torch.empty((1, height, width, 3), dtype=torch.float32)
+            target = image_tensor[0]
+        else:
+            target = image_tensor = target_for(width, height)
+            if target is None:
+                return None
+        for top in range(0, height, DECODE_STRIP_ROWS):
+            bottom = min(top + DECODE_STRIP_ROWS, height)
+            strip = np.asarray(image.crop((0, top, width, bottom)))
+            with warnings.catch_warnings():
+                # PIL导出的数组是只读的，这里只读取它，忽略torch的不可写警告
+                warnings.simplefilter("ignore", UserWarning)
+                target[top:bottom].copy_(torch.from_numpy(strip))
+    
+    # 原地归一化到 [0, 1]，uint8 存储保持原始像素值
+    if target.is_floating_point():
+        target.div_(255.0)
+    
+    with _decode_stats_lock:
+        _decode_stats["count"] += 1
+        _decode_stats["bytes"] += len(image_data)
+        _decode_stats["megapixels"] += height * width / 1e6
+        _decode_stats["seconds"] += time.perf_counter() - start
+    return image_tensor
+
+def resolve_output_dtype(output_dtype=None):
+    """规范化输出存储类型名称（接受节点上的选项文字），未知类型退回float32"""
+    name = (output_dtype or OUTPUT_DTYPE).lower()
+    if name == OUTPUT_UINT8_CHOICE.lower():
+        name = "uint8"
+    if name not in OUTPUT_DTYPES:
+        print(f"⚠️ 未知的输出存储类型 {name}，使用float32")
+        name = "float32"
+    return name
+
+def image_cache_kind(dtype_name):
+    """解码缓存按存储类型区分，float32沿用原有的 image 类型"""
+    return "image" if dtype_name == "float32" else f"image:{dtype_name}"
+
+_pin_memory_warned = False
+
+def allocate_output_tensor(shape, dtype, pin_memory=False):
+    """分配输出张量；需要锁页内存但没有CUDA时退回普通内存"""
+    global _pin_memory_warned
+    if pin_memory:
+        if torch.cuda.is_available():
+            try:
+                return torch.empty(shape, dtype=dtype, pin_memory=True), True
+            except RuntimeError as e:
+                print(f"⚠️ 锁页内存分配失败，使用普通内存: {e}")
+        elif not _pin_memory_warned:
+            _pin_memory_warned = True
+            print("⚠️ 未检测到CUDA，锁页内存不可用，使用普通内存")
+    return torch.empty(shape, dtype=dtype), False
+
+class OutputImageBatch:
+    """预分配的输出图像批次：第一张解码的图像确定尺寸后一次分配 [N, H, W, 3]，
+    各下载线程把图像直接解码进自己的槽位，合并时无需再拼接拷贝。
+    与批次尺寸不同的图像解码到单独的张量；合并时以序号最小的成功输出为准（与下载完成顺序无关）"""
+    
+    def __init__(self, count, output_dtype=None, pin_memory=None):
+        self.count = count
+        self.dtype_name = resolve_output_dtype(output_dtype)
+        self.dtype = OUTPUT_DTYPES[self.dtype_name]
+        self.pin_memory = OUTPUT_PIN_MEMORY if pin_memory is None else bool(pin_memory)
+        self.pinned = False
+        self.tensor = None
+        self.filled = [False] * count
+        self.aside = {}  # 序号 -> 尺寸与批次不同的 [H, W, 3] 张量
+        self.mismatched = 0
+        self.images = 0
+        self.peak_bytes = 0
+        self._held_bytes = 0  # 解码中的下载数据与单独张量的字节数
+        self._lock = threading.Lock()
+    
+    @property
+    def cache_kind(self):
+        return image_cache_kind(self.dtype_name)
+    
+    def _track_locked(self, extra=0):
+        batch_bytes = self.tensor.element_size() * self.tensor.nelement() if self.tensor is not None else 0
+        self.peak_bytes = max(self.peak_bytes, batch_bytes + self._held_bytes + extra)
+    
+    def slot(self, index, width, height):
+        """返回第 index 张图像的 [H, W, 3] 写入位置：尺寸与批次一致时为批次槽位，否则为单独的张量"""
+        with self._lock:
+            if self.tensor is None:
+                self.tensor, self.pinned = allocate_output_tensor((self.count, height, width, 3), self.dtype, self.pin_memory)
+                self._track_locked()
+            elif tuple(self.tensor.shape[1:3]) != (height, width):
+                target = torch.empty((height, width, 3), dtype=self.dtype)
+                self.aside[index] = target
+                self._held_bytes += target.element_size() * target.nelement()
+                self._track_locked()
+                return target
+            self.aside.pop(index, None)
+            return self.tensor[index]
+    
+    def hold(self, nbytes):
+        """登记正在解码的下载数据（负数表示释放），用于统计峰值内存"""
+        with self._lock:
+            self._held_bytes += nbytes
+            self._track_locked()
+    
+    def fill(self, index, image_tensor):
+        """把已解码的 [1, H, W, 3] 张量（例如缓存命中）拷入写入位置"""
+        target = self.slot(index, image_tensor.shape[2], image_tensor.shape[1])
+        target.copy_(image_tensor[0])
+        self.mark(index)
+        return target
+    
+    def mark(self, index):
+        with self._lock:
+            self.filled[index] = True
+    
+    def finish(self):
+        """返回只含成功图像的批次张量，尺寸以序号最小的成功输出为准；
+        全部成功且尺寸一致时直接返回预分配张量，没有图像时返回64x64空白图像"""
+        with self._lock:
+            indices = [i for i, ok in enumerate(self.filled) if ok]
+            if not indices:
+                self.images = 0
+                return torch.zeros((1, 64, 64, 3), dtype=self.dtype)
+            reference = self.aside[indices[0]].shape if indices[0] in self.aside else self.tensor.shape[1:]
+            kept = [i for i in indices if (self.aside[i].shape if i in self.aside else self.tensor.shape[1:]) == reference]
+            self.mismatched = len(indices) - len(kept)
+            self.images = len(kept)
+            if self.mismatched:
+                print(f"⚠️ 警告: 忽略了 {self.mismatched} 张尺寸不匹配的图像")
+            if len(kept) == self.count and not self.aside:
+                return self.tensor
+            # 有失败、超时或尺寸不同的输出：超时的下载可能仍在写入原张量，只能拷出保留的部分
+            final_image, _ = allocate_output_tensor((len(kept),) + tuple(reference), self.dtype, self.pinned)
+            self._track_locked(extra=final_image.element_size() * final_image.nelement())
+            for row, i in enumerate(kept):
+                final_image[row].copy_(self.aside[i] if i in self.aside else self.tensor[i])
+            return final_image
+    
+    def metrics(self, final_tensor):
+        return {
+            "bytes": final_tensor.element_size() * final_tensor.nelement(),
+            "peak_bytes": self.peak_bytes,
+            "images": self.images,
+            "dtype": self.dtype_name,
+            "pinned": self.pinned,
+        }
+
+def get_decode_stats():
+    """返回累计解码统计以及每百万像素的平均解码耗时"""
+    with _decode_stats_lock:
+        stats = dict(_decode_stats)
+    stats["ms_per_megapixel"] = round(stats["seconds"] * 1000 / stats["megapixels"], 2) if stats["megapixels"] else 0.0
+    return stats
+
+def download_image_tensor(image_url, timeout=30, batch=None, index=None):
+    """下载URL图像并转换为ComfyUI张量格式，失败时抛出异常；
+    提供 batch 时直接解码进 batch 的第 index 个槽位，返回该槽位"""
+    kind = batch.cache_kind if batch is not None else "image"
+    with metrics_span("download", kind="image") as span:
+        cached = DECODED_OUTPUT_CACHE.get(image_url, kind=kind)
+        if cached is not None:
+            span["cache_hit"] = True
+            return _place_image(cached, batch, index)
+        
+        # print(f"🌐 开始下载图像: {image_url}")
+        found = {}
+        
+        def check_hash(headers):
+            # 先检查内容哈希，同一对象已解码过则无需下载响应体
+            found["hash"] = content_hash_from_headers(headers)
+            found["tensor"] = DECODED_OUTPUT_CACHE.get_by_hash(found["hash"], image_url, kind=kind)
+            return found["tensor"] is None
+        
+        # 流式读取响应体到复用缓冲区后直接解码
+        sink = _BufferSink()
+        info = OBJECT_DOWNLOADER.download(image_url, sink, timeout=timeout, on_headers=check_hash)
+        if info["aborted"]:
+            span["cache_hit"] = True
+            return _place_image(found["tensor"], batch, index)
+        content_hash = found["hash"]
+        image_data = sink.data()
+        span["bytes"] = len(image_data)
+        if info["resumes"] or info["hedged"]:
+            span.update(resumes=info["resumes"], hedged=info["hedged"])
+    # print(f"💾 图像数据下载成功，大小: {len(image_data)} 字节")
+    if batch is None:
+        with metrics_span("decode", kind="image", bytes=len(image_data)):
+            image_tensor = decode_image_bytes(image_data)
+    else:
+        batch.hold(len(image_data))
+        try:
+            with metrics_span("decode", kind="image", bytes=len(image_data), dtype=batch.dtype_name):
+                target = decode_image_bytes(image_data, lambda width, height: batch.slot(index, width, height))
+        finally:
+            batch.hold(-len(image_data))
+        batch.mark(index)
+        # 缓存保存独立副本：槽位是返回给工作流的批次张量的视图，
+        # 直接缓存会让整个批次一直驻留，下游的原地修改也会改掉缓存内容
+        if target.element_size() * target.nelement() <= DECODED_OUTPUT_CACHE.max_bytes:
+            DECODED_OUTPUT_CACHE.put(image_url, target.unsqueeze(0).clone(), kind=kind, content_hash=content_hash)
+        return target
+    
+    # print(f"✅ 图像转换为张量成功，形状: {image_tensor.shape}, 数据类型: {image_tensor.dtype}")
+    # 与批次模式相同，缓存保存独立副本，返回给工作流的张量被原地修改时不影响缓存
+    if image_tensor.element_size() * image_tensor.nelement() <= DECODED_OUTPUT_CACHE.max_bytes:
+        DECODED_OUTPUT_CACHE.put(image_url, image_tensor.clone(), kind=kind, content_hash=content_hash)
+    return image_tensor
+
+def _place_image(image_tensor, batch, index):
+    """缓存命中的图像：单张模式返回副本，批次模式拷入槽位；缓存中的张量不直接交给工作流"""
+    if batch is None:
+        return image_tensor.clone()
+    return batch.fill(index, image_tensor)
+
+def url_to_tensor(image_url):
+    """将URL图像转换为ComfyUI张量格式"""
+    try:
+        return download_image_tensor(image_url)
+    except Exception as e:
+        print(f"❌ 加载图像失败: {e}")
+        # 返回一个默认的64x64空白图像
+        empty_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32)
+        print(f"🖼️ 返回默认空白图像: {empty_image.shape}")
+        return empty_image
+
+# 输出并发下载配置
+DOWNLOAD_CONCURRENCY = _env_int("BIZYAIR_DOWNLOAD_CONCURRENCY", 4)
+DOWNLOAD_OUTPUT_TIMEOUT = _env_int("BIZYAIR_DOWNLOAD_TIMEOUT", 60)  # 单个输出的超时时间(秒)
+
+def fetch_outputs(urls, loader, max_workers=None, timeout=None, label="图像", indexed=False):
+    """用 loader(url, timeout) 并发下载多个输出，按原始顺序返回结果列表，失败或超时的位置为None；
+    indexed 时调用 loader(index, url, timeout)"""
+    if not urls:
+        return []
+    max_workers = max(1, min(max_workers or DOWNLOAD_CONCURRENCY, len(urls)))
+    timeout = timeout or DOWNLOAD_OUTPUT_TIMEOUT
+    
+    started_at = {}
+    
+    def _worker(index, url):
+        started_at[index] = time.monotonic()
+        if indexed:
+            return loader(index, url, timeout=timeout)
+        return loader(url, timeout=timeout)
+    
+    results = [None] * len(urls)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bizyair-download")
+    try:
+        futures = {run_in_context(executor, _worker, i, url): i for i, url in enumerate(urls)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    print(f"❌ 下载{label}失败 {urls[index]}: {e}")
+            # 单个输出超时后不再等待，避免一个慢对象拖住整个节点
+            now = time.monotonic()
+            for future in list(pending):
+                index = futures[future]
+                if index in started_at and now - started_at[index] > timeout:
+                    print(f"⏱️ 下载{label}超时({timeout}秒)，已跳过: {urls[index]}")
+                    pending.discard(future)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    failed = sum(1 for t in results if t is None)
+    if failed:
+        print(f"⚠️ {failed}/{len(urls)} 个{label}输出下载失败，将使用其余输出")
+    return results
+
+def fetch_image_tensors(image_urls, max_workers=None, timeout=None):
+    """并发下载并解码多个图像URL，按原始顺序返回张量列表，失败或超时的位置为None"""
+    return fetch_outputs(image_urls, download_image_tensor, max_workers, timeout, label="图像")
+
+def fetch_image_batch(image_urls, max_workers=None, timeout=None, output_dtype=None, pin_memory=None):
+    """并发下载多个图像URL，直接解码进一个预分配的批次张量，按原始顺序返回 [N, H, W, 3]；
+    批次的实际字节数和峰值内存记录为 output_batch 阶段"""
+    start = time.perf_counter()
+    batch = OutputImageBatch(len(image_urls), output_dtype, pin_memory)
+    
+    def _load(index, url, timeout):
+        return download_image_tensor(url, timeout, batch=batch, index=index)
+    
+    fetch_outputs(image_urls, _load, max_workers, timeout, label="图像", indexed=True)
+    final_image = batch.finish()
+    record_metric("output_batch", time.perf_counter() - start, **batch.metrics(final_image))
+    if image_urls:
+        print(f"✅ 合并了 {final_image.shape[0]} 张图像，最终形状: {tuple(final_image.shape)}，"
+              f"存储: {batch.dtype_name}，峰值内存: {batch.peak_bytes / 1024 / 1024:.1f}MB")
+    return final_image
+
+# Latent 磁盘缓存：统一存为safetensors，再次加载时直接内存映射
+LATENT_STORE_MAX_BYTES = _env_int("BIZYAIR_LATENT_CACHE_BYTES", 2 * 1024 * 1024 * 1024)
+LATENT_STORE = DownloadStore(os.path.join(BIZYAIR_CACHE_DIR, "latents"), LATENT_STORE_MAX_BYTES)
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+_latent_convert_lock = threading.Lock()
+
+def empty_latent():
+    """默认的空白Latent"""
+    return {"samples": torch.zeros((1, 4, 8, 8), dtype=torch.float32)}
+
+def is_safetensors_file(path):
+    """按文件头判断是否为safetensors格式（8字节头长度 + JSON头）"""
+    with open(path, "rb") as f:
+        head = f.read(9)
+    if len(head) < 9 or head[8:9] != b"{":
+        return False
+    return int.from_bytes(head[:8], "little") < os.path.getsize(path)
+
+def load_safetensors_mmap(path):
+    """以内存映射读取safetensors文件，张量直接引用文件页（写时复制，不修改文件），返回 (张量字典, 元数据)"""
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    metadata = header.pop("__metadata__", None) or {}
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=file_size)
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        item_size = torch.empty((), dtype=dtype).element_size()
+        if offset % item_size == 0:
+            tensors[name] = torch.empty(0, dtype=dtype).set_(storage, offset // item_size, info["shape"])
+        else:
+            # 未对齐的张量无法直接映射，复制一份
+            raw = torch.empty(0, dtype=torch.uint8).set_(storage, offset, (end - begin,))
+            tensors[name] = raw.clone().view(dtype).reshape(info["shape"])
+    return tensors, metadata
+
+def convert_latent_to_safetensors(path):
+    """把torch序列化的Latent文件原地转换为safetensors；未安装safetensors时保持原样"""
+    try:
+        from safetensors.torch import save_file
+    except ImportError:
+        return False
+    latent = torch.load(path, map_location="cpu", weights_only=True)
+    tensors = {k: v.contiguous() for k, v in latent.items() if isinstance(v, torch.Tensor)}
+    extra = {k: v for k, v in latent.items() if not isinstance(v, torch.Tensor)}
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    save_file(tensors, tmp_path, metadata={"bizyair_extra": json.dumps(extra)})
+    os.replace(tmp_path, path)
+    return True
+
+def load_latent_file(path):
+    """从本地缓存文件加载ComfyUI Latent：safetensors走内存映射，其余用 weights_only 的 torch.load"""
+    if not is_safetensors_file(path):
+        with _latent_convert_lock:
+            converted = not is_safetensors_file(path) and convert_latent_to_safetensors(path)
+            if converted:
+                LATENT_STORE.update_size(path)
+        if not converted and not is_safetensors_file(path):
+            try:
+                return dict(torch.load(path, map_location="cpu", weights_only=True, mmap=True))
+            except RuntimeError:
+                # 旧版非zip格式不支持mmap
+                return dict(torch.load(path, map_location="cpu", weights_only=True))
+    
+    tensors, metadata = load_safetensors_mmap(path)
+    if "latent_tensor" in tensors:
+        # ComfyUI SaveLatent 格式，旧版本文件需要换算缩放系数
+        samples = tensors["latent_tensor"].float()
+        if "latent_format_version_0" not in tensors:
+            samples = samples * (1.0 / 0.18215)
+        return {"samples": samples}
+    latent = dict(tensors)
+    latent.update(json.loads(metadata.get("bizyair_extra", "{}")))
+    if "samples" not in latent:
+        raise ValueError(f"Latent文件中没有 samples 或 latent_tensor: {list(tensors)}")
+    return latent
+
+def _copy_latent(latent):
+    """Latent字典的独立副本：缓存中的张量是文件内存映射，不直接交给工作流"""
+    return {k: v.clone() if isinstance(v, torch.Tensor) else v for k, v in latent.items()}
+
+def download_latent(latent_url, timeout=60):
+    """下载URL Latent文件并转换为ComfyUI Latent格式，失败时抛出异常"""
+    with metrics_span("download", kind="latent") as span:
+        cached = DECODED_OUTPUT_CACHE.get(latent_url, kind="latent")
+        if cached is not None:
+            span["cache_hit"] = True
+            return _copy_latent(cached)
+        span["cache_hit"] = LATENT_STORE.contains(latent_url)
+        # print(f"🌐 开始下载Latent: {latent_url}")
+        path = LATENT_STORE.get(latent_url, timeout=timeout)
+        span["bytes"] = os.path.getsize(path)
+    
+    with metrics_span("decode", kind="latent", bytes=span["bytes"]):
+        latent = load_latent_file(path)
+    print(f"✅ Latent加载成功: {latent['samples'].shape}")
+    DECODED_OUTPUT_CACHE.put(latent_url, latent, kind="latent")
+    return _copy_latent(latent)
+
+def url_to_latent(latent_url):
+    """将URL Latent文件转换为ComfyUI Latent格式"""
+    try:
+        return download_latent(latent_url)
+    except Exception as e:
+        print(f"❌ 加载Latent失败: {e}")
+        return empty_latent()
+
+def decode_text_bytes(data, declared_charset=None):
+    """按 BOM、响应头声明的字符集、UTF-8、自动检测的顺序解码文本输出"""
+    for bom, encoding in ((b"\xef\xbb\xbf", "utf-8-sig"), (b"\xff\xfe", "utf-16"), (b"\xfe\xff", "utf-16")):
+        if data.startswith(bom):
+            return data.decode(encoding)
+    candidates = [declared_charset] if declared_charset else []
+    candidates.append("utf-8")
+    for encoding in candidates:
+        try:
+            return data.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+    # 国内服务常见的GBK等编码，交给requests自带的字符集检测（charset_normalizer/chardet）
+    detector = getattr(requests.compat, "chardet", None)
+    detected = detector.detect(data).get("encoding") if detector else None
+    return data.decode(detected or "gb18030", errors="replace")
+
+def download_text(text_url, timeout=30):
+    """下载文本输出并按字符集解码，结果进入URL缓存，失败时抛出异常"""
+    with metrics_span("download", kind="text") as span:
+        cached = DECODED_OUTPUT_CACHE.get(text_url, kind="text")
+        if cached is not None:
+            span["cache_hit"] = True
+            return cached
+        
+        found = {}
+        
+        def check_hash(headers):
+            found["hash"] = content_hash_from_headers(headers)
+            found["text"] = DECODED_OUTPUT_CACHE.get_by_hash(found["hash"], text_url, kind="text")
+            return found["text"] is None
+        
+        sink = _BufferSink()
+        info = OBJECT_DOWNLOADER.download(text_url, sink, timeout=timeout, on_headers=check_hash)
+        if info["aborted"]:
+            span["cache_hit"] = True
+            return found["text"]
+        content_hash = found["hash"]
+        data = bytes(sink.data())
+        span["bytes"] = len(data)
+    # requests 在没有声明charset时对 text/* 默认ISO-8859-1，这里只采用服务器明确声明的字符集
+    headers = info["headers"]
+    declared = requests.utils.get_encoding_from_headers(headers) if "charset" in headers.get("Content-Type", "") else None
+    text = decode_text_bytes(data, declared)
+    DECODED_OUTPUT_CACHE.put(text_url, text, kind="text", content_hash=content_hash)
+    return text
+
+def fetch_texts(text_urls, max_workers=None, timeout=None):
+    """并发下载多个文本输出，按原始顺序返回，失败或超时的位置为None"""
+    return fetch_outputs(text_urls, download_text, max_workers, timeout, label="文本")
+
+def merge_text_outputs(text_urls, texts):
+    """合并文本输出，返回 (全部文本, JSON字符串)；.json 输出和内容可解析为JSON的文本进入JSON输出"""
+    valid = [(url, text) for url, text in zip(text_urls, texts) if text is not None]
+    parsed = []
+    for url, text in valid:
+        stripped = text.strip()
+        is_json = urllib.parse.urlparse(url).path.lower().endswith(".json")
+        if is_json or stripped[:1] in ("{", "["):
+            try:
+                parsed.append(json.loads(stripped))
+            except ValueError:
+                if is_json:
+                    print(f"⚠️ JSON输出解析失败: {url}")
+    merged_text = "\n\n".join(text for _, text in valid)
+    if not parsed:
+        return merged_text, ""
+    return merged_text, json.dumps(parsed[0] if len(parsed) == 1 else parsed, ensure_ascii=False, indent=2)
+
+def fetch_latents(latent_urls, max_workers=None, timeout=None):
+    """并发下载多个Latent，按原始顺序返回，失败或超时的位置为None"""
+    return fetch_outputs(latent_urls, download_latent, max_workers, timeout, label="Latent")
+
+def merge_latents(latents):
+    """把多个Latent的 samples 沿批次维拼接，没有有效Latent时返回空白Latent"""
+    latents = [latent for latent in latents if latent is not None]
+    if not latents:
+        return empty_latent()
+    if len(latents) == 1:
+        return latents[0]
+    first_shape = latents[0]["samples"].shape[1:]
+    valid = [latent["samples"] for latent in latents if latent["samples"].shape[1:] == first_shape]
+    if len(valid) < len(latents):
+        print(f"⚠️ 警告: 忽略了 {len(latents) - len(valid)} 个尺寸不匹配的Latent")
+    return {"samples": torch.cat(valid, dim=0)}
+
+# 图像上传配置：上传一次后只在请求中传URL
+UPLOAD_URL_TTL_HOURS = _env_float("BIZYAIR_UPLOAD_TTL_HOURS", 24.0)  # 已上传URL的有效期
+BIZYAIR_UPLOAD_URL = os.environ.get("BIZYAIR_UPLOAD_URL", "").rstrip("/")  # 设置后改用HTTP PUT上传（本地替身服务器）
+
+def _mime_extension(mime_type):
+    return mimetypes.guess_extension(mime_type) or ".bin"
+
+def bizyair_oss_uploader(data, file_name, mime_type, api_key):
+    """上传到BizyAIR输入存储：获取STS上传凭证 -> 写入OSS -> 登记输入资源，返回资源URL"""
+    try:
+        import oss2
+    except ImportError:
+        raise RuntimeError("上传到BizyAIR需要安装 oss2: pip install oss2")
+    
+    headers = {"Authorization": f"Bearer {api_key}"}
+    query = urllib.parse.urlencode({"file_name": file_name, "file_type": "inputs"})
+    response = _keyed_request(api_key, "GET", f"{BIZYAIR_API_BASE}/x/v1/upload/token?{query}", headers=headers, timeout=30)
+    response.raise_for_status()
+    token = normalize_task_result(response.json())
+    file_info = token["file"]
+    storage = token["storage"]
+    
+    auth = oss2.StsAuth(file_info["access_key_id"], file_info["access_key_secret"], file_info["security_token"])
+    bucket = oss2.Bucket(auth, storage["endpoint"], storage["bucket"])
+    with ADMISSION.admit("upload"):
+        bucket.put_object(file_info["object_key"], data, headers={"Content-Type": mime_type})
+    
+    response = _keyed_request(api_key, "POST", f"{BIZYAIR_API_BASE}/x/v1/input_resource/commit",
+                              headers={**headers, "Content-Type": "application/json"},
+                              json={"name": file_name, "object_key": file_info["object_key"]}, timeout=30)
+    response.raise_for_status()
+    return normalize_task_result(response.json())["url"]
+
+def http_put_uploader(data, file_name, mime_type, api_key):
+    """通过HTTP PUT上传到 BIZYAIR_UPLOAD_URL，响应JSON中有url时使用它，否则使用PUT地址"""
+    target = f"{BIZYAIR_UPLOAD_URL}/{file_name}"
+    response = http_request("PUT", target, data=data, headers={"Content-Type": mime_type, "Authorization": f"Bearer {api_key}"}, timeout=60)
+    response.raise_for_status()
+    try:
+        return response.json().get("url") or target
+    except ValueError:
+        return target
+
+_image_uploader = None
+
+def register_image_uploader(uploader):
+    """替换图像上传函数 uploader(data, file_name, mime_type, api_key) -> url；传None恢复默认"""
+    global _image_uploader
+    _image_uploader = uploader
+
+def get_image_uploader():
+    if _image_uploader is not None:
+        return _image_uploader
+    return http_put_uploader if BIZYAIR_UPLOAD_URL else bizyair_oss_uploader
+
+class UploadIndex:
+    """内容哈希 -> 已上传URL 的本地索引，带过期时间，持久化到JSON文件"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+    
+    def _load_locked(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+    
+    def _save_locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        now = time.time()
+        self._entries = {h: e for h, e in self._entries.items() if e.get("expires_at", 0) > now}
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+    
+    def get(self, content_hash):
+        with self._lock:
+            self._load_locked()
+            entry = self._entries.get(content_hash)
+            if entry and entry.get("expires_at", 0) > time.time():
+                return entry["url"]
+            return None
+    
+    def put(self, content_hash, url, ttl_hours=UPLOAD_URL_TTL_HOURS):
+        with self._lock:
+            self._load_locked()
+            self._entries[content_hash] = {"url": url, "expires_at": time.time() + ttl_hours * 3600}
+            self._save_locked()
+    
+    def upload(self, data, mime_type, api_key, ttl_hours=UPLOAD_URL_TTL_HOURS):
+        """按内容哈希上传，已上传且未过期时直接返回URL"""
+        content_hash = hashlib.sha256(data).hexdigest()
+        url = self.get(content_hash)
+        if url:
+            record_metric("upload", 0.0, cache_hit=True)
+            print(f"📋 图像已上传过，复用URL: {content_hash[:12]}")
+            return url
+        
+        def _upload():
+            cached_url = self.get(content_hash)
+            if cached_url:
+                return cached_url
+            file_name = f"{content_hash}{_mime_extension(mime_type)}"
+            with metrics_span("upload", bytes=len(data)):
+                new_url = get_image_uploader()(data, file_name, mime_type, api_key)
+            self.put(content_hash, new_url, ttl_hours)
+            print(f"⬆️ 图像上传完成: {len(data)} 字节 -> {new_url}")
+            return new_url
+        return self._flight.do(content_hash, _upload)
+
+UPLOAD_INDEX = UploadIndex(os.path.join(BIZYAIR_CACHE_DIR, "uploads.json"))
+
+def upload_data_uri(data_uri, api_key=None):
+    """把 data:...;base64 图像上传并返回URL"""
+    header, payload = data_uri.split(",", 1)
+    mime_type = header[len("data:"):].split(";", 1)[0]
+    return UPLOAD_INDEX.upload(base64.b64decode(payload), mime_type, api_key or get_bizyair_api_key())
+
+def upload_data_uris(data_uris, api_key=None, max_workers=None):
+    """并行上传多张图像，按顺序返回URL列表"""
+    if len(data_uris) == 1:
+        return [upload_data_uri(data_uris[0], api_key)]
+    max_workers = max(1, min(max_workers or ENCODE_CONCURRENCY, len(data_uris)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bizyair-upload") as executor:
+        return map_in_context(executor, lambda uri: upload_data_uri(uri, api_key), data_uris)
+
+# 输出类型分类
+IMAGE_OUTPUT_EXTS = ['.png', '.jpg', '.jpeg', '.webp', '.bmp']
+LATENT_OUTPUT_EXTS = ['.latent']
+TEXT_OUTPUT_EXTS = ['.txt', '.text', '.json', '.md']
+
+# 任务终止状态（小写）
+TASK_TERMINAL_STATUSES = ('completed', 'success', 'failed', 'canceled', 'cancelled', 'error')
+TASK_SUCCESS_STATUSES = ('completed', 'success')
+
+# 异步提交请求头：create接口立即返回任务ID，不等待远程执行完成
+BIZYAIR_ASYNC_HEADERS = {"X-Bizyair-Task-Async": "enable"}
+
+def parse_input_values(inputs):
+    """解析 "节点名|值" 格式的输入列表为 input_values 字典"""
+    input_values = {}
+    for input_data in inputs:
+        if not input_data or not input_data.strip():
+            continue
+        # 分析输入格式，例如: "91:LoadImage.image|https://example.com/image.jpg"
+        input_data = input_data.strip()
+        if '|' in input_data:
+            node_name, value = input_data.split('|', 1)
+            input_values[node_name] = value
+    return input_values
+
+def _keyed_request(api_key, method, url, **kwargs):
+    """发送使用API Key的请求，并把结果反馈给Key池"""
+    KEY_POOL.begin(api_key)
+    response = None
+    try:
+        response = http_request(method, url, api_key=api_key, **kwargs)
+        return response
+    finally:
+        status_code = response.status_code if response is not None else None
+        KEY_POOL.end(api_key, status_code, _parse_retry_after(response) if status_code == 429 else None)
+
+async def _keyed_request_async(api_key, method, url, **kwargs):
+    """_keyed_request 的协程版本"""
+    KEY_POOL.begin(api_key)
+    response = None
+    try:
+        response = await async_http_request(method, url, api_key=api_key, **kwargs)
+        return response
+    finally:
+        status_code = response.status_code if response is not None else None
+        KEY_POOL.end(api_key, status_code, _parse_retry_after(response) if status_code == 429 else None)
+
+def submit_bizyair_task(web_app_id, input_values, api_key, async_submit=False, timeout=300):
+    """调用create接口提交任务，返回API响应字典"""
+    url = f"{BIZYAIR_API_BASE}/w/v1/webapp/task/openapi/create"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    if async_submit:
+        headers.update(BIZYAIR_ASYNC_HEADERS)
+    
+    data = {
+        "web_app_id": web_app_id,
+        "suppress_preview_output": True,
+        "input_values": input_values
+    }
+    
+    # print(f"BizyAIR请求数据: {json.dumps(data, indent=2, ensure_ascii=False)}")
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    with metrics_span("create", bytes=len(body), async_submit=async_submit):
+        response = _keyed_request(api_key, "POST", url, headers=headers, data=body, timeout=timeout)
+        response.raise_for_status()
+        return normalize_task_result(response.json())
+
+def normalize_task_result(result):
+    """兼容 {"data": {...}} 包装格式的任务响应"""
+    if isinstance(result, dict) and 'status' not in result and isinstance(result.get('data'), dict):
+        return result['data']
+    return result
+
+def is_task_terminal(result):
+    """判断任务是否已结束（成功或失败）"""
+    return str(result.get('status', '')).lower() in TASK_TERMINAL_STATUSES
+
+def _parse_task_status(task_id, response, span):
+    response.raise_for_status()
+    span["bytes"] = len(response.content)
+    result = normalize_task_result(response.json())
+    if is_task_terminal(result):
+        TERMINAL_TASK_STATUS[task_id] = result.get('status')
+    return result
+
+def fetch_task_status(task_id, api_key, timeout=30):
+    """查询单个任务的状态，返回API响应字典"""
+    url = f"{BIZYAIR_API_BASE}/w/v1/webapp/task/{task_id}"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    with metrics_span("status") as span:
+        response = _keyed_request(api_key, "GET", url, headers=headers, timeout=timeout)
+        return _parse_task_status(task_id, response, span)
+
+async def fetch_task_status_async(task_id, api_key, timeout=30):
+    """fetch_task_status 的协程版本，供轮询调度器在传输事件循环中并发查询"""
+    url = f"{BIZYAIR_API_BASE}/w/v1/webapp/task/{task_id}"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    with metrics_span("status") as span:
+        response = await _keyed_request_async(api_key, "GET", url, headers=headers, timeout=timeout)
+        return _parse_task_status(task_id, response, span)
+
+# Web应用输入模式：各输入字段的类型、取值范围和图像尺寸，用于提交前的本地校验
+# 模式接口地址，可含 {web_app_id}。BizyAIR没有公开的模式接口，为空时不发请求，只使用 cache/schemas 中手工放入的模式文件
+INPUT_SCHEMA_URL = os.environ.get("BIZYAIR_SCHEMA_URL", "")
+INPUT_SCHEMA_TTL_HOURS = _env_float("BIZYAIR_SCHEMA_TTL_HOURS", 24.0)
+INPUT_SCHEMA_RETRY_SECONDS = 300  # 获取模式出错后，多久之后再重试
+VALIDATE_INPUTS = os.environ.get("BIZYAIR_VALIDATE_INPUTS", "1") != "0"
+INPUT_TYPE_ALIASES = {
+    "integer": "int", "number": "float", "str": "string", "text": "string", "bool": "boolean",
+    "select": "enum", "combo": "enum",
+}
+
+class InputValidationError(ValueError):
+    """输入值不符合Web应用的输入模式，在提交create请求之前本地失败"""
+    
+    def __init__(self, web_app_id, errors):
+        self.errors = list(errors)
+        super().__init__(f"web_app_id {web_app_id} 的输入校验失败: " + "；".join(self.errors))
+
+def normalize_input_schema(raw):
+    """把接口返回或手工编写的模式规范化为 {"inputs": {字段名: 规格}, "strict": bool}，无法识别时返回None；
+    支持 {"data": ...} 包装，inputs 可以是以字段名为键的字典，也可以是带 name 的列表"""
+    if isinstance(raw, dict) and "inputs" not in raw and isinstance(raw.get("data"), dict):
+        raw = raw["data"]
+    if not isinstance(raw, dict):
+        return None
+    inputs = raw.get("inputs")
+    if isinstance(inputs, list):
+        inputs = {item["name"]: item for item in inputs if isinstance(item, dict) and item.get("name")}
+    if not isinstance(inputs, dict):
+        return None
+    specs = {}
+    for name, spec in inputs.items():
+        spec = {k: v for k, v in spec.items() if k != "name"} if isinstance(spec, dict) else {"type": spec}
+        kind = str(spec.get("type", "string")).lower()
+        spec["type"] = INPUT_TYPE_ALIASES.get(kind, kind)
+        specs[name] = spec
+    # strict：出现模式中没有的字段时报错（通常是节点ID填错，远端会忽略该值）；
+    # 模式来源不一定完整，默认只打印警告，模式明确要求时才拒绝提交
+    return {"inputs": specs, "strict": bool(raw.get("strict", False))}
+
+class InputSchemaCache:
+    """按 web_app_id 缓存输入模式：内存 + 插件缓存目录下的JSON文件。
+    接口获取的模式按TTL过期；手工放入目录的模式文件（不含 fetched_at）不会被接口结果覆盖"""
+    
+    def __init__(self, directory, ttl_hours=INPUT_SCHEMA_TTL_HOURS):
+        self.directory = directory
+        self.ttl_hours = ttl_hours
+        self._entries = {}  # web_app_id -> (模式或None, 过期时间)
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+    
+    def _path(self, web_app_id):
+        return os.path.join(self.directory, f"{int(web_app_id)}.json")
+    
+    def get(self, web_app_id, api_key=None):
+        """返回规范化的模式；该应用没有可用模式时返回None"""
+        with self._lock:
+            entry = self._entries.get(web_app_id)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        return self._flight.do(("schema", web_app_id), lambda: self._load(web_app_id, api_key))
+    
+    def _remember(self, web_app_id, schema, ttl_seconds):
+        with self._lock:
+            self._entries[web_app_id] = (schema, time.time() + ttl_seconds)
+        return schema
+    
+    def _load(self, web_app_id, api_key):
+        ttl_seconds = self.ttl_hours * 3600
+        path = self._path(web_app_id)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            if "fetched_at" not in stored:
+                return self._remember(web_app_id, normalize_input_schema(stored), ttl_seconds)
+            if time.time() - stored["fetched_at"] < ttl_seconds:
+                return self._remember(web_app_id, stored.get("schema"), ttl_seconds - (time.time() - stored["fetched_at"]))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            print(f"⚠️ 读取输入模式缓存失败 {path}: {e}")
+        
+        if not INPUT_SCHEMA_URL:
+            # 未配置模式接口：没有模式文件的应用跳过校验，过一段时间再检查是否放入了文件
+            return self._remember(web_app_id, None, INPUT_SCHEMA_RETRY_SECONDS)
+        try:
+            schema = self._fetch(web_app_id, api_key)
+        except Exception as e:
+            print(f"⚠️ 获取 web_app_id {web_app_id} 的输入模式失败，跳过本地校验: {e}")
+            return self._remember(web_app_id, None, INPUT_SCHEMA_RETRY_SECONDS)
+        self._store(path, {"fetched_at": time.time(), "schema": schema})
+        return self._remember(web_app_id, schema, ttl_seconds)
+    
+    def _fetch(self, web_app_id, api_key):
+        """从 BIZYAIR_SCHEMA_URL 获取模式；应用没有发布模式（404）时返回None"""
+        # 不是BizyAIR公开的API：不经过 _keyed_request，该地址返回的401/403/404不能让Key池把可用的Key判为失效；
+        # 请求在首次create之前，不重试，出错时直接跳过校验
+        url = INPUT_SCHEMA_URL.format(web_app_id=web_app_id)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        with metrics_span("schema") as span:
+            response = http_request("GET", url, retries=0, api_key=api_key, headers=headers, timeout=15)
+            if response.status_code in (401, 403, 404):
+                # 没有模式或无权读取模式，都按“没有可用模式”处理
+                return None
+            response.raise_for_status()
+            span["bytes"] = len(response.content)
+            schema = normalize_input_schema(response.json())
+        if schema is not None:
+            print(f"📋 已获取 web_app_id {web_app_id} 的输入模式: {len(schema['inputs'])} 个字段")
+        return schema
+    
+    def _store(self, path, stored):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(stored, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ 写入输入模式缓存失败: {e}")
+    
+    def invalidate(self, web_app_id=None):
+        with self._lock:
+            if web_app_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(web_app_id, None)
+
+INPUT_SCHEMAS = InputSchemaCache(os.path.join(BIZYAIR_CACHE_DIR, "schemas"))
+
+def schema_image_size(spec, width, height):
+    """按图像字段规格计算应提交的尺寸（沿用 BA_Image_Resizer 的尺寸计算）：
+    固定 width/height 时缩放到该尺寸；超过 max_width/max_height 时保持宽高比缩小；再按 multiple_of 向下对齐"""
+    if spec.get("width") and spec.get("height"):
+        return compute_resize_dimensions(width, height, int(spec["width"]), int(spec["height"]), maintain_aspect_ratio=False)
+    max_width = int(spec.get("max_width") or 0)
+    max_height = int(spec.get("max_height") or 0)
+    if (max_width and width > max_width) or (max_height and height > max_height):
+        width, height = compute_resize_dimensions(width, height, max_width or width, max_height or height)
+    multiple = int(spec.get("multiple_of") or 0)
+    if multiple > 1:
+        width = max(multiple, width // multiple * multiple)
+        height = max(multiple, height // multiple * multiple)
+    return width, height
+
+def data_uri_image_size(value):
+    """读取 data:image base64 值的图像尺寸（只解析图像头，不解码像素）"""
+    payload = value.split(",", 1)[1] if "," in value else value
+    with Image.open(BytesIO(base64.b64decode(payload))) as image:
+        return image.size
+
+def _check_input_value(spec, value, image_sizes):
+    """检查单个输入值，返回错误描述，符合时返回None"""
+    kind = spec["type"]
+    text = str(value).strip()
+    if kind in ("int", "float"):
+        try:
+            number = int(text) if kind == "int" else float(text)
+        except ValueError:
+            return f"应为{'整数' if kind == 'int' else '数值'}，实际为 {text[:32]!r}"
+        if spec.get("min") is not None and number < spec["min"]:
+            return f"{number} 小于最小值 {spec['min']}"
+        if spec.get("max") is not None and number > spec["max"]:
+            return f"{number} 大于最大值 {spec['max']}"
+    elif kind == "boolean":
+        if text.lower() not in ("true", "false", "1", "0"):
+            return f"应为布尔值，实际为 {text[:32]!r}"
+    elif kind == "enum":
+        options = [str(option) for option in spec.get("options") or []]
+        if options and text not in options:
+            return f"{text[:32]!r} 不在可选值 {options} 中"
+    elif kind == "string":
+        if spec.get("max_length") and len(text) > int(spec["max_length"]):
+            return f"长度 {len(text)} 超过上限 {spec['max_length']}"
+    elif kind == "image" and text:
+        if text.startswith("data:"):
+            if text not in image_sizes:
+                image_sizes[text] = data_uri_image_size(text)
+            width, height = image_sizes[text]
+            expected = schema_image_size(spec, width, height)
+            if expected != (width, height):
+                return (f"图像尺寸 {width}x{height} 不符合要求（应为 {expected[0]}x{expected[1]}），"
+                        f"可在 BA_LoadImage 中填写 web_app_id 并开启 auto_resize")
+        elif not text.startswith(("http://", "https://")):
+            return "应为图像URL或 data:image base64"
+    return None
+
+def validate_input_values(schema, input_values, image_sizes=None):
+    """按输入模式检查一组 input_values，返回错误描述列表"""
+    image_sizes = {} if image_sizes is None else image_sizes
+    specs = schema["inputs"]
+    errors = []
+    for name, value in input_values.items():
+        spec = specs.get(name)
+        if spec is None:
+            message = f"{name}: 该Web应用没有这个输入（可用输入: {', '.join(sorted(specs))}）"
+            if schema["strict"]:
+                errors.append(message)
+            else:
+                print(f"⚠️ 输入模式中没有该输入，仍然提交: {message}")
+            continue
+        try:
+            error = _check_input_value(spec, value, image_sizes)
+        except Exception as e:
+            error = f"无法解析输入值: {e}"
+        if error:
+            errors.append(f"{name}: {error}")
+    for name, spec in specs.items():
+        if spec.get("required") and not str(input_values.get(name, "")).strip():
+            errors.append(f"{name}: 缺少必填输入")
+    return errors
+
+def validate_task_inputs(web_app_id, input_values_list, api_key=None):
+    """提交前按Web应用的输入模式校验所有任务的输入，有错误时抛出 InputValidationError；没有可用模式时跳过"""
+    schema = INPUT_SCHEMAS.get(web_app_id, api_key)
+    if schema is None:
+        return False
+    with metrics_span("validate", tasks=len(input_values_list)):
+        image_sizes = {}  # 批量任务中广播的同一图像只解析一次
+        errors = []
+        for index, input_values in enumerate(input_values_list):
+            prefix = f"[任务{index + 1}] " if len(input_values_list) > 1 else ""
+            errors.extend(prefix + error for error in validate_input_values(schema, input_values, image_sizes))
+        if errors:
+            for error in errors:
+                print(f"❌ 输入校验失败: {error}")
+            raise InputValidationError(web_app_id, errors)
+    print(f"✅ 输入校验通过: {len(input_values_list)} 组输入")
+    return True
+
+def fit_image_to_schema(web_app_id, node_name, image, resample_method="LANCZOS"):
+    """按输入模式把图像批次缩放到该输入要求的尺寸（BA_Image_Resizer 的缩放逻辑），不需要调整时原样返回"""
+    schema = INPUT_SCHEMAS.get(web_app_id, get_bizyair_api_key() or None)
+    spec = schema["inputs"].get(node_name) if schema else None
+    if not spec or spec["type"] != "image":
+        return image
+    if len(image.shape) == 3:
+        image = image[None,]
+    width, height = image.shape[2], image.shape[1]
+    new_width, new_height = schema_image_size(spec, width, height)
+    if (new_width, new_height) == (width, height):
+        return image
+    with metrics_span("resize", kind="image"):
+        resized = resize_image_batch(image, new_width, new_height, resample_method)
+    print(f"📐 按输入模式调整尺寸: {node_name} {width}x{height} -> {new_width}x{new_height}")
+    return resized
+
+# 已结束任务的最终状态，任务状态检查节点据此跳过重复查询
+TERMINAL_TASK_STATUS = {}
+
+def report_task_failure(result):
+    """打印失败任务的错误信息和解决建议"""
+    if result.get('status') != 'Failed':
+        return
+    print("=== BizyAIR执行失败 ===")
+    if 'outputs' in result and len(result['outputs']) > 0:
+        error_info = result['outputs'][0]
+        error_type = error_info.get('error_type', 'Unknown')
+        error_msg = error_info.get('error_msg', 'No error message')
+        
+        print(f"错误类型: {error_type}")
+        print(f"错误信息: {error_msg}")
+        
+        # 解析具体的ComfyUI错误
+        if 'exception_message' in error_msg:
+            if 'size of tensor' in error_msg and 'must match' in error_msg:
+                print("⚠️  张量维度不匹配错误 - 这通常是由以下原因造成的:")
+                print("   1. 输入图像尺寸与模型期望不匹配")
+                print("   2. 工作流中的节点参数配置错误")
+                print("   3. 模型和采样器不兼容")
+                print("   4. 建议检查图像尺寸和工作流配置")
+        
+        # 提供解决建议
+        if 'SamplerCustomAdvanced' in error_msg:
+            print("💡 建议解决方案:")
+            print("   - 确保输入图像尺寸为标准比例 (如 1024x1024, 512x768 等)")
+            print("   - 检查采样器设置与模型兼容性")
+            print("   - 尝试使用不同的采样器或调整参数")
+
+def split_task_outputs(result):
+    """按类型拆分任务输出URL，返回 (图像URL, Latent URL, 文本URL)"""
+    image_urls = []
+    latent_urls = []
+    text_urls = []
+    
+    status = str(result.get('status', '')).lower()
+    if status in TASK_SUCCESS_STATUSES and 'outputs' in result:
+        for output in result['outputs']:
+            obj_url = output.get('object_url', '')
+            ext = output.get('output_ext', '').lower()
+            
+            if not obj_url:
+                continue
+                
+            if ext in IMAGE_OUTPUT_EXTS:
+                image_urls.append(obj_url)
+            elif ext in LATENT_OUTPUT_EXTS:
+                latent_urls.append(obj_url)
+            elif ext in TEXT_OUTPUT_EXTS:
+                text_urls.append(obj_url)
+    return image_urls, latent_urls, text_urls
+
+def download_task_outputs(image_urls, latent_urls=(), text_urls=(), return_latent=False, return_text=False,
+                          download_concurrency=None, output_timeout=None, output_dtype=None, pin_memory=None):
+    """图像、Latent、文本输出同时并发下载，返回 (image, latent, text, text_json)"""
+    background = {}
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="bizyair-outputs") as executor:
+        if return_latent and latent_urls:
+            background["latent"] = run_in_context(executor, fetch_latents, list(latent_urls), download_concurrency, output_timeout)
+        if return_text and text_urls:
+            background["text"] = run_in_context(executor, fetch_texts, list(text_urls), download_concurrency, output_timeout)
+        # 并发下载图像，按输出顺序直接解码进预分配的批次张量
+        final_image = fetch_image_batch(image_urls, download_concurrency, output_timeout, output_dtype, pin_memory)
+        latent = merge_latents(background["latent"].result()) if "latent" in background else empty_latent()
+        text, text_json = merge_text_outputs(text_urls, background["text"].result()) if "text" in background else ("", "")
+    return final_image, latent, text, text_json
+
+def collect_task_outputs(result, download_concurrency=None, output_timeout=None, return_latent=False, return_text=False,
+                         output_dtype=None, pin_memory=None):
+    """下载任务输出，返回 (response_json, task_id, image_url, image, latent_url, txt_url, latent, text, text_json)"""
+    report_task_failure(result)
+    
+    # 提取结果 - 返回完整的API响应数据
+    response_json = json.dumps(result, ensure_ascii=False, indent=2)
+    task_id = result.get('request_id', '')
+    print(f"任务 ID：{task_id}")
+    
+    image_urls, latent_urls, text_urls = split_task_outputs(result)
+    final_image, latent, text, text_json = download_task_outputs(
+        image_urls, latent_urls, text_urls, return_latent, return_text, download_concurrency, output_timeout,
+        output_dtype, pin_memory)
+    if JOURNAL_ENABLED and is_task_terminal(result):
+        JOB_JOURNAL.mark_delivered([task_id])
+    
+    return (response_json, task_id, "\n".join(image_urls), final_image, "\n".join(latent_urls), "\n".join(text_urls),
+            latent, text, text_json)
+
+# 轮询退避配置
+POLL_INTERVAL_MIN = _env_float("BIZYAIR_POLL_INTERVAL", 1.0)
+POLL_INTERVAL_MAX = _env_float("BIZYAIR_POLL_INTERVAL_MAX", 10.0)
+POLL_BACKOFF_FACTOR = 1.5
+
+POLL_MAX_RPS = _env_float("BIZYAIR_POLL_MAX_RPS", 5.0)  # 所有任务状态查询合计的每秒请求上限，0为不限
+POLL_WORKERS = _env_int("BIZYAIR_POLL_WORKERS", 4)  # 同时进行的状态查询数
+
+class TaskPollScheduler:
+    """进程内共享的任务轮询调度器：所有等待中的任务由一个调度线程统一安排，
+    每个任务按各自的退避间隔查询，全部查询合计不超过 max_rps，同一任务的多个等待者共享查询结果"""
+    
+    def __init__(self, max_rps=POLL_MAX_RPS, workers=POLL_WORKERS):
+        self.max_rps = max_rps
+        self.workers = workers
+        self.requests = 0
+        self._tasks = {}  # task_id -> 轮询状态
+        self._heap = []  # (下次查询时间, 序号, task_id)
+        self._seq = itertools.count()
+        self._next_slot = 0.0  # 全局限速：下一次允许发出查询的时间
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+    
+    def _schedule_locked(self, state, delay):
+        state["seq"] = next(self._seq)
+        heapq.heappush(self._heap, (time.monotonic() + delay, state["seq"], state["task_id"]))
+        self._cond.notify()
+    
+    def watch(self, task_id, api_key, poll_interval=None):
+        """登记一个等待者，返回任务的轮询状态（其中 done 事件在任务结束时置位）"""
+        poll_interval = poll_interval or POLL_INTERVAL_MIN
+        with self._cond:
+            state = self._tasks.get(task_id)
+            if state is None:
+                state = {
+                    "task_id": task_id,
+                    "api_key": api_key,
+                    "interval": poll_interval,
+                    "waiters": 0,
+                    "result": None,
+                    "done": threading.Event(),
+                    # 查询在调度线程中执行，沿用第一个等待者的统计上下文
+                    "context": contextvars.copy_context(),
+                }
+                self._tasks[task_id] = state
+                self._schedule_locked(state, 0.0)
+            else:
+                state["interval"] = min(state["interval"], poll_interval)
+            state["waiters"] += 1
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bizyair-poll")
+                self._thread = threading.Thread(target=self._run, daemon=True, name="bizyair-poll-scheduler")
+                self._thread.start()
+            return state
+    
+    def release(self, state):
+        """等待者不再等待（传入 watch 返回的状态）；没有等待者的任务停止轮询。
+        任务结束后同一ID可能已被新的等待者重新登记，只释放这次登记对应的状态"""
+        with self._cond:
+            if self._tasks.get(state["task_id"]) is not state:
+                return
+            state["waiters"] -= 1
+            if state["waiters"] <= 0:
+                del self._tasks[state["task_id"]]
+    
+    def _next_due_locked(self):
+        """弹出失效的堆项，返回下一个到期任务的状态，没有时返回None"""
+        while self._heap:
+            _, seq, task_id = self._heap[0]
+            state = self._tasks.get(task_id)
+            if state is not None and state["seq"] == seq:
+                return state
+            heapq.heappop(self._heap)
+        return None
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    state = self._next_due_locked()
+                    now = time.monotonic()
+                    if state is None:
+                        self._cond.wait()
+                        continue
+                    due = max(self._heap[0][0], self._next_slot)
+                    if due <= now:
+                        break
+                    self._cond.wait(due - now)
+                heapq.heappop(self._heap)
+                state["seq"] = None  # 查询进行中，不在堆里
+                if self.max_rps > 0:
+                    self._next_slot = max(now, self._next_slot) + 1.0 / self.max_rps
+                self.requests += 1
+            if ASYNC_TRANSPORT.enabled:
+                # 查询在传输事件循环中并发进行，线程池只处理结果
+                future = ASYNC_TRANSPORT.submit(fetch_task_status_async(state["task_id"], state["api_key"]), state["context"])
+                future.add_done_callback(lambda f, state=state: self._executor.submit(state["context"].run, self._poll_done, state, f))
+            else:
+                self._executor.submit(state["context"].run, self._poll_once, state)
+    
+    def _poll_once(self, state):
+        try:
+            result = fetch_task_status(state["task_id"], state["api_key"])
+        except Exception as e:
+            print(f"⚠️ 查询任务 {state['task_id']} 失败: {e}")
+            result = None
+        self._finish_poll(state, result)
+    
+    def _poll_done(self, state, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"⚠️ 查询任务 {state['task_id']} 失败: {e}")
+            result = None
+        self._finish_poll(state, result)
+    
+    def _finish_poll(self, state, result):
+        task_id = state["task_id"]
+        if result is not None and JOURNAL_ENABLED:
+            JOB_JOURNAL.update_task(task_id, result)
+        
+        with self._cond:
+            if result is not None and is_task_terminal(result):
+                result.setdefault('request_id', task_id)
+                state["result"] = result
+                if self._tasks.get(task_id) is state:
+                    del self._tasks[task_id]
+                state["done"].set()
+                print(f"📊 任务 {task_id} 已结束: {result.get('status')}")
+                return
+            if self._tasks.get(task_id) is not state:
+                # 等待者都已超时离开
+                return
+            # 自适应退避：任务越久未完成，查询间隔越长
+            state["interval"] = min(state["interval"] * POLL_BACKOFF_FACTOR, POLL_INTERVAL_MAX)
+            self._schedule_locked(state, state["interval"])
+    
+    def stats(self):
+        with self._cond:
+            return {"watching": len(self._tasks), "requests": self.requests, "max_rps": self.max_rps}
+
+TASK_POLLER = TaskPollScheduler()
+
+def poll_bizyair_tasks(handles, timeout=600, poll_interval=None):
+    """通过共享调度器轮询多个任务直到全部结束或超时，按输入顺序返回结果（超时为None）"""
+    results = [None] * len(handles)
+    watched = {}
+    for i, handle in enumerate(handles):
+        # 提交时已结束的任务（同步返回）无需轮询
+        if handle.get('result') and is_task_terminal(handle['result']):
+            results[i] = handle['result']
+        else:
+            watched[i] = TASK_POLLER.watch(handle['task_id'], handle['api_key'], poll_interval)
+    
+    deadline = time.monotonic() + timeout
+    try:
+        for i, state in watched.items():
+            handle = handles[i]
+            if not state["done"].wait(max(deadline - time.monotonic(), 0)):
+                print(f"⏱️ 任务 {handle['task_id']} 等待超时({timeout}秒)")
+                continue
+            results[i] = state["result"]
+            if handle.get('submitted_at'):
+                # 从提交到观察到结束的时间，即远程排队+执行时间
+                record_metric("remote_queue", time.time() - handle['submitted_at'], task_id=handle['task_id'])
+    finally:
+        for state in watched.values():
+            TASK_POLLER.release(state)
+    return results
+
+# 请求结果缓存配置
+RESULT_CACHE_TTL_HOURS = _env_float("BIZYAIR_RESULT_CACHE_TTL_HOURS", 24.0)
+RESULT_CACHE_IGNORE_FIELDS = ""  # 默认所有输入都参与指纹；只想按其余参数复用结果时可填 "seed"
+
+def _canonical_input_value(value):
+    """base64图像替换为解码后内容的哈希，其余值原样参与指纹计算"""
+    if isinstance(value, str) and value.startswith("data:") and ";base64," in value:
+        header, payload = value.split(",", 1)
+        try:
+            digest = hashlib.sha256(base64.b64decode(payload)).hexdigest()
+        except (ValueError, TypeError):
+            digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        return f"{header},sha256:{digest}"
+    return value
+
+def _parse_ignore_fields(ignore_fields):
+    if isinstance(ignore_fields, str):
+        ignore_fields = ignore_fields.replace("\n", ",").split(",")
+    return [f.strip().lower() for f in (ignore_fields or []) if f and f.strip()]
+
+def request_fingerprint(web_app_id, input_values, ignore_fields=None):
+    """计算请求的规范化哈希，ignore_fields 中的关键字匹配的节点(如seed)不参与计算"""
+    patterns = _parse_ignore_fields(ignore_fields)
+    canonical = {
+        node_name: _canonical_input_value(value)
+        for node_name, value in input_values.items()
+        if not any(p in node_name.lower() for p in patterns)
+    }
+    payload = json.dumps({"web_app_id": int(web_app_id), "input_values": canonical}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """持久化的请求结果缓存：按请求指纹保存成功任务的响应，带TTL和并发请求合并"""
+    
+    def __init__(self, root):
+        self.root = root
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+    
+    def _path(self, fingerprint):
+        return os.path.join(self.root, f"{fingerprint}.json")
+    
+    def get(self, fingerprint, ttl_hours=RESULT_CACHE_TTL_HOURS):
+        path = self._path(fingerprint)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if ttl_hours and time.time() - entry.get("created_at", 0) > ttl_hours * 3600:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.get("result")
+    
+    def discard(self, fingerprint):
+        try:
+            os.remove(self._path(fingerprint))
+        except OSError:
+            pass
+    
+    def put(self, fingerprint, result):
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(fingerprint)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "result": result}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def get_or_submit(self, fingerprint, submit_fn, ttl_hours=RESULT_CACHE_TTL_HOURS, refresh=False):
+        """缓存未命中时提交任务；同时到达的相同请求共享同一个远程任务。refresh 时忽略已有结果并覆盖"""
+        def _run():
+            cached = None if refresh else self.get(fingerprint, ttl_hours)
+            if cached is not None:
+                return cached
+            result = submit_fn()
+            if str(result.get('status', '')).lower() in TASK_SUCCESS_STATUSES:
+                self.put(fingerprint, result)
+            return result
+        return self._flight.do(fingerprint, _run)
+
+RESULT_CACHE = ResultCache(os.path.join(BIZYAIR_CACHE_DIR, "results"))
+
+def cached_outputs_available(result, timeout=10):
+    """缓存的响应只保存了输出的签名URL，URL过期后命中缓存也下载不到任何输出。
+    只探测第一个输出（同一任务的URL有效期相同）；401/403/404/410 视为已失效，网络错误不能说明失效，按可用处理"""
+    urls = [output.get('object_url') for output in result.get('outputs', []) if output.get('object_url')]
+    if not urls:
+        return True
+    try:
+        response = http_request("GET", urls[0], retries=0, timeout=timeout, headers={"Range": "bytes=0-0"})
+    except Exception:
+        return True
+    return response.status_code not in (401, 403, 404, 410)
+
+# 任务日志配置：记录每次提交，ComfyUI重启或节点超时后继续轮询，复用已完成但未交付的结果
+JOURNAL_PATH = os.path.join(BIZYAIR_CACHE_DIR, "jobs.sqlite3")
+JOURNAL_ENABLED = _env_int("BIZYAIR_JOURNAL", 1) == 1
+JOURNAL_RESUME_HOURS = _env_float("BIZYAIR_JOURNAL_RESUME_HOURS", 24.0)  # 超过这个时间的任务不再恢复或复用
+JOURNAL_DURABLE_SYNC = _env_int("BIZYAIR_JOURNAL_DURABLE_SYNC", 1) == 1  # 同步调用也改为异步提交+轮询，任务ID提交后立即落盘；设为0恢复同步create
+TASK_WAIT_TIMEOUT = _env_int("BIZYAIR_TASK_WAIT_TIMEOUT", 600)  # 同步等待已提交任务的超时时间(秒)
+# create请求（含准入排队）最长的耗时；超过这个时间仍是 Submitting 的记录才认为提交进程已退出。
+# 同一插件目录可能被多个ComfyUI进程共用，不能把其他进程正在提交的记录标为 Lost
+JOURNAL_SUBMIT_LEASE = _env_int("BIZYAIR_JOURNAL_SUBMIT_LEASE", 900)
+# 本地状态：Submitting 为create请求进行中，Error 为提交失败，Lost 为进程退出时仍在提交中（任务ID未知）
+JOURNAL_FINAL_STATUSES = TASK_TERMINAL_STATUSES + ('lost', 'timeout')
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fingerprint TEXT NOT NULL,
+    web_app_id INTEGER,
+    key_fingerprint TEXT,
+    task_id TEXT,
+    status TEXT NOT NULL,
+    async_submit INTEGER NOT NULL DEFAULT 0,
+    submitted_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL,
+    delivered_at REAL,
+    reuse_count INTEGER NOT NULL DEFAULT 0,
+    output_urls TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs(fingerprint, submitted_at);
+CREATE INDEX IF NOT EXISTS jobs_task_id ON jobs(task_id);
+CREATE INDEX IF NOT EXISTS jobs_submitted_at ON jobs(submitted_at);
+"""
+
+class JobJournal:
+    """SQLite任务日志（WAL模式，多线程各用一个连接并发写入）"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.time()
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+    
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # isolation_level=None：每条语句自动提交，避免长事务阻塞其他写入者
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(JOURNAL_SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _row(row):
+        return dict(row) if row is not None else None
+    
+    def begin(self, fingerprint, web_app_id, api_key, async_submit=False):
+        """create请求发出前登记，返回日志ID"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO jobs (fingerprint, web_app_id, key_fingerprint, status, async_submit, submitted_at, updated_at) "
+            "VALUES (?, ?, ?, 'Submitting', ?, ?, ?)",
+            (fingerprint, web_app_id, key_fingerprint(api_key), int(bool(async_submit)), now, now))
+        return cursor.lastrowid
+    
+    def _result_columns(self, result):
+        image_urls, latent_urls, text_urls = split_task_outputs(result)
+        terminal = is_task_terminal(result)
+        return (
+            result.get('status', 'Unknown'),
+            json.dumps(image_urls + latent_urls + text_urls, ensure_ascii=False),
+            json.dumps(result, ensure_ascii=False) if terminal else None,
+            time.time() if terminal else None,
+        )
+    
+    def record_result(self, job_id, result):
+        """create请求返回后记录任务ID和状态"""
+        status, output_urls, result_json, finished_at = self._result_columns(result)
+        self._conn().execute(
+            "UPDATE jobs SET task_id = ?, status = ?, output_urls = ?, result = ?, finished_at = ?, updated_at = ? WHERE id = ?",
+            (result.get('request_id', ''), status, output_urls, result_json, finished_at, time.time(), job_id))
+    
+    def record_error(self, job_id, error):
+        self._conn().execute(
+            "UPDATE jobs SET status = 'Error', error = ?, finished_at = ?, updated_at = ? WHERE id = ?",
+            (str(error)[:2000], time.time(), time.time(), job_id))
+    
+    def update_task(self, task_id, result):
+        """轮询得到新状态时更新；状态未变的非终态结果不写库"""
+        status, output_urls, result_json, finished_at = self._result_columns(result)
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, output_urls = ?, result = ?, finished_at = COALESCE(finished_at, ?), updated_at = ? "
+            "WHERE task_id = ? AND (status != ? OR result IS NULL AND ? IS NOT NULL)",
+            (status, output_urls, result_json, finished_at, time.time(), task_id, status, result_json))
+    
+    def mark_delivered(self, task_ids):
+        """节点已把结果输出到工作流，之后相同输入不再复用这条记录"""
+        task_ids = [task_id for task_id in task_ids if task_id]
+        if task_ids:
+            placeholders = ",".join("?" * len(task_ids))
+            self._conn().execute(
+                f"UPDATE jobs SET delivered_at = ? WHERE delivered_at IS NULL AND task_id IN ({placeholders})",
+                [time.time()] + task_ids)
+    
+    def mark_reused(self, job_id):
+        self._conn().execute("UPDATE jobs SET reuse_count = reuse_count + 1 WHERE id = ?", (job_id,))
+    
+    def key_for_task(self, task_id):
+        """提交该任务时使用的Key（日志中只有指纹，需在Key池中找回），找不到时返回空字符串"""
+        row = self._conn().execute(
+            "SELECT key_fingerprint FROM jobs WHERE task_id = ? ORDER BY submitted_at DESC LIMIT 1", (task_id,)).fetchone()
+        return KEY_POOL.find_by_fingerprint(row["key_fingerprint"]) if row and row["key_fingerprint"] else ""
+    
+    def find_reusable(self, fingerprint, max_age_hours=JOURNAL_RESUME_HOURS, exclude=()):
+        """相同输入最近的可恢复记录：未结束的任务，或已成功但结果尚未交付的任务；跳过 exclude 中的日志ID"""
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE fingerprint = ? AND submitted_at >= ? AND task_id IS NOT NULL AND task_id != '' "
+            "AND delivered_at IS NULL ORDER BY submitted_at DESC LIMIT ?",
+            (fingerprint, time.time() - max_age_hours * 3600, len(exclude) + 5)).fetchall()
+        for row in rows:
+            if row["id"] in exclude:
+                continue
+            status = str(row["status"]).lower()
+            if status not in JOURNAL_FINAL_STATUSES or (status in TASK_SUCCESS_STATUSES and row["result"]):
+                return self._row(row)
+        return None
+    
+    def mark_lost_submissions(self, lease_seconds=JOURNAL_SUBMIT_LEASE):
+        """提交进程退出后仍是 Submitting 的记录拿不到任务ID，标记为 Lost；
+        只处理超过提交租期的记录，其他进程正在进行的提交不受影响"""
+        self._conn().execute(
+            "UPDATE jobs SET status = 'Lost', updated_at = ? WHERE status = 'Submitting' AND submitted_at < ?",
+            (time.time(), min(self.started_at, time.time() - lease_seconds)))
+    
+    def pending_jobs(self, max_age_hours=JOURNAL_RESUME_HOURS):
+        """尚未结束、可继续轮询的任务"""
+        placeholders = ",".join("?" * len(JOURNAL_FINAL_STATUSES))
+        rows = self._conn().execute(
+            f"SELECT * FROM jobs WHERE task_id IS NOT NULL AND task_id != '' AND submitted_at >= ? "
+            f"AND lower(status) NOT IN ({placeholders}) AND status NOT IN ('Submitting', 'Error')",
+            [time.time() - max_age_hours * 3600, *JOURNAL_FINAL_STATUSES]).fetchall()
+        return [self._row(row) for row in rows]
+    
+    def query(self, status=None, web_app_id=None, limit=50):
+        """最近的任务记录（不含完整响应）"""
+        sql = ("SELECT id, fingerprint, web_app_id, key_fingerprint, task_id, status, async_submit, submitted_at, updated_at, "
+               "finished_at, delivered_at, reuse_count, output_urls, error FROM jobs WHERE 1 = 1")
+        params = []
+        if status:
+            sql += " AND lower(status) = ?"
+            params.append(status.lower())
+        if web_app_id:
+            sql += " AND web_app_id = ?"
+            params.append(web_app_id)
+        sql += " ORDER BY submitted_at DESC LIMIT ?"
+        params.append(int(limit))
+        return [self._row(row) for row in self._conn().execute(sql, params).fetchall()]
+    
+    def report(self, hours=24.0, web_app_id=None):
+        """时间窗口内的吞吐、失败率和耗时分位数，按应用分组"""
+        since = time.time() - hours * 3600
+        sql = "SELECT web_app_id, status, submitted_at, finished_at, reuse_count FROM jobs WHERE submitted_at >= ?"
+        params = [since]
+        if web_app_id:
+            sql += " AND web_app_id = ?"
+            params.append(web_app_id)
+        rows = self._conn().execute(sql, params).fetchall()
+        
+        def summarize(items):
+            statuses = {}
+            for row in items:
+                statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+            succeeded = [row for row in items if str(row["status"]).lower() in TASK_SUCCESS_STATUSES]
+            failed = sum(1 for row in items if str(row["status"]).lower() in ('failed', 'error', 'canceled', 'cancelled', 'lost', 'timeout'))
+            finished = len(succeeded) + failed
+            durations = sorted(row["finished_at"] - row["submitted_at"] for row in succeeded if row["finished_at"])
+            pick = lambda q: round(durations[min(int(q * len(durations)), len(durations) - 1)], 2) if durations else None
+            return {
+                "submitted": len(items),
+                "succeeded": len(succeeded),
+                "failed": failed,
+                "in_flight": len(items) - finished,
+                "failure_rate": round(failed / finished, 4) if finished else 0.0,
+                "throughput_per_hour": round(len(succeeded) / hours, 2) if hours else None,
+                "reused": sum(row["reuse_count"] for row in items),
+                "latency_p50": pick(0.5),
+                "latency_p95": pick(0.95),
+                "statuses": statuses,
+            }
+        
+        by_app = {}
+        for row in rows:
+            by_app.setdefault(row["web_app_id"], []).append(row)
+        return {
+            "window_hours": hours,
+            "total": summarize(rows),
+            "by_web_app": {str(app_id): summarize(items) for app_id, items in sorted(by_app.items(), key=lambda item: str(item[0]))},
+        }
+
+JOB_JOURNAL = JobJournal(JOURNAL_PATH)
+
+def wait_for_task(task_id, api_key, submitted_at=None, timeout=TASK_WAIT_TIMEOUT):
+    """轮询单个已提交的任务直到结束，超时抛出 TimeoutError"""
+    handle = {"task_id": task_id, "api_key": api_key, "submitted_at": submitted_at or time.time()}
+    result = poll_bizyair_tasks([handle], timeout=timeout)[0]
+    if result is None:
+        raise TimeoutError(f"任务 {task_id} 等待超时({timeout}秒)")
+    return result
+
+def resume_journal_job(job, async_submit=False):
+    """恢复日志中的任务：已完成则直接返回结果，未完成则继续轮询（异步提交时返回句柄状态）；无法恢复时返回None"""
+    if job["result"] and str(job["status"]).lower() in TASK_SUCCESS_STATUSES:
+        JOB_JOURNAL.mark_reused(job["id"])
+        print(f"♻️ 复用任务日志中已完成的任务: {job['task_id']}")
+        return json.loads(job["result"])
+    api_key = KEY_POOL.find_by_fingerprint(job["key_fingerprint"])
+    if not api_key:
+        return None
+    JOB_JOURNAL.mark_reused(job["id"])
+    print(f"♻️ 继续等待任务日志中未完成的任务: {job['task_id']} ({job['status']})")
+    if async_submit:
+        return {"request_id": job["task_id"], "status": job["status"]}
+    return wait_for_task(job["task_id"], api_key, job["submitted_at"])
+
+class JournalClaims:
+    """一次批量提交中已占用的日志记录：同一批内输入相同的多个任务各自提交或各自恢复，不合并成一个远程任务"""
+    
+    def __init__(self):
+        self.job_ids = set()
+        self.lock = threading.Lock()
 
-def get_bizyair_api_key():
-    """获取BizyAIR API密钥，支持多Key轮询"""
-    global CURRENT_KEY_INDEX
-    key_path = os.path.join(os.path.dirname(__file__), "key", "siliconflow_API_key.txt")
+def submit_with_journal(web_app_id, input_values, api_key, async_submit=False, force_refresh=False, claims=None):
+    """经过任务日志提交：相同输入有未完成或未交付的任务时复用它，避免重复提交；
+    批量提交时传入同一个 claims，每条日志记录只被批内的一个任务复用"""
+    if not JOURNAL_ENABLED:
+        return submit_bizyair_task(web_app_id, input_values, api_key, async_submit=async_submit)
+    
+    start_job_journal()
+    fingerprint = request_fingerprint(web_app_id, input_values, ignore_fields="")
+    if not force_refresh:
+        if claims is None:
+            job = JOB_JOURNAL.find_reusable(fingerprint)
+        else:
+            with claims.lock:
+                job = JOB_JOURNAL.find_reusable(fingerprint, exclude=claims.job_ids)
+                if job is not None:
+                    claims.job_ids.add(job["id"])
+        if job is not None:
+            result = resume_journal_job(job, async_submit)
+            if result is not None:
+                return result
+    
+    # 持久同步模式下先异步提交拿到任务ID，再在本地轮询
+    durable = JOURNAL_DURABLE_SYNC and not async_submit
+    job_id = JOB_JOURNAL.begin(fingerprint, web_app_id, api_key, async_submit or durable)
+    if claims is not None:
+        with claims.lock:
+            claims.job_ids.add(job_id)
     try:
-        if not os.path.exists(key_path):
-            return ""
-            
-        with open(key_path, "r", encoding="utf-8") as f:
-            # 读取所有行并过滤空行
-            keys = [line.strip() for line in f.readlines() if line.strip()]
-            
-        if not keys:
-            return ""
-            
-        # 轮询选择
-        if CURRENT_KEY_INDEX >= len(keys):
-            CURRENT_KEY_INDEX = 0
-            
-        selected_key = keys[CURRENT_KEY_INDEX]
-        
-        # 更新索引以供下次调用
-        CURRENT_KEY_INDEX = (CURRENT_KEY_INDEX + 1) % len(keys)
-        
-        # print(f"🔑 使用API Key [{CURRENT_KEY_INDEX}/{len(keys)}]: {selected_key[:8]}...")
-        return selected_key
+        result = submit_bizyair_task(web_app_id, input_values, api_key, async_submit=async_submit or durable)
     except Exception as e:
-        print(f"❌ 读取API Key失败: {e}")
-        return ""
+        JOB_JOURNAL.record_error(job_id, e)
+        raise
+    JOB_JOURNAL.record_result(job_id, result)
+    if durable and not is_task_terminal(result):
+        result = wait_for_task(result.get('request_id', ''), api_key)
+    return result
 
-def save_bizyair_api_key(new_key):
-    """保存新的API Key到文件，自动去重"""
-    if not new_key or not new_key.strip():
-        return
-        
-    key_path = os.path.join(os.path.dirname(__file__), "key", "siliconflow_API_key.txt")
+_journal_started = False
+_journal_start_lock = threading.Lock()
+
+def start_job_journal():
+    """启动任务日志的恢复：由插件加载（__init__.py）或第一次提交时调用，只执行一次；
+    单独导入本模块（压测脚本、替身服务器等）不会打开日志或启动轮询线程"""
+    global _journal_started
+    with _journal_start_lock:
+        if _journal_started:
+            return None
+        _journal_started = True
+    return resume_pending_jobs()
+
+def resume_pending_jobs():
+    """在后台继续轮询上次未结束的任务，结果写回日志，重新运行时即可复用"""
+    if not JOURNAL_ENABLED or not os.path.exists(JOURNAL_PATH):
+        return None
     try:
-        # 读取现有Keys
-        keys = []
-        if os.path.exists(key_path):
-            with open(key_path, "r", encoding="utf-8") as f:
-                keys = [line.strip() for line in f.readlines() if line.strip()]
-        
-        # 添加新Key（如果不存在）
-        clean_key = new_key.strip()
-        if clean_key not in keys:
-            keys.append(clean_key)
-            
-            # 写回文件
-            with open(key_path, "w", encoding="utf-8") as f:
-                for key in keys:
-                    f.write(f"{key}\n")
-            print(f"✅ 新API Key已保存到: {key_path}")
-            
-    except Exception as e:
-        print(f"❌ 保存API Key失败: {e}")
+        JOB_JOURNAL.mark_lost_submissions()
+        handles = []
+        for job in JOB_JOURNAL.pending_jobs():
+            api_key = KEY_POOL.find_by_fingerprint(job["key_fingerprint"])
+            if api_key:
+                handles.append({"task_id": job["task_id"], "api_key": api_key, "submitted_at": job["submitted_at"]})
+    except sqlite3.Error as e:
+        print(f"⚠️ 读取任务日志失败: {e}")
+        return None
+    if not handles:
+        return None
+    print(f"♻️ 任务日志中有 {len(handles)} 个未结束的任务，后台继续轮询")
+    thread = threading.Thread(target=poll_bizyair_tasks, args=(handles, TASK_WAIT_TIMEOUT), daemon=True, name="bizyair-resume")
+    thread.start()
+    return thread
 
-def image_to_base64(image_tensor):
-    """将图像张量转换为base64字符串"""
-    # 确保图像张量是正确的格式 [batch, height, width, channels]
-    if len(image_tensor.shape) == 4:
-        image_tensor = image_tensor[0]  # 取第一张图
+def _register_journal_routes():
+    """在ComfyUI服务器上注册 /bizyair/jobs（最近记录）和 /bizyair/jobs/report（吞吐与失败率）"""
+    try:
+        from server import PromptServer
+        from aiohttp import web
+    except ImportError:
+        return
+    if getattr(PromptServer, "instance", None) is None:
+        return
     
-    # 转换为numpy数组并确保数据类型正确
-    if image_tensor.dtype != torch.uint8:
-        image_tensor = (image_tensor * 255).clamp(0, 255).to(torch.uint8)
+    @PromptServer.instance.routes.get("/bizyair/jobs")
+    async def bizyair_jobs(request):
+        query = request.rel_url.query
+        jobs = JOB_JOURNAL.query(query.get("status"), int(query.get("web_app_id", 0)) or None, int(query.get("limit", 50)))
+        return web.json_response(jobs)
     
-    image_np = image_tensor.cpu().numpy()
+    @PromptServer.instance.routes.get("/bizyair/jobs/report")
+    async def bizyair_jobs_report(request):
+        query = request.rel_url.query
+        return web.json_response(JOB_JOURNAL.report(float(query.get("hours", 24)), int(query.get("web_app_id", 0)) or None))
+
+_register_journal_routes()
+
+# 批量输入：BA_LoadImage 批量模式输出的值以此前缀开头，后接JSON数组
+BATCH_VALUE_PREFIX = "bizyair-batch:"
+TASK_CONCURRENCY = _env_int("BIZYAIR_TASK_CONCURRENCY", 4)
+
+def format_batch_value(values):
+    """把多个输入值编码为一个批量值字符串"""
+    return BATCH_VALUE_PREFIX + json.dumps(list(values), ensure_ascii=False)
+
+def expand_batch_inputs(input_values):
+    """把含批量值的 input_values 展开为逐任务的列表，非批量值广播到每个任务"""
+    batches = {}
+    for node_name, value in input_values.items():
+        if isinstance(value, str) and value.startswith(BATCH_VALUE_PREFIX):
+            batches[node_name] = json.loads(value[len(BATCH_VALUE_PREFIX):])
+    if not batches:
+        return [input_values]
     
-    # 转换为PIL图像
-    pil_image = Image.fromarray(image_np)
+    sizes = {len(items) for items in batches.values()} - {1}
+    if len(sizes) > 1:
+        raise ValueError(f"批量输入的长度不一致: { {name: len(items) for name, items in batches.items()} }")
+    batch_size = sizes.pop() if sizes else 1
     
-    # 转换为base64
-    buffer = BytesIO()
-    pil_image.save(buffer, format='WebP')
-    img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    expanded = []
+    for i in range(batch_size):
+        values = dict(input_values)
+        for node_name, items in batches.items():
+            values[node_name] = items[i] if len(items) > 1 else items[0]
+        expanded.append(values)
+    return expanded
+
+def run_bizyair_task(web_app_id, input_values, api_key, async_submit=False, use_result_cache=False,
+                     cache_ttl_hours=RESULT_CACHE_TTL_HOURS, cache_ignore_fields=RESULT_CACHE_IGNORE_FIELDS, force_refresh=False,
+                     journal_claims=None):
+    """提交单个任务（可选经过结果缓存），返回API响应字典；force_refresh 时重新提交并覆盖缓存结果"""
+    submit = lambda: submit_with_journal(web_app_id, input_values, api_key, async_submit, force_refresh, journal_claims)
+    if not use_result_cache:
+        return submit()
     
-    return f"data:image/webp;base64,{img_base64}"
+    fingerprint = request_fingerprint(web_app_id, input_values, cache_ignore_fields)
+    if not force_refresh:
+        with metrics_span("result_cache") as span:
+            result = RESULT_CACHE.get(fingerprint, cache_ttl_hours)
+            span["cache_hit"] = result is not None
+        if result is not None and not cached_outputs_available(result):
+            print(f"⚠️ 缓存结果的输出URL已失效，丢弃缓存并重新提交: {fingerprint[:12]}")
+            RESULT_CACHE.discard(fingerprint)
+            result = None
+        if result is not None:
+            print(f"📋 命中结果缓存: {fingerprint[:12]}")
+            return result
+    if async_submit:
+        # 异步提交的结果尚未完成，不写入缓存
+        return submit()
+    return RESULT_CACHE.get_or_submit(fingerprint, submit, cache_ttl_hours, refresh=force_refresh)
 
-def url_to_tensor(image_url):
-    """将URL图像转换为ComfyUI张量格式"""
-    try:
-        # print(f"🌐 开始下载图像: {image_url}")
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
-        
-        # 从响应中获取图像数据
-        image_data = response.content
-        # print(f"💾 图像数据下载成功，大小: {len(image_data)} 字节")
-        
-        # 使用PIL打开图像
-        image = Image.open(BytesIO(image_data))
-        print(f"🖼️ PIL图像加载成功，格式: {image.mode}, 尺寸: {image.size}")
-        
-        # 确保图像是RGB格式
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-            # print(f"🎨 图像已转换为RGB格式")
-        
-        # 转换为numpy数组
-        image_np = np.array(image).astype(np.float32) / 255.0
-        
-        # 转换为torch张量并添加batch维度
-        image_tensor = torch.from_numpy(image_np)[None,]  # [1, H, W, C]
-        
-        # print(f"✅ 图像转换为张量成功，形状: {image_tensor.shape}, 数据类型: {image_tensor.dtype}")
-        return image_tensor
-    except Exception as e:
-        print(f"❌ 加载图像失败: {e}")
-        # 返回一个默认的64x64空白图像
-        empty_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32)
-        print(f"🖼️ 返回默认空白图像: {empty_image.shape}")
-        return empty_image
+def run_bizyair_tasks(web_app_id, input_values_list, api_key=None, max_concurrency=None, **task_options):
+    """并发提交多个任务，按输入顺序返回 [(api_key, 结果或异常)]；未指定api_key时每个任务从Key池中选取"""
+    max_concurrency = max(1, min(max_concurrency or TASK_CONCURRENCY, len(input_values_list)))
+    # 批内输入相同的任务（例如重复的扫描变体）各自对应一个远程任务
+    claims = JournalClaims()
+    
+    def _run(input_values):
+        task_key = api_key or get_bizyair_api_key()
+        try:
+            return task_key, run_bizyair_task(web_app_id, input_values, task_key, journal_claims=claims, **task_options)
+        except Exception as e:
+            print(f"❌ BizyAIR任务提交失败: {e}")
+            return task_key, e
+    
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="bizyair-task") as executor:
+        return map_in_context(executor, _run, input_values_list)
 
-def url_to_latent(latent_url):
-    """将URL Latent文件转换为ComfyUI Latent格式"""
-    try:
-        # print(f"🌐 开始下载Latent: {latent_url}")
-        response = requests.get(latent_url, timeout=60)
-        response.raise_for_status()
-        
-        latent_data = BytesIO(response.content)
-        # ComfyUI .latent files are torch serialized dicts
-        latent = torch.load(latent_data, map_location="cpu")
-        print(f"✅ Latent加载成功: {latent.get('samples', torch.tensor([])).shape}")
-        return latent
-    except Exception as e:
-        print(f"❌ 加载Latent失败: {e}")
-        return {"samples": torch.zeros((1, 4, 8, 8), dtype=torch.float32)}
+def make_task_handle(result, web_app_id, api_key):
+    """构造 BIZYAIR_TASK 任务句柄；已结束的任务携带结果，BA_Await 无需再轮询"""
+    return {
+        "task_id": result.get('request_id', ''),
+        "web_app_id": web_app_id,
+        "api_key": api_key,
+        "submitted_at": time.time(),
+        "result": result if is_task_terminal(result) else None,
+    }
+
+def collect_batch_outputs(results, download_concurrency=None, output_timeout=None, return_latent=False, return_text=False,
+                          output_dtype=None, pin_memory=None):
+    """按任务顺序合并多个任务的输出，返回与 collect_task_outputs 相同结构的元组"""
+    responses = []
+    task_ids = []
+    image_urls = []
+    latent_urls = []
+    text_urls = []
+    for result in results:
+        if isinstance(result, Exception):
+            responses.append({"error": str(result), "message": "API调用过程中发生错误"})
+            continue
+        report_task_failure(result)
+        responses.append(result)
+        task_ids.append(result.get('request_id', ''))
+        task_images, task_latents, task_texts = split_task_outputs(result)
+        image_urls.extend(task_images)
+        latent_urls.extend(task_latents)
+        text_urls.extend(task_texts)
+    
+    # 所有任务的输出一起并发下载，按任务顺序合并
+    final_image, latent, text, text_json = download_task_outputs(
+        image_urls, latent_urls, text_urls, return_latent, return_text, download_concurrency, output_timeout,
+        output_dtype, pin_memory)
+    if JOURNAL_ENABLED:
+        JOB_JOURNAL.mark_delivered([r.get('request_id', '') for r in results if isinstance(r, dict) and is_task_terminal(r)])
+    
+    return (json.dumps(responses, ensure_ascii=False, indent=2), "\n".join(task_ids), "\n".join(image_urls),
+            final_image, "\n".join(latent_urls), "\n".join(text_urls), latent, text, text_json)
 
 class BA_BizyAIR_Main:
     """BizyAIR主界面API调用节点"""
@@ -257,150 +3881,98 @@ class BA_BizyAIR_Main:
                 "input_7": ("STRING", {"default": ""}),
                 "input_8": ("STRING", {"default": ""}),
                 "input_9": ("STRING", {"default": ""}),
+                "download_concurrency": ("INT", {"default": DOWNLOAD_CONCURRENCY, "min": 1, "max": 32}),
+                "output_timeout": ("INT", {"default": DOWNLOAD_OUTPUT_TIMEOUT, "min": 5, "max": 600}),
+                "submit_only": ("BOOLEAN", {"default": False}),
+                "use_result_cache": ("BOOLEAN", {"default": False}),
+                "cache_ttl_hours": ("FLOAT", {"default": RESULT_CACHE_TTL_HOURS, "min": 0.0, "max": 8760.0, "step": 1.0}),
+                "cache_ignore_fields": ("STRING", {"default": RESULT_CACHE_IGNORE_FIELDS, "multiline": False}),
+                "max_concurrent_tasks": ("INT", {"default": TASK_CONCURRENCY, "min": 1, "max": 32}),
+                "return_latent": ("BOOLEAN", {"default": False}),
+                "return_text": ("BOOLEAN", {"default": False}),
+                "output_dtype": (OUTPUT_DTYPE_CHOICES, {"default": OUTPUT_DTYPE}),
+                "pin_memory": ("BOOLEAN", {"default": OUTPUT_PIN_MEMORY}),
+                "force_refresh": ("BOOLEAN", {"default": False}),
+                "validate_inputs": ("BOOLEAN", {"default": VALIDATE_INPUTS}),
             }
         }
     
-    RETURN_TYPES = ("STRING", "STRING", "STRING", "IMAGE", "STRING", "STRING")
-    RETURN_NAMES = ("response_json", "task_id", "image_url", "image", "latent_url", "txt_url")
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "IMAGE", "STRING", "STRING", "BIZYAIR_TASK", "STRING", "LATENT", "STRING", "STRING")
+    RETURN_NAMES = ("response_json", "task_id", "image_url", "image", "latent_url", "txt_url", "task_handle", "metrics_json", "latent", "text", "text_json")
     FUNCTION = "process_api_call"
     CATEGORY = "🇨🇳BOZO/BizyAir"
     
-    def process_api_call(self, web_app_id, api_key="", **kwargs):
+    @classmethod
+    def IS_CHANGED(cls, web_app_id=None, force_refresh=False, **kwargs):
+        """输入值规范化后的哈希；force_refresh 时返回NaN，每次都重新执行"""
+        if force_refresh:
+            return float("nan")
+        input_values = parse_input_values(kwargs.pop(f"input_{i}", "") or "" for i in range(1, 10))
+        options = {k: v for k, v in kwargs.items() if k != "api_key"}
+        return f"{request_fingerprint(web_app_id, input_values, ignore_fields='')}:{fingerprint_inputs(**options)}"
+    
+    @with_metrics_output
+    def process_api_call(self, web_app_id, api_key="", download_concurrency=None, output_timeout=None, submit_only=False,
+                         use_result_cache=False, cache_ttl_hours=RESULT_CACHE_TTL_HOURS, cache_ignore_fields=RESULT_CACHE_IGNORE_FIELDS,
+                         max_concurrent_tasks=TASK_CONCURRENCY, return_latent=False, return_text=False, force_refresh=False,
+                         output_dtype=None, pin_memory=None, validate_inputs=VALIDATE_INPUTS, **kwargs):
         # 获取API密钥
-        if api_key and api_key.strip():
+        explicit_key = bool(api_key and api_key.strip())
+        if explicit_key:
             # 如果提供了Key，尝试保存
-            save_bizyair_api_key(api_key.strip())
+            api_key = api_key.strip()
+            save_bizyair_api_key(api_key)
         else:
             # 否则从文件获取
             api_key = get_bizyair_api_key()
         
         if not api_key:
             print("错误: 未找到API密钥")
-            return ("{}", "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "")
+            return ("{}", "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", None, empty_latent(), "", "")
         
         # 构建请求数据
-        input_values = {}
-        for i in range(1, 10):
-            input_key = f"input_{i}"
-            if input_key in kwargs and kwargs[input_key].strip():
-                # 分析输入格式，例如: "91:LoadImage.image|https://example.com/image.jpg"
-                input_data = kwargs[input_key].strip()
-                if '|' in input_data:
-                    node_name, value = input_data.split('|', 1)
-                    input_values[node_name] = value
-        
-        # API请求配置
-        url = "https://api.bizyair.cn/w/v1/webapp/task/openapi/create"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
+        input_values = parse_input_values(kwargs.get(f"input_{i}", "") for i in range(1, 10))
+        task_options = {
+            "async_submit": submit_only,
+            "use_result_cache": use_result_cache,
+            "cache_ttl_hours": cache_ttl_hours,
+            "cache_ignore_fields": cache_ignore_fields,
+            "force_refresh": force_refresh,
         }
-        
-        data = {
-            "web_app_id": web_app_id,
-            "suppress_preview_output": True,
-            "input_values": input_values
+        output_options = {
+            "download_concurrency": download_concurrency,
+            "output_timeout": output_timeout,
+            "return_latent": return_latent,
+            "return_text": return_text,
+            "output_dtype": output_dtype,
+            "pin_memory": pin_memory,
         }
         
         try:
-            # 发送请求
-            # print(f"BizyAIR请求数据: {json.dumps(data, indent=2, ensure_ascii=False)}")
-            
-            response = requests.post(url, headers=headers, json=data, timeout=300)
-            response.raise_for_status()
+            batch_inputs = expand_batch_inputs(input_values)
+            if validate_inputs:
+                # 按Web应用的输入模式本地校验，不合格的输入不提交、不消耗额度
+                validate_task_inputs(web_app_id, batch_inputs, api_key)
+            if len(batch_inputs) > 1:
+                # 未显式填写Key时，批量任务各自从Key池中选取
+                batch_key = api_key if explicit_key else None
+                return self._process_batch(web_app_id, batch_inputs, batch_key, max_concurrent_tasks, task_options, output_options)
             
-            result = response.json()
+            # 发送请求
+            result = run_bizyair_task(web_app_id, input_values, api_key, **task_options)
             print(f"📊 BizyAIR响应状态: {result.get('status', 'Unknown')}")
             print(f"📋 响应数据摘要: 包含 {len(result.get('outputs', []))} 个输出")
             
-            # 检查执行状态和错误处理
-            if result.get('status') == 'Failed':
-                print("=== BizyAIR执行失败 ===")
-                if 'outputs' in result and len(result['outputs']) > 0:
-                    error_info = result['outputs'][0]
-                    error_type = error_info.get('error_type', 'Unknown')
-                    error_msg = error_info.get('error_msg', 'No error message')
-                    
-                    print(f"错误类型: {error_type}")
-                    print(f"错误信息: {error_msg}")
-                    
-                    # 解析具体的ComfyUI错误
-                    if 'exception_message' in error_msg:
-                        if 'size of tensor' in error_msg and 'must match' in error_msg:
-                            print("⚠️  张量维度不匹配错误 - 这通常是由以下原因造成的:")
-                            print("   1. 输入图像尺寸与模型期望不匹配")
-                            print("   2. 工作流中的节点参数配置错误")
-                            print("   3. 模型和采样器不兼容")
-                            print("   4. 建议检查图像尺寸和工作流配置")
-                    
-                    # 提供解决建议
-                    if 'SamplerCustomAdvanced' in error_msg:
-                        print("💡 建议解决方案:")
-                        print("   - 确保输入图像尺寸为标准比例 (如 1024x1024, 512x768 等)")
-                        print("   - 检查采样器设置与模型兼容性")
-                        print("   - 尝试使用不同的采样器或调整参数")
-            
-            # 提取结果 - 返回完整的API响应数据
-            response_json = json.dumps(result, ensure_ascii=False, indent=2)
-            task_id = result.get('request_id', '')
-            print(f"任务 ID：{task_id}")
-            
-            # 初始化结果容器
-            all_image_urls = []
-            image_tensors = []
-            latent_urls = []
-            text_urls = []
-            
-            status = result.get('status', '').lower()
-            if status in ['completed', 'success'] and 'outputs' in result:
-                for output in result['outputs']:
-                    obj_url = output.get('object_url', '')
-                    ext = output.get('output_ext', '').lower()
-                    
-                    if not obj_url:
-                        continue
-                        
-                    if ext in ['.png', '.jpg', '.jpeg', '.webp', '.bmp']:
-                        all_image_urls.append(obj_url)
-                        # 下载图像
-                        try:
-                            tensor = url_to_tensor(obj_url)
-                            image_tensors.append(tensor)
-                        except Exception as e:
-                            print(f"❌ 下载图像失败 {obj_url}: {e}")
-                            
-                    elif ext in ['.latent']:
-                        latent_urls.append(obj_url)
-                            
-                    elif ext in ['.txt', '.text', '.json', '.md']:
-                        text_urls.append(obj_url)
-
-            # 处理图像合并
-            if image_tensors:
-                # 检查尺寸一致性
-                first_shape = image_tensors[0].shape
-                valid_tensors = [t for t in image_tensors if t.shape == first_shape]
-                if len(valid_tensors) < len(image_tensors):
-                     print(f"⚠️ 警告: 忽略了 {len(image_tensors) - len(valid_tensors)} 张尺寸不匹配的图像")
-                
-                if valid_tensors:
-                    final_image = torch.cat(valid_tensors, dim=0)
-                    print(f"✅ 合并了 {len(valid_tensors)} 张图像，最终形状: {final_image.shape}")
-                else:
-                    final_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32)
-            else:
-                final_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32)
-            
-            # 处理Latent URL合并
-            final_latent_url = "\n".join(latent_urls)
-            
-            # 处理文本URL合并
-            final_text_url = "\n".join(text_urls)
+            task_handle = make_task_handle(result, web_app_id, api_key)
             
-            # 处理图片URL合并
-            final_image_url_str = "\n".join(all_image_urls)
+            if submit_only and not is_task_terminal(result):
+                # 仅提交模式：立即返回任务句柄，由 BA_Await 节点收集结果
+                print(f"🚀 任务已提交: {task_handle['task_id']}")
+                response_json = json.dumps(result, ensure_ascii=False, indent=2)
+                return (response_json, task_handle['task_id'], "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", task_handle, empty_latent(), "", "")
             
-            return (response_json, task_id, final_image_url_str, final_image, final_latent_url, final_text_url)
+            outputs = collect_task_outputs(result, **output_options)
+            return outputs[:6] + (task_handle,) + outputs[6:]
             
         except Exception as e:
             print(f"BizyAIR API调用失败: {e}")
@@ -408,7 +3980,30 @@ class BA_BizyAIR_Main:
                 "error": str(e),
                 "message": "API调用过程中发生错误"
             }
-            return (json.dumps(error_response, ensure_ascii=False, indent=2), "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "")
+            if isinstance(e, InputValidationError):
+                error_response["message"] = "输入不符合Web应用的输入模式，任务未提交"
+                error_response["validation_errors"] = e.errors
+            return (json.dumps(error_response, ensure_ascii=False, indent=2), "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", None, empty_latent(), "", "")
+    
+    def _process_batch(self, web_app_id, batch_inputs, api_key, max_concurrent_tasks, task_options, output_options):
+        """批量模式：每个批次元素提交一个任务，并发执行后按批次顺序合并输出"""
+        print(f"📦 批量模式: {len(batch_inputs)} 个任务，最大并发 {max_concurrent_tasks}")
+        task_results = run_bizyair_tasks(web_app_id, batch_inputs, api_key, max_concurrent_tasks, **task_options)
+        results = [result for _, result in task_results]
+        handles = [make_task_handle(result, web_app_id, key) for key, result in task_results if not isinstance(result, Exception)]
+        
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        if failed:
+            print(f"⚠️ {failed}/{len(results)} 个批量任务提交失败")
+        
+        if task_options.get("async_submit"):
+            print(f"🚀 已提交 {len(handles)} 个任务")
+            response_json = json.dumps([r if not isinstance(r, Exception) else {"error": str(r)} for r in results], ensure_ascii=False, indent=2)
+            task_ids = "\n".join(handle['task_id'] for handle in handles)
+            return (response_json, task_ids, "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", handles, empty_latent(), "", "")
+        
+        outputs = collect_batch_outputs(results, **output_options)
+        return outputs[:6] + (handles,) + outputs[6:]
 
 class BA_LoadImage:
     """BizyAIR图像输入节点"""
@@ -423,17 +4018,57 @@ class BA_LoadImage:
             "optional": {
                 "image": ("IMAGE",),
                 "image_url": ("STRING", {"default": "", "multiline": False}),
+                "encoder": (list(IMAGE_ENCODERS.keys()), {"default": "WEBP"}),
+                "encode_quality": ("INT", {"default": DEFAULT_ENCODE_QUALITY, "min": 0, "max": 100}),
+                "webp_method": ("INT", {"default": DEFAULT_WEBP_METHOD, "min": 0, "max": 6}),
+                "batch_mode": ("BOOLEAN", {"default": False}),
+                "upload_image": ("BOOLEAN", {"default": False}),
+                "force_refresh": ("BOOLEAN", {"default": False}),
+                "web_app_id": ("INT", {"default": 0, "min": 0, "max": 999999}),
+                "auto_resize": ("BOOLEAN", {"default": False}),
             }
         }
     
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("formatted_input",)
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("formatted_input", "metrics_json")
     FUNCTION = "format_image_input"
     CATEGORY = "🇨🇳BOZO/BizyAir"
     
-    def format_image_input(self, node_name, use_url=False, image=None, image_url=""):
+    @classmethod
+    def IS_CHANGED(cls, use_url=False, image_url="", force_refresh=False, **kwargs):
+        """URL模式使用 URL + ETag 指纹，远程图像变化时才重新执行；图像输入使用抽样张量指纹"""
+        if force_refresh:
+            return float("nan")
+        urls = url_fingerprints((image_url or "").split()) if use_url else []
+        return fingerprint_inputs(use_url=use_url, urls=urls, **kwargs)
+    
+    @with_metrics_output
+    def format_image_input(self, node_name, use_url=False, image=None, image_url="",
+                           encoder="WEBP", encode_quality=DEFAULT_ENCODE_QUALITY, webp_method=DEFAULT_WEBP_METHOD, batch_mode=False,
+                           upload_image=False, force_refresh=False, web_app_id=0, auto_resize=False):
         try:
-            if use_url and image_url.strip():
+            if auto_resize and web_app_id and image is not None and not use_url:
+                # 编码前按目标Web应用的输入模式缩放，上传的数据量与模型实际使用的尺寸一致
+                image = fit_image_to_schema(web_app_id, node_name, image)
+            if force_refresh and use_url:
+                # 强制刷新：丢弃本地下载缓存，重新下载
+                for url in image_url.split():
+                    DOWNLOAD_STORE.discard(url)
+            if batch_mode and use_url and len(image_url.split()) > 1:
+                # 批量URL模式：空格或换行分隔的多个URL，每个URL对应一个任务
+                urls = image_url.split()
+                for url in urls:
+                    download_and_cache_image(url)
+                formatted = f"{node_name}|{format_batch_value(urls)}"
+                print(f"📦 批量URL模式: {len(urls)} 张图像")
+            elif batch_mode and not use_url and image is not None and len(image.shape) == 4 and image.shape[0] > 1:
+                # 批量模式：批次中的每张图像并行编码，BA_BizyAIR_Main 会为每张图像提交一个任务
+                base64_list = images_to_base64(image, encoder, encode_quality, webp_method)
+                if upload_image:
+                    base64_list = self._upload_or_inline(base64_list)
+                formatted = f"{node_name}|{format_batch_value(base64_list)}"
+                print(f"📦 批量模式: {len(base64_list)} 张图像")
+            elif use_url and image_url.strip():
                 # 使用URL模式，先下载到本地缓存，再转换为WebP base64
                 print(f"🌐 URL模式：处理图像URL: {image_url.strip()}")
                 
@@ -456,7 +4091,10 @@ class BA_LoadImage:
                     
             elif not use_url and image is not None:
                 # 使用base64模式，需要检测image输入
-                base64_data = image_to_base64(image)
+                base64_data = image_to_base64(image, encoder, encode_quality, webp_method)
+                if upload_image:
+                    # 上传模式：请求中只传URL，相同图像只上传一次
+                    base64_data = self._upload_or_inline([base64_data])[0]
                 formatted = f"{node_name}|{base64_data}"
                 # print(f"✅ 图像输入格式化完成(使用Base64): {node_name}")
             elif use_url and not image_url.strip():
@@ -476,6 +4114,14 @@ class BA_LoadImage:
         except Exception as e:
             print(f"❌ 图像格式化失败: {e}")
             return (f"{node_name}|",)
+    
+    def _upload_or_inline(self, data_uris):
+        """上传图像并返回URL列表，上传失败时退回内联base64"""
+        try:
+            return upload_data_uris(data_uris)
+        except Exception as e:
+            print(f"⚠️ 图像上传失败，改用base64内联: {e}")
+            return data_uris
 
 class BA_Float_Value:
     """BizyAIR数值输入节点"""
@@ -495,6 +4141,10 @@ class BA_Float_Value:
     FUNCTION = "format_value_input"
     CATEGORY = "🇨🇳BOZO/BizyAir"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return fingerprint_inputs(**kwargs)
+    
     def format_value_input(self, value, node_name, use_float=False):
         try:
             if use_float:
@@ -529,6 +4179,10 @@ class BA_String_Value:
     FUNCTION = "format_string_input"
     CATEGORY = "🇨🇳BOZO/BizyAir"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return fingerprint_inputs(**kwargs)
+    
     def format_string_input(self, text, node_name):
         try:
             formatted = f"{node_name}|{text}"
@@ -538,6 +4192,93 @@ class BA_String_Value:
             print(f"字符串格式化失败: {e}")
             return (f"{node_name}|",)
 
+# 调整图像尺寸 - PIL版本兼容性处理
+# 使用数值常量避免版本兼容性问题
+PIL_RESAMPLE_MAP = {
+    "LANCZOS": 1,  # Image.LANCZOS 或 Image.Resampling.LANCZOS
+    "BILINEAR": 2,  # Image.BILINEAR 或 Image.Resampling.BILINEAR
+    "BICUBIC": 3,  # Image.BICUBIC 或 Image.Resampling.BICUBIC
+    "NEAREST": 0,  # Image.NEAREST 或 Image.Resampling.NEAREST
+    "AREA": 4  # Image.BOX 或 Image.Resampling.BOX
+}
+
+def compute_resize_dimensions(original_width, original_height, width, height, maintain_aspect_ratio=True):
+    """计算调整后的尺寸：保持宽高比时适配目标框并对齐到64的倍数"""
+    if not maintain_aspect_ratio:
+        return width, height
+    
+    # 保持宽高比
+    aspect_ratio = original_width / original_height
+    if width / height > aspect_ratio:
+        # 以高度为准
+        new_width = int(height * aspect_ratio)
+        new_height = height
+    else:
+        # 以宽度为准
+        new_width = width
+        new_height = int(width / aspect_ratio)
+    
+    # 确保尺寸是64的倍数
+    new_width = (new_width // 64) * 64
+    new_height = (new_height // 64) * 64
+    
+    # 确保最小尺寸
+    new_width = max(new_width, 64)
+    new_height = max(new_height, 64)
+    return new_width, new_height
+
+# torch插值模式：(interpolate的mode, 是否抗锯齿)
+TORCH_RESAMPLE_MAP = {
+    "BILINEAR": ("bilinear", True),
+    "BICUBIC": ("bicubic", True),
+    "AREA": ("area", False),
+    "NEAREST": ("nearest-exact", False),
+}
+
+def pil_resize_batch(images, new_width, new_height, resample_method="LANCZOS"):
+    """PIL逐张调整尺寸（精确模式，LANCZOS只能走此路径）"""
+    resized_tensors = []
+    for image_tensor in images:
+        # 转换为numpy数组
+        if image_tensor.dtype != torch.uint8:
+            image_np = (image_tensor * 255).clamp(0, 255).to(torch.uint8).cpu().numpy()
+        else:
+            image_np = image_tensor.cpu().numpy()
+        
+        # 转换为PIL图像
+        pil_image = Image.fromarray(image_np)
+        resized_image = pil_image.resize((new_width, new_height), PIL_RESAMPLE_MAP[resample_method])
+        
+        # 转换回张量格式
+        resized_np = np.array(resized_image).astype(np.float32) / 255.0
+        resized_tensors.append(torch.from_numpy(resized_np)[None,])  # [1, H, W, C]
+    return torch.cat(resized_tensors, dim=0)
+
+def torch_resize_batch(images, new_width, new_height, resample_method="BICUBIC"):
+    """整批 [B, H, W, C] 张量一次调整尺寸，不经过uint8/PIL转换"""
+    mode, antialias = TORCH_RESAMPLE_MAP[resample_method]
+    if images.dtype == torch.uint8:
+        images = images.float() / 255.0
+    elif images.dtype != torch.float32:
+        # float16等输入：CPU上的抗锯齿插值不支持半精度，并且所有插值方式统一输出float32
+        images = images.float()
+    # [B, H, W, C] -> [B, C, H, W] 视图
+    x = images.movedim(-1, 1)
+    if mode in ("bilinear", "bicubic"):
+        resized = F.interpolate(x, size=(new_height, new_width), mode=mode, align_corners=False, antialias=antialias)
+    else:
+        resized = F.interpolate(x, size=(new_height, new_width), mode=mode)
+    if mode == "bicubic":
+        # 双三次插值会有轻微过冲
+        resized = resized.clamp_(0.0, 1.0)
+    return resized.movedim(1, -1).contiguous()
+
+def resize_image_batch(images, new_width, new_height, resample_method="LANCZOS", exact=False):
+    """选择调整尺寸后端：LANCZOS或精确模式用PIL，其余用torch批量插值"""
+    if exact or resample_method not in TORCH_RESAMPLE_MAP:
+        return pil_resize_batch(images, new_width, new_height, resample_method)
+    return torch_resize_batch(images, new_width, new_height, resample_method)
+
 class BA_Image_Resizer:
     """BizyAIR图像尺寸调整节点 - 用于解决张量维度不匹配问题"""
     
@@ -550,8 +4291,9 @@ class BA_Image_Resizer:
                 "height": ("INT", {"default": 1536, "min": 64, "max": 4096, "step": 64}),
             },
             "optional": {
-                "resample_method": (["LANCZOS", "BILINEAR", "BICUBIC", "NEAREST"], {"default": "LANCZOS"}),
+                "resample_method": (["LANCZOS", "BILINEAR", "BICUBIC", "AREA", "NEAREST"], {"default": "LANCZOS"}),
                 "maintain_aspect_ratio": ("BOOLEAN", {"default": True}),
+                "pil_exact": ("BOOLEAN", {"default": False}),
             }
         }
     
@@ -560,64 +4302,25 @@ class BA_Image_Resizer:
     FUNCTION = "resize_image"
     CATEGORY = "🇨🇳BOZO/PIC"
     
-    def resize_image(self, image, width, height, resample_method="LANCZOS", maintain_aspect_ratio=True):
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        return fingerprint_inputs(**kwargs)
+    
+    def resize_image(self, image, width, height, resample_method="LANCZOS", maintain_aspect_ratio=True, pil_exact=False):
         try:
             # 确保图像张量是正确的格式 [batch, height, width, channels]
-            if len(image.shape) == 4:
-                image_tensor = image[0]  # 取第一张图
-            else:
-                image_tensor = image
-            
-            # 转换为numpy数组
-            if image_tensor.dtype != torch.uint8:
-                image_np = (image_tensor * 255).clamp(0, 255).to(torch.uint8).cpu().numpy()
-            else:
-                image_np = image_tensor.cpu().numpy()
-            
-            # 转换为PIL图像
-            pil_image = Image.fromarray(image_np)
-            original_size = pil_image.size
-            
-            # 计算新尺寸
-            if maintain_aspect_ratio:
-                # 保持宽高比
-                aspect_ratio = original_size[0] / original_size[1]
-                if width / height > aspect_ratio:
-                    # 以高度为准
-                    new_width = int(height * aspect_ratio)
-                    new_height = height
-                else:
-                    # 以宽度为准
-                    new_width = width
-                    new_height = int(width / aspect_ratio)
-                
-                # 确保尺寸是64的倍数
-                new_width = (new_width // 64) * 64
-                new_height = (new_height // 64) * 64
-                
-                # 确保最小尺寸
-                new_width = max(new_width, 64)
-                new_height = max(new_height, 64)
-            else:
-                new_width = width
-                new_height = height
-            
-            # 调整图像尺寸 - PIL版本兼容性处理
-            # 使用数值常量避免版本兼容性问题
-            resample_map = {
-                "LANCZOS": 1,  # Image.LANCZOS 或 Image.Resampling.LANCZOS
-                "BILINEAR": 2,  # Image.BILINEAR 或 Image.Resampling.BILINEAR
-                "BICUBIC": 3,  # Image.BICUBIC 或 Image.Resampling.BICUBIC
-                "NEAREST": 0  # Image.NEAREST 或 Image.Resampling.NEAREST
-            }
+            if len(image.shape) == 3:
+                image = image[None,]
             
-            resized_image = pil_image.resize((new_width, new_height), resample_map[resample_method])
+            original_size = (image.shape[2], image.shape[1])
+            new_width, new_height = compute_resize_dimensions(original_size[0], original_size[1], width, height, maintain_aspect_ratio)
             
-            # 转换回张量格式
-            resized_np = np.array(resized_image).astype(np.float32) / 255.0
-            resized_tensor = torch.from_numpy(resized_np)[None,]  # [1, H, W, C]
+            # 整批调整尺寸：LANCZOS或pil_exact使用PIL，其余方法使用torch批量插值
+            resized_tensor = resize_image_batch(image, new_width, new_height, resample_method, exact=pil_exact)
             
             size_info = f"原始尺寸: {original_size[0]}x{original_size[1]} -> 调整后: {new_width}x{new_height}"
+            if image.shape[0] > 1:
+                size_info += f" (批次 {image.shape[0]} 张)"
             print(f"图像尺寸调整完成: {size_info}")
             
             return (resized_tensor, size_info)
@@ -637,33 +4340,37 @@ class BA_Task_Status_Checker:
             "required": {
                 "task_id": ("STRING", {"default": "", "multiline": False}),
                 "api_key": ("STRING", {"default": "", "multiline": False}),
+            },
+            "optional": {
+                "force_refresh": ("BOOLEAN", {"default": False}),
             }
         }
     
-    RETURN_TYPES = ("STRING", "STRING", "IMAGE")
-    RETURN_NAMES = ("status_info", "image_url", "image")
+    RETURN_TYPES = ("STRING", "STRING", "IMAGE", "STRING", "STRING")
+    RETURN_NAMES = ("status_info", "image_url", "image", "metrics_json", "text")
     FUNCTION = "check_task_status"
     CATEGORY = "🇨🇳BOZO/BizyAir"
     
-    def check_task_status(self, task_id, api_key=""):
+    @classmethod
+    def IS_CHANGED(cls, task_id="", force_refresh=False, **kwargs):
+        """任务已结束时状态不会再变，返回固定值以复用上次结果；未结束的任务每次都重新查询"""
+        task_id = (task_id or "").strip()
+        status = TERMINAL_TASK_STATUS.get(task_id)
+        if force_refresh or status is None:
+            return float("nan")
+        return f"{task_id}:{status}"
+    
+    @with_metrics_output
+    def check_task_status(self, task_id, api_key="", force_refresh=False):
         # 获取API密钥
         if not api_key.strip():
             api_key = get_bizyair_api_key()
         
         if not api_key or not task_id.strip():
-            return ("错误: 缺少API密钥或任务ID", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32))
-        
-        # 检查任务状态的API端点
-        url = f"https://api.bizyair.cn/w/v1/webapp/task/{task_id}"
-        headers = {
-            "Authorization": f"Bearer {api_key}"
-        }
+            return ("错误: 缺少API密钥或任务ID", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "")
         
         try:
-            response = requests.get(url, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = fetch_task_status(task_id.strip(), api_key)
             status = result.get('status', 'Unknown')
             
             status_info = f"任务状态: {status}\n"
@@ -685,8 +4392,326 @@ class BA_Task_Status_Checker:
                 if image_url:
                     image_tensor = url_to_tensor(image_url)
             
-            return (status_info, image_url, image_tensor)
+            # 文本输出走URL缓存，重复检查同一任务不会重新下载
+            _, _, text_urls = split_task_outputs(result)
+            text, _ = merge_text_outputs(text_urls, fetch_texts(text_urls))
+            
+            return (status_info, image_url, image_tensor, text)
             
         except Exception as e:
             error_info = f"检查任务状态失败: {str(e)}"
-            return (error_info, "", torch.zeros((1, 64, 64, 3), dtype=torch.float32))
+            return (error_info, "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "")
+
+class BA_Await:
+    """BizyAIR任务等待节点 - 收集仅提交模式的任务结果"""
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "timeout": ("INT", {"default": 600, "min": 10, "max": 7200}),
+                "poll_interval": ("FLOAT", {"default": POLL_INTERVAL_MIN, "min": 0.2, "max": 60.0, "step": 0.1}),
+            },
+            "optional": {
+                "task_1": ("BIZYAIR_TASK",),
+                "task_2": ("BIZYAIR_TASK",),
+                "task_3": ("BIZYAIR_TASK",),
+                "task_4": ("BIZYAIR_TASK",),
+                "download_concurrency": ("INT", {"default": DOWNLOAD_CONCURRENCY, "min": 1, "max": 32}),
+                "output_timeout": ("INT", {"default": DOWNLOAD_OUTPUT_TIMEOUT, "min": 5, "max": 600}),
+                "return_latent": ("BOOLEAN", {"default": False}),
+                "return_text": ("BOOLEAN", {"default": False}),
+                "output_dtype": (OUTPUT_DTYPE_CHOICES, {"default": OUTPUT_DTYPE}),
+                "pin_memory": ("BOOLEAN", {"default": OUTPUT_PIN_MEMORY}),
+            }
+        }
+    
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "IMAGE", "STRING", "STRING", "STRING", "LATENT", "STRING", "STRING")
+    RETURN_NAMES = ("response_json", "task_id", "image_url", "image", "latent_url", "txt_url", "metrics_json", "latent", "text", "text_json")
+    FUNCTION = "await_tasks"
+    CATEGORY = "🇨🇳BOZO/BizyAir"
+    
+    @with_metrics_output
+    def await_tasks(self, timeout=600, poll_interval=1.0, download_concurrency=None, output_timeout=None, return_latent=False,
+                    return_text=False, output_dtype=None, pin_memory=None, **kwargs):
+        handles = []
+        for i in range(1, 5):
+            task = kwargs.get(f"task_{i}")
+            # 批量模式的主节点输出句柄列表
+            for handle in (task if isinstance(task, list) else [task]):
+                if handle and handle.get('task_id'):
+                    handles.append(handle)
+        if not handles:
+            print("❌ 错误: 未提供任何任务句柄")
+            return ("[]", "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", empty_latent(), "", "")
+        
+        try:
+            results = poll_bizyair_tasks(handles, timeout=timeout, poll_interval=poll_interval)
+            results = [
+                result if result is not None else {"request_id": handle['task_id'], "status": "Timeout"}
+                for handle, result in zip(handles, results)
+            ]
+            return collect_batch_outputs(results, download_concurrency, output_timeout, return_latent, return_text,
+                                         output_dtype, pin_memory)
+            
+        except Exception as e:
+            print(f"BizyAIR任务等待失败: {e}")
+            error_response = {
+                "error": str(e),
+                "message": "等待任务结果过程中发生错误"
+            }
+            return (json.dumps(error_response, ensure_ascii=False, indent=2), "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", empty_latent(), "", "")
+
+def parse_task_ids(text):
+    """解析任务ID列表（换行、逗号或空格分隔），去重并保持顺序"""
+    return list(dict.fromkeys(part for part in re.split(r"[\s,;]+", text or "") if part))
+
+class BA_Batch_Status_Checker:
+    """BizyAIR批量任务状态检查节点 - 一个轮询调度器等待多个任务，全部结束后并发下载输出"""
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "task_ids": ("STRING", {"default": "", "multiline": True}),
+                "api_key": ("STRING", {"default": "", "multiline": False}),
+                "timeout": ("INT", {"default": 600, "min": 10, "max": 7200}),
+                "poll_interval": ("FLOAT", {"default": POLL_INTERVAL_MIN, "min": 0.2, "max": 60.0, "step": 0.1}),
+            },
+            "optional": {
+                "download_concurrency": ("INT", {"default": DOWNLOAD_CONCURRENCY, "min": 1, "max": 32}),
+                "output_timeout": ("INT", {"default": DOWNLOAD_OUTPUT_TIMEOUT, "min": 5, "max": 600}),
+                "return_latent": ("BOOLEAN", {"default": False}),
+                "return_text": ("BOOLEAN", {"default": False}),
+                "output_dtype": (OUTPUT_DTYPE_CHOICES, {"default": OUTPUT_DTYPE}),
+                "pin_memory": ("BOOLEAN", {"default": OUTPUT_PIN_MEMORY}),
+            }
+        }
+    
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "IMAGE", "STRING", "STRING", "STRING", "LATENT", "STRING", "STRING")
+    RETURN_NAMES = ("response_json", "task_id", "image_url", "image", "latent_url", "txt_url", "metrics_json", "latent", "text", "text_json")
+    FUNCTION = "check_tasks"
+    CATEGORY = "🇨🇳BOZO/BizyAir"
+    
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # 任务状态在远端变化，每次都重新检查
+        return float("nan")
+    
+    @with_metrics_output
+    def check_tasks(self, task_ids, api_key="", timeout=600, poll_interval=1.0, download_concurrency=None,
+                    output_timeout=None, return_latent=False, return_text=False, output_dtype=None, pin_memory=None):
+        empty_outputs = ("[]", "", "", torch.zeros((1, 64, 64, 3), dtype=torch.float32), "", "", empty_latent(), "", "")
+        ids = parse_task_ids(task_ids)
+        if not ids:
+            print("❌ 错误: 未提供任何任务ID")
+            return empty_outputs
+        
+        try:
+            handles = []
+            for task_id in ids:
+                # 未填写Key时优先使用日志中提交该任务的Key，再退回Key池
+                key = api_key.strip() or (JOB_JOURNAL.key_for_task(task_id) if JOURNAL_ENABLED and os.path.exists(JOURNAL_PATH) else "")
+                key = key or get_bizyair_api_key()
+                if not key:
+                    print("❌ 错误: 缺少API密钥")
+                    return empty_outputs
+                handles.append({"task_id": task_id, "api_key": key})
+            
+            print(f"🔍 批量检查 {len(handles)} 个任务")
+            results = poll_bizyair_tasks(handles, timeout=timeout, poll_interval=poll_interval)
+            results = [
+                result if result is not None else {"request_id": handle['task_id'], "status": "Timeout"}
+                for handle, result in zip(handles, results)
+            ]
+            return collect_batch_outputs(results, download_concurrency, output_timeout, return_latent, return_text,
+                                         output_dtype, pin_memory)
+            
+        except Exception as e:
+            print(f"BizyAIR批量任务检查失败: {e}")
+            error_response = {
+                "error": str(e),
+                "message": "批量检查任务状态过程中发生错误"
+            }
+            return (json.dumps(error_response, ensure_ascii=False, indent=2),) + empty_outputs[1:]
+
+def parse_sweep_values(sweep_input):
+    """解析参数扫描输入 "节点名|值列表"，值列表为JSON数组或每行一个值"""
+    if not sweep_input or '|' not in sweep_input:
+        return None, []
+    node_name, raw_values = sweep_input.split('|', 1)
+    raw_values = raw_values.strip()
+    if raw_values.startswith('['):
+        values = [v if isinstance(v, str) else json.dumps(v) for v in json.loads(raw_values)]
+    else:
+        values = [line.strip() for line in raw_values.splitlines() if line.strip()]
+    return node_name.strip(), values
+
+def build_sweep_variants(sweeps, mode="cartesian"):
+    """按笛卡尔积或逐项配对组合扫描参数，返回 [{节点名: 值}] 列表"""
+    if not sweeps:
+        return []
+    node_names = [name for name, _ in sweeps]
+    value_lists = [values for _, values in sweeps]
+    if mode == "zip":
+        if len({len(values) for values in value_lists}) > 1:
+            print(f"⚠️ zip模式下各扫描列表长度不一致，按最短列表 {min(len(v) for v in value_lists)} 组合")
+        combos = zip(*value_lists)
+    else:
+        combos = itertools.product(*value_lists)
+    return [dict(zip(node_names, combo)) for combo in combos]
+
+def _manifest_value(value, limit=200):
+    """清单中截断过长的值（如base64图像）"""
+    return value if len(value) <= limit else f"{value[:limit]}...({len(value)} 字符)"
+
+class BA_Parameter_Sweep:
+    """BizyAIR参数扫描节点 - 同一应用的多组参数并发运行"""
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "web_app_id": ("INT", {"default": 36259, "min": 1, "max": 999999}),
+                "api_key": ("STRING", {"default": "", "multiline": False}),
+                "sweep_mode": (["cartesian", "zip"], {"default": "cartesian"}),
+                "max_in_flight": ("INT", {"default": TASK_CONCURRENCY, "min": 1, "max": 64}),
+            },
+            "optional": {
+                "sweep_1": ("STRING", {"default": "", "multiline": True}),
+                "sweep_2": ("STRING", {"default": "", "multiline": True}),
+                "sweep_3": ("STRING", {"default": "", "multiline": True}),
+                "input_1": ("STRING", {"default": ""}),
+                "input_2": ("STRING", {"default": ""}),
+                "input_3": ("STRING", {"default": ""}),
+                "input_4": ("STRING", {"default": ""}),
+                "input_5": ("STRING", {"default": ""}),
+                "input_6": ("STRING", {"default": ""}),
+                "input_7": ("STRING", {"default": ""}),
+                "input_8": ("STRING", {"default": ""}),
+                "input_9": ("STRING", {"default": ""}),
+                "download_concurrency": ("INT", {"default": DOWNLOAD_CONCURRENCY, "min": 1, "max": 32}),
+                "output_timeout": ("INT", {"default": DOWNLOAD_OUTPUT_TIMEOUT, "min": 5, "max": 600}),
+            }
+        }
+    
+    RETURN_TYPES = ("IMAGE", "STRING", "STRING")
+    RETURN_NAMES = ("image", "manifest_json", "metrics_json")
+    FUNCTION = "run_sweep"
+    CATEGORY = "🇨🇳BOZO/BizyAir"
+    
+    @with_metrics_output
+    def run_sweep(self, web_app_id, api_key="", sweep_mode="cartesian", max_in_flight=TASK_CONCURRENCY,
+                  download_concurrency=None, output_timeout=None, **kwargs):
+        empty_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32)
+        try:
+            # 未填写api_key时每个任务从Key文件中轮流选取，分散负载
+            api_key = api_key.strip() if api_key else ""
+            if api_key:
+                save_bizyair_api_key(api_key)
+            
+            base_values = parse_input_values(kwargs.get(f"input_{i}", "") for i in range(1, 10))
+            sweeps = []
+            for i in range(1, 4):
+                node_name, values = parse_sweep_values(kwargs.get(f"sweep_{i}", ""))
+                if node_name and values:
+                    sweeps.append((node_name, values))
+            
+            variants = build_sweep_variants(sweeps, sweep_mode)
+            if not variants:
+                print("❌ 错误: 未提供有效的扫描参数")
+                return (empty_image, json.dumps({"error": "未提供有效的扫描参数"}, ensure_ascii=False))
+            
+            print(f"🔬 参数扫描: {len(variants)} 组参数，最大并发 {max_in_flight}")
+            input_values_list = [{**base_values, **variant} for variant in variants]
+            if VALIDATE_INPUTS:
+                validate_task_inputs(web_app_id, input_values_list, api_key or get_bizyair_api_key() or None)
+            task_results = run_bizyair_tasks(web_app_id, input_values_list, api_key or None, max_in_flight)
+            
+            # 所有变体的图像一起并发下载
+            variant_urls = []
+            for _, result in task_results:
+                if isinstance(result, Exception):
+                    variant_urls.append(([], [], []))
+                else:
+                    report_task_failure(result)
+                    variant_urls.append(split_task_outputs(result))
+            all_image_urls = [url for image_urls, _, _ in variant_urls for url in image_urls]
+            tensors = fetch_image_tensors(all_image_urls, download_concurrency, output_timeout)
+            
+            # 按变体顺序堆叠，记录每个变体在批次中的位置
+            first_shape = next((t.shape for t in tensors if t is not None), None)
+            stacked = []
+            manifest = []
+            url_index = 0
+            for index, (variant, (task_key, result), (image_urls, latent_urls, text_urls)) in enumerate(zip(variants, task_results, variant_urls)):
+                image_indices = []
+                for _ in image_urls:
+                    tensor = tensors[url_index]
+                    url_index += 1
+                    if tensor is not None and tensor.shape == first_shape:
+                        image_indices.append(sum(t.shape[0] for t in stacked))
+                        stacked.append(tensor)
+                entry = {
+                    "index": index,
+                    "values": {name: _manifest_value(value) for name, value in variant.items()},
+                    "api_key": f"{task_key[:8]}..." if task_key else "",
+                    "image_indices": image_indices,
+                    "image_urls": image_urls,
+                    "latent_urls": latent_urls,
+                    "text_urls": text_urls,
+                }
+                if isinstance(result, Exception):
+                    entry.update({"status": "Error", "error": str(result), "task_id": ""})
+                else:
+                    entry.update({"status": result.get('status', 'Unknown'), "task_id": result.get('request_id', '')})
+                manifest.append(entry)
+            
+            final_image = torch.cat(stacked, dim=0) if stacked else empty_image
+            if JOURNAL_ENABLED:
+                JOB_JOURNAL.mark_delivered([entry["task_id"] for entry in manifest])
+            succeeded = sum(1 for entry in manifest if str(entry["status"]).lower() in TASK_SUCCESS_STATUSES)
+            print(f"✅ 参数扫描完成: {succeeded}/{len(manifest)} 组成功，图像批次形状: {final_image.shape}")
+            
+            return (final_image, json.dumps({"web_app_id": web_app_id, "mode": sweep_mode, "variants": manifest}, ensure_ascii=False, indent=2))
+            
+        except Exception as e:
+            print(f"BizyAIR参数扫描失败: {e}")
+            return (empty_image, json.dumps({"error": str(e), "message": "参数扫描过程中发生错误"}, ensure_ascii=False, indent=2))
+
+class BA_Job_Report:
+    """BizyAIR任务日志报告节点 - 查看吞吐、失败率和最近的任务记录"""
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "hours": ("FLOAT", {"default": 24.0, "min": 0.1, "max": 8760.0, "step": 1.0}),
+            },
+            "optional": {
+                "web_app_id": ("INT", {"default": 0, "min": 0, "max": 999999}),
+                "status": ("STRING", {"default": "", "multiline": False}),
+                "limit": ("INT", {"default": 50, "min": 1, "max": 1000}),
+            }
+        }
+    
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("report_json", "jobs_json")
+    FUNCTION = "build_report"
+    CATEGORY = "🇨🇳BOZO/BizyAir"
+    
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # 日志内容随时变化，每次都重新读取
+        return float("nan")
+    
+    def build_report(self, hours=24.0, web_app_id=0, status="", limit=50):
+        try:
+            report = JOB_JOURNAL.report(hours, web_app_id or None)
+            jobs = JOB_JOURNAL.query(status.strip() or None, web_app_id or None, limit)
+            total = report["total"]
+            print(f"📒 任务日志: {total['submitted']} 次提交，成功 {total['succeeded']}，失败率 {total['failure_rate']:.1%}")
+            return (json.dumps(report, ensure_ascii=False, indent=2), json.dumps(jobs, ensure_ascii=False, indent=2))
+        except Exception as e:
+            print(f"❌ 读取任务日志失败: {e}")
+            return (json.dumps({"error": str(e)}, ensure_ascii=False), "[]")
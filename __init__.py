@@ -1,6 +1,9 @@
 # ComfyUI BizyAir 插件初始化文件
 
-from .BizyAIR import BA_BizyAIR_Main, BA_LoadImage, BA_Float_Value, BA_String_Value, BA_Image_Resizer, BA_Task_Status_Checker
+from .BizyAIR import BA_BizyAIR_Main, BA_LoadImage, BA_Float_Value, BA_String_Value, BA_Image_Resizer, BA_Task_Status_Checker, BA_Await, BA_Parameter_Sweep, BA_Job_Report, BA_Batch_Status_Checker, start_job_journal
+
+# 插件加载时在后台继续轮询上次未结束的任务
+start_job_journal()
 
 # （必填）填写 import的类名称，命名需要唯一，key或value与其他插件冲突可能引用不了。这是决定是否能引用的关键。
 # key(自定义):value(import的类名称)
@@ -13,6 +16,10 @@ NODE_CLASS_MAPPINGS = {
     "BA_String_Value": BA_String_Value,
     "BA_Image_Resizer": BA_Image_Resizer,
     "BA_Task_Status_Checker": BA_Task_Status_Checker,
+    "BA_Await": BA_Await,
+    "BA_Parameter_Sweep": BA_Parameter_Sweep,
+    "BA_Job_Report": BA_Job_Report,
+    "BA_Batch_Status_Checker": BA_Batch_Status_Checker,
 }
 
 
@@ -30,6 +37,10 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "BA_String_Value": "BizyAIR 字符串输入~ 🎯BOZO ",
     "BA_Image_Resizer": "图像尺寸调整~ 🎯BOZO ",
     "BA_Task_Status_Checker": "BizyAIR 任务状态检查~ 🎯BOZO ",
+    "BA_Await": "BizyAIR 任务等待收集~ 🎯BOZO ",
+    "BA_Parameter_Sweep": "BizyAIR 参数扫描~ 🎯BOZO ",
+    "BA_Job_Report": "BizyAIR 任务日志报告~ 🎯BOZO ",
+    "BA_Batch_Status_Checker": "BizyAIR 批量任务状态检查~ 🎯BOZO ",
 }
 
 WEB_DIRECTORY = "web"
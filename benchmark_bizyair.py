@@ -0,0 +1,636 @@
+# BizyAIR 插件本地性能基准测试脚本
+# 用法（在插件目录内）: python benchmark_bizyair.py encode --size 1536
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from PIL import Image
+
+import BizyAIR
+import mock_bizyair_server
+
+
+def make_test_image(width, height, batch_size=1, seed=0):
+    """生成带渐变和噪声的测试图像张量 [B, H, W, C]，比纯色图更接近真实照片的压缩难度"""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+    base = np.stack([x * np.ones_like(y), y * np.ones_like(x), (x + y) / 2], axis=-1)
+    images = []
+    for _ in range(batch_size):
+        noise = rng.normal(0.0, 0.05, size=(height, width, 3)).astype(np.float32)
+        images.append(np.clip(base + noise, 0.0, 1.0))
+    return torch.from_numpy(np.stack(images))
+
+
+def time_call(fn, repeat):
+    """重复执行并返回 (最短耗时秒数, 最后一次结果)"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_encode(args):
+    """比较各编码器预设的耗时与体积"""
+    image = make_test_image(args.size, args.size)
+    presets = [
+        ("WEBP", 80, 4),
+        ("WEBP", 80, 0),
+        ("WEBP", 90, 6),
+        ("WEBP_LOSSLESS", 0, 0),
+        ("PNG_FAST", 0, 0),
+        ("PNG", 0, 0),
+        ("JPEG", 90, 0),
+    ]
+    print(f"编码基准: {args.size}x{args.size}, 每项重复 {args.repeat} 次（取最短）")
+    print(f"{'编码器':<16}{'quality':>8}{'method':>8}{'耗时(ms)':>12}{'大小(KB)':>12}")
+    for encoder, quality, method in presets:
+        def run():
+            # 清空编码缓存，测量真实编码耗时
+            BizyAIR.ENCODE_MEMO_CACHE.clear()
+            return BizyAIR.image_to_base64(image, encoder, quality, method)
+        seconds, data_uri = time_call(run, args.repeat)
+        print(f"{encoder:<16}{quality:>8}{method:>8}{seconds * 1000:>12.1f}{len(data_uri) / 1024:>12.1f}")
+
+    # 缓存命中耗时（张量哈希 + 查表）
+    BizyAIR.image_to_base64(image)
+    seconds, _ = time_call(lambda: BizyAIR.image_to_base64(image), args.repeat)
+    print(f"{'WEBP(缓存命中)':<16}{80:>8}{4:>8}{seconds * 1000:>12.1f}")
+
+    # 批次并行编码
+    batch = make_test_image(args.size, args.size, batch_size=args.batch)
+    for workers in (1, BizyAIR.ENCODE_CONCURRENCY):
+        def run_batch():
+            BizyAIR.ENCODE_MEMO_CACHE.clear()
+            return BizyAIR.images_to_base64(batch, max_workers=workers)
+        seconds, _ = time_call(run_batch, args.repeat)
+        print(f"批次编码 {args.batch} 张, {workers} 线程: {seconds * 1000:.1f} ms")
+
+
+def current_rss_mb():
+    """当前进程的常驻内存（MB），非Linux系统退回到峰值常驻内存"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 单位为字节，其他为KB
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class RssSampler:
+    """后台线程采样常驻内存，记录测量区间内相对起点的峰值增量"""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.baseline = 0.0
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss_mb()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss_mb())
+            time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+    @property
+    def delta_mb(self):
+        return self.peak - self.baseline
+
+
+class _StaticHandler(http.server.BaseHTTPRequestHandler):
+    """返回固定内容的HTTP处理器"""
+    protocol_version = "HTTP/1.1"
+    payload = b""
+    content_type = "application/octet-stream"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", self.content_type)
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_bytes(payload, content_type):
+    """在本地随机端口上提供一个静态对象，返回URL"""
+    handler = type("Handler", (_StaticHandler,), {"payload": payload, "content_type": content_type})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/image.png"
+
+
+def legacy_url_to_tensor(image_url):
+    """改造前的解码路径：response.content -> BytesIO -> np.array -> astype/255"""
+    response = BizyAIR.http_request("GET", image_url, timeout=60)
+    response.raise_for_status()
+    image = Image.open(io.BytesIO(response.content))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image_np = np.array(image).astype(np.float32) / 255.0
+    return torch.from_numpy(image_np)[None,]
+
+
+def decode_child(args):
+    """子进程中测量单一解码路径，独立进程才能得到准确的峰值内存"""
+    fn = legacy_url_to_tensor if args.method == "legacy" else BizyAIR.download_image_tensor
+    # 预热：建立连接并加载解码库，不计入测量
+    BizyAIR.http_request("GET", args.url, timeout=60).content
+    times = []
+    peaks = []
+    for _ in range(args.repeat):
+        BizyAIR.DECODED_OUTPUT_CACHE.clear()
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            tensor = fn(args.url)
+            times.append(time.perf_counter() - start)
+        peaks.append(sampler.delta_mb)
+        del tensor
+    megapixels = args.width * args.height / 1e6
+    print(json.dumps({
+        "method": args.method,
+        "ms_per_megapixel": min(times) * 1000 / megapixels,
+        "peak_rss_mb_per_megapixel": max(peaks) / megapixels,
+    }))
+
+
+def bench_decode(args):
+    """对比改造前后的下载解码路径：每百万像素耗时和峰值内存"""
+    image = make_test_image(args.width, args.height)
+    buffer = io.BytesIO()
+    Image.fromarray((image[0].numpy() * 255).astype(np.uint8)).save(buffer, format="PNG", compress_level=1)
+    server, url = serve_bytes(buffer.getvalue(), "image/png")
+    print(f"解码基准: {args.width}x{args.height} PNG ({len(buffer.getvalue()) / 1024 / 1024:.1f} MB), 每项重复 {args.repeat} 次")
+    print(f"{'路径':<12}{'耗时(ms/MP)':>14}{'峰值内存(MB/MP)':>18}")
+    try:
+        for method in ("legacy", "streaming"):
+            output = subprocess.run(
+                [sys.executable, __file__, "decode-child", "--method", method, "--url", url,
+                 "--width", str(args.width), "--height", str(args.height), "--repeat", str(args.repeat)],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{method:<12}{result['ms_per_megapixel']:>14.1f}{result['peak_rss_mb_per_megapixel']:>18.1f}")
+    finally:
+        server.shutdown()
+
+
+def bench_resize(args):
+    """对比PIL逐张调整与torch批量插值在不同批次大小下的耗时"""
+    print(f"调整尺寸基准: {args.size}x{args.size} -> {args.target}x{args.target}, 每项重复 {args.repeat} 次（取最短）")
+    print(f"{'批次':>6}{'方法':>10}{'PIL(ms)':>12}{'torch(ms)':>12}{'加速比':>10}")
+    for batch_size in args.batches:
+        images = make_test_image(args.size, args.size, batch_size=batch_size)
+        for method in ("BILINEAR", "BICUBIC", "AREA"):
+            pil_seconds, _ = time_call(lambda: BizyAIR.pil_resize_batch(images, args.target, args.target, method), args.repeat)
+            torch_seconds, _ = time_call(lambda: BizyAIR.torch_resize_batch(images, args.target, args.target, method), args.repeat)
+            print(f"{batch_size:>6}{method:>10}{pil_seconds * 1000:>12.1f}{torch_seconds * 1000:>12.1f}{pil_seconds / torch_seconds:>10.1f}x")
+
+
+def percentile(values, q):
+    """最近秩分位数，没有样本时返回0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def start_mock_server(args):
+    """在子进程中启动替身服务器，避免服务器内存计入客户端峰值；返回 (进程, URL)"""
+    command = [sys.executable, mock_bizyair_server.__file__, "--port", "0"]
+    for name in ("latency", "jitter", "failure_rate", "error_rate", "outputs", "output_size", "output_format",
+                 "text_outputs", "object_latency", "variants", "seed", "rate_limit",
+                 "stall_rate", "header_stall_rate", "truncate_rate", "stall_seconds", "input_schema"):
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    if not line.startswith("READY "):
+        process.kill()
+        raise RuntimeError(f"替身服务器启动失败: {line}")
+    return process, line.split(" ", 1)[1]
+
+
+def run_node_request(index, args):
+    """像ComfyUI一样直接调用节点类执行一次请求，返回 (耗时, 是否成功, 各阶段span)"""
+    input_value = f"1:CLIPTextEncode.text|load benchmark request {index}"
+    start = time.perf_counter()
+    main_node = BizyAIR.BA_BizyAIR_Main()
+    outputs = main_node.process_api_call(1, api_key="", input_1=input_value, submit_only=args.mode == "async",
+                                         download_concurrency=args.download_concurrency, return_text=args.text_outputs > 0)
+    outputs = dict(zip(BizyAIR.BA_BizyAIR_Main.RETURN_NAMES, outputs))
+    spans = json.loads(outputs["metrics_json"])["spans"]
+    response_json = outputs["response_json"]
+    if args.mode == "async" and outputs["task_handle"]:
+        awaited = BizyAIR.BA_Await().await_tasks(timeout=args.task_timeout, poll_interval=args.poll_interval,
+                                                 task_1=outputs["task_handle"], download_concurrency=args.download_concurrency,
+                                                 return_text=args.text_outputs > 0)
+        awaited = dict(zip(BizyAIR.BA_Await.RETURN_NAMES, awaited))
+        spans += json.loads(awaited["metrics_json"])["spans"]
+        response_json = awaited["response_json"]
+    elapsed = time.perf_counter() - start
+    results = json.loads(response_json)
+    results = results if isinstance(results, list) else [results]
+    ok = all(str(result.get("status", "")).lower() in BizyAIR.TASK_SUCCESS_STATUSES for result in results)
+    return elapsed, ok, spans
+
+
+def run_load_level(concurrency, args):
+    """以给定并发执行 args.requests 次节点请求，返回该并发级别的统计"""
+    samples = []
+    # 每个并发级别使用新的准入控制器，排队和限流统计互不影响
+    BizyAIR.ADMISSION = BizyAIR.AdmissionController(
+        max_in_flight=args.max_in_flight if args.max_in_flight is not None else BizyAIR.ADMISSION_MAX_IN_FLIGHT,
+        endpoint_rates={endpoint: 0.0 for endpoint in BizyAIR.ADMISSION_ENDPOINT_RATES} if args.no_rate_limit else None,
+        key_rate=0.0 if args.no_rate_limit else BizyAIR.ADMISSION_KEY_RATE,
+    )
+    log = io.StringIO() if not args.verbose else None
+    with RssSampler() as sampler, contextlib.redirect_stdout(log or sys.stdout):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(lambda i: run_node_request(i, args), range(args.requests)))
+        wall = time.perf_counter() - start
+
+    admission = BizyAIR.ADMISSION.stats()
+    phases = {"node": [elapsed for elapsed, _, _ in samples]}
+    for _, _, spans in samples:
+        for span in spans:
+            phases.setdefault(span["phase"], []).append(span["seconds"])
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ok": sum(1 for _, ok, _ in samples if ok),
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(samples) / wall, 3),
+        "peak_rss_mb": round(sampler.delta_mb, 1),
+        "admission": {field: admission[field] for field in ("max_queue_depth", "throttled", "timeouts")},
+        "phases": {
+            phase: {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99)}
+            for phase, values in phases.items()
+        },
+    }
+
+
+def print_load_level(level):
+    print(f"\n并发 {level['concurrency']}: {level['requests']} 次请求, 成功 {level['ok']}, "
+          f"{level['requests_per_second']:.2f} req/s, 峰值内存增量 {level['peak_rss_mb']:.1f} MB")
+    admission = level.get("admission")
+    if admission:
+        print(f"准入控制: 最大排队 {admission['max_queue_depth']}, 被限流 {admission['throttled']} 次, 排队超时 {admission['timeouts']} 次")
+    print(f"{'阶段':<14}{'次数':>8}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}")
+    for phase, stats in level["phases"].items():
+        print(f"{phase:<14}{stats['count']:>8}{stats['p50'] * 1000:>12.1f}{stats['p95'] * 1000:>12.1f}{stats['p99'] * 1000:>12.1f}")
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    """与基线比较吞吐、p95和峰值内存，返回退化项列表"""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    print(f"\n与基线比较（容差 {tolerance:.0%}）:")
+    print(f"{'并发':>6}  {'指标':<22}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for level in report["levels"]:
+        old = baseline_levels.get(level["concurrency"])
+        if old is None:
+            continue
+        checks = [("requests_per_second", old["requests_per_second"], level["requests_per_second"], False),
+                  ("peak_rss_mb", old["peak_rss_mb"], level["peak_rss_mb"], True)]
+        for phase, stats in level["phases"].items():
+            if phase in old["phases"]:
+                checks.append((f"{phase}.p95", old["phases"][phase]["p95"], stats["p95"], True))
+        for name, old_value, new_value, lower_is_better in checks:
+            change = (new_value - old_value) / old_value if old_value else 0.0
+            worse = change > tolerance if lower_is_better else change < -tolerance
+            # 峰值内存的绝对变化小于8MB时视为噪声
+            if name == "peak_rss_mb" and abs(new_value - old_value) < 8:
+                worse = False
+            marker = "  ⚠️ 退化" if worse else ""
+            print(f"{level['concurrency']:>6}  {name:<22}{old_value:>12.4g}{new_value:>12.4g}{change:>+10.1%}{marker}")
+            if worse:
+                regressions.append((level["concurrency"], name, old_value, new_value))
+    return regressions
+
+
+def bench_load(args):
+    """启动替身服务器，在不同并发下直接驱动节点类，报告吞吐、各阶段分位数和峰值内存"""
+    process, url = (None, args.server_url) if args.server_url else start_mock_server(args)
+    # 使用临时Key文件和独立的API地址，不影响真实配置
+    key_dir = tempfile.mkdtemp(prefix="bizyair-bench-")
+    key_path = os.path.join(key_dir, "keys.txt")
+    with open(key_path, "w", encoding="utf-8") as f:
+        f.write("bench-key-1\nbench-key-2\n")
+    BizyAIR.KEY_POOL = BizyAIR.ApiKeyPool(key_path)
+    BizyAIR.JOB_JOURNAL = BizyAIR.JobJournal(os.path.join(key_dir, "jobs.sqlite3"))
+    BizyAIR.BIZYAIR_API_BASE = url
+    if args.input_schema:
+        # 替身服务器在推测的模式接口上返回 --input-schema 的内容
+        BizyAIR.INPUT_SCHEMA_URL = f"{url}/w/v1/webapp/{{web_app_id}}/schema"
+    if not args.keep_cache:
+        # 压测的是网络和解码路径，关闭解码结果缓存
+        BizyAIR.DECODED_OUTPUT_CACHE.set_budget(0)
+    BizyAIR.configure_http_client(pool_maxsize=max(args.concurrency) * max(1, args.download_concurrency))
+
+    print(f"负载基准: 替身服务器 {url}, 模式 {args.mode}, 每个并发级别 {args.requests} 次请求, "
+          f"任务耗时 {args.latency}s, 每任务 {args.outputs} 个 {args.output_size} 输出")
+    report = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "mode": args.mode,
+        "server": {} if args.server_url else mock_bizyair_server.MockConfig.from_args(args).to_dict(),
+        "levels": [],
+    }
+    try:
+        for concurrency in args.concurrency:
+            level = run_load_level(concurrency, args)
+            report["levels"].append(level)
+            print_load_level(level)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 基线已保存: {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} 项指标超出容差")
+            sys.exit(1)
+        print("✅ 未发现超出容差的退化")
+
+
+def reference_tensor(data):
+    """不经插件解码路径，直接用PIL解码对象字节，作为下载结果的对照"""
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    return torch.from_numpy(np.asarray(image, dtype=np.float32) / 255.0)[None,]
+
+
+def check_fault_scenario(server, name, args, store, **faults):
+    """在给定故障比例下逐个下载对象，分别校验原始字节、磁盘文件和解码张量与对象一致，返回不一致个数"""
+    for key, value in faults.items():
+        setattr(server.config, key, value)
+    before = BizyAIR.OBJECT_DOWNLOADER.stats()
+    mismatches = 0
+    start = time.perf_counter()
+    try:
+        for i in range(args.objects):
+            task_id = f"{name.replace('-', '')}{i}"
+            expected, _ = server.object_for(task_id, 0)
+            url = f"{server.url}/objects/{task_id}/0.{args.output_format}"
+            try:
+                sink = BizyAIR._BufferSink()
+                BizyAIR.OBJECT_DOWNLOADER.download(url, sink, timeout=args.timeout)
+                if bytes(sink.data()) != expected:
+                    print(f"   ❌ {url} 字节不一致")
+                    mismatches += 1
+                path = store.get(f"{server.url}/objects/{task_id}f/0.{args.output_format}", timeout=args.timeout)
+                with open(path, "rb") as f:
+                    if f.read() != server.object_for(f"{task_id}f", 0)[0]:
+                        print(f"   ❌ {path} 文件内容不一致")
+                        mismatches += 1
+                decoded_url = f"{server.url}/objects/{task_id}d/0.{args.output_format}"
+                tensor = BizyAIR.download_image_tensor(decoded_url, timeout=args.timeout)
+                reference = reference_tensor(server.object_for(f"{task_id}d", 0)[0])
+                if tensor.shape != reference.shape or not torch.allclose(tensor.float(), reference, atol=1e-3):
+                    print(f"   ❌ {decoded_url} 解码结果不一致")
+                    mismatches += 1
+            except Exception as e:
+                print(f"   ❌ {url} 下载失败: {e}")
+                mismatches += 1
+    finally:
+        for key in faults:
+            setattr(server.config, key, 0.0)
+    after = BizyAIR.OBJECT_DOWNLOADER.stats()
+    delta = {key: after[key] - before[key] for key in ("resumes", "restarts", "hedges", "verify_failures")}
+    print(f"{name:<14}{args.objects * 3 - mismatches:>6}/{args.objects * 3:<6}{time.perf_counter() - start:>8.2f}s  "
+          + "  ".join(f"{key}={value}" for key, value in delta.items()))
+    return mismatches
+
+
+def check_breaker(server, args):
+    """对无人监听的端口连续下载，熔断器应打开并拒绝后续请求，同时不影响正常主机"""
+    downloader = BizyAIR.ObjectDownloader()
+    probe = http.server.ThreadingHTTPServer(("127.0.0.1", 0), http.server.BaseHTTPRequestHandler)
+    dead_url = f"http://127.0.0.1:{probe.server_port}/objects/dead/0.png"
+    probe.server_close()
+    opened = False
+    for _ in range(downloader.breaker.threshold + 1):
+        try:
+            downloader.download(dead_url, BizyAIR._BufferSink(), timeout=args.timeout)
+        except BizyAIR.CircuitOpenError:
+            opened = True
+            break
+        except Exception:
+            pass
+    failures = 0
+    if not opened:
+        print(f"   ❌ 连续失败后熔断器未打开: {downloader.breaker.stats()}")
+        failures += 1
+    sink = BizyAIR._BufferSink()
+    try:
+        downloader.download(f"{server.url}/objects/alive/0.{args.output_format}", sink, timeout=args.timeout)
+        if bytes(sink.data()) != server.object_for("alive", 0)[0]:
+            raise ValueError("字节不一致")
+    except Exception as e:
+        print(f"   ❌ 熔断其他主机时正常主机下载失败: {e}")
+        failures += 1
+    if server.url.split("//", 1)[1] in downloader.breaker.stats():
+        print("   ❌ 正常主机被计入熔断")
+        failures += 1
+    print(f"{'breaker':<14}{'ok' if not failures else 'FAIL':>6}{'':<16}  {downloader.breaker.stats()}")
+    return failures
+
+
+class _SwitchableHandler(http.server.BaseHTTPRequestHandler):
+    """按 status 返回错误或固定对象的HTTP处理器，用于熔断恢复检查"""
+    protocol_version = "HTTP/1.1"
+    status = 200
+    payload = b""
+
+    def do_GET(self):
+        body = self.payload if self.status == 200 else b"error"
+        self.send_response(self.status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def check_breaker_recovery(args):
+    """熔断打开 -> 冷却后试探请求得到4xx -> 主机恢复后下载成功；4xx试探不能让主机一直停在熔断状态"""
+    payload = os.urandom(64 * 1024)
+    handler = type("Handler", (_SwitchableHandler,), {"status": 500, "payload": payload})
+    flaky = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    flaky.daemon_threads = True
+    threading.Thread(target=flaky.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{flaky.server_port}/object.bin"
+    downloader = BizyAIR.ObjectDownloader()
+    downloader.breaker.cooldown = 0.2
+    steps = []
+    try:
+        for _ in range(downloader.breaker.threshold + 1):
+            try:
+                downloader.download(url, BizyAIR._BufferSink(), timeout=args.timeout)
+            except BizyAIR.CircuitOpenError:
+                steps.append("open")
+                break
+            except Exception:
+                pass
+        time.sleep(downloader.breaker.cooldown + 0.05)
+        handler.status = 404
+        try:
+            downloader.download(url, BizyAIR._BufferSink(), timeout=args.timeout)
+        except BizyAIR.CircuitOpenError:
+            steps.append("stuck")
+        except Exception:
+            steps.append("probe-4xx")
+        handler.status = 200
+        sink = BizyAIR._BufferSink()
+        try:
+            downloader.download(url, sink, timeout=args.timeout)
+            steps.append("recovered" if bytes(sink.data()) == payload else "mismatch")
+        except Exception as e:
+            steps.append(type(e).__name__)
+    finally:
+        flaky.shutdown()
+        flaky.server_close()
+    ok = steps == ["open", "probe-4xx", "recovered"]
+    if not ok:
+        print(f"   ❌ 熔断恢复过程不符合预期: {' -> '.join(steps)}")
+    print(f"{'half-open':<14}{'ok' if ok else 'FAIL':>6}{'':<16}  {' -> '.join(steps)}")
+    return 0 if ok else 1
+
+
+def bench_faults(args):
+    """在注入停顿、截断和响应头停顿的替身服务器上下载输出对象，校验续传、长度/ETag校验、对冲和熔断后结果与对象一致"""
+    server = mock_bizyair_server.MockBizyAIRServer(mock_bizyair_server.MockConfig.from_args(args)).start()
+    rates = {key: getattr(args, key) for key in ("stall_rate", "header_stall_rate", "truncate_rate")}
+    for key in rates:
+        setattr(server.config, key, 0.0)
+    # 停顿判定调短，让停顿在基准时长内触发续传；解码缓存关闭以确保每次都真正下载
+    BizyAIR.DOWNLOAD_STALL_TIMEOUT = args.stall_timeout
+    # 续传请求同样会按比例遇到故障，放宽请求次数上限，避免校验结果受随机故障连续命中影响
+    BizyAIR.DOWNLOAD_MAX_ATTEMPTS = args.attempts
+    BizyAIR.DECODED_OUTPUT_CACHE.set_budget(0)
+    store = BizyAIR.DownloadStore(tempfile.mkdtemp(prefix="bizyair-faults-"), 1 << 30)
+    print(f"故障注入校验: 替身服务器 {server.url}, 每个场景 {args.objects} 个对象 x 3 条路径(字节/文件/解码), "
+          f"停顿 {args.stall_seconds}s, 停顿判定 {args.stall_timeout}s")
+    print(f"{'场景':<14}{'一致':>6}{'':<6}{'耗时':>9}")
+    scenarios = [("clean", {})] + [(key[:-5].replace("_", "-"), {key: value}) for key, value in rates.items() if value > 0]
+    mismatches = 0
+    try:
+        for name, faults in scenarios:
+            mismatches += check_fault_scenario(server, name, args, store, **faults)
+        mismatches += check_breaker(server, args)
+        mismatches += check_breaker_recovery(args)
+    finally:
+        server.stop()
+    print(f"服务器统计: {server.stats}")
+    if mismatches:
+        print(f"❌ {mismatches} 项校验失败")
+        sys.exit(1)
+    print("✅ 所有下载结果与对象一致")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BizyAIR 插件性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    encode_parser = subparsers.add_parser("encode", help="图像编码器耗时/体积对比")
+    encode_parser.add_argument("--size", type=int, default=1536)
+    encode_parser.add_argument("--batch", type=int, default=4)
+    encode_parser.add_argument("--repeat", type=int, default=3)
+    encode_parser.set_defaults(func=bench_encode)
+
+    decode_parser = subparsers.add_parser("decode", help="输出图像下载解码耗时与峰值内存")
+    decode_parser.add_argument("--width", type=int, default=3840)
+    decode_parser.add_argument("--height", type=int, default=2160)
+    decode_parser.add_argument("--repeat", type=int, default=3)
+    decode_parser.set_defaults(func=bench_decode)
+
+    resize_parser = subparsers.add_parser("resize", help="PIL与torch批量调整尺寸耗时对比")
+    resize_parser.add_argument("--size", type=int, default=1536)
+    resize_parser.add_argument("--target", type=int, default=1024)
+    resize_parser.add_argument("--batches", type=int, nargs="+", default=[1, 4, 16])
+    resize_parser.add_argument("--repeat", type=int, default=3)
+    resize_parser.set_defaults(func=bench_resize)
+
+    load_parser = subparsers.add_parser("load", help="本地替身服务器上的节点负载测试")
+    load_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    load_parser.add_argument("--requests", type=int, default=32, help="每个并发级别的请求数")
+    load_parser.add_argument("--mode", choices=["sync", "async"], default="sync", help="async 为 submit_only + BA_Await")
+    load_parser.add_argument("--poll-interval", type=float, default=0.2)
+    load_parser.add_argument("--task-timeout", type=int, default=600)
+    load_parser.add_argument("--download-concurrency", type=int, default=BizyAIR.DOWNLOAD_CONCURRENCY)
+    load_parser.add_argument("--keep-cache", action="store_true", help="保留解码结果缓存")
+    load_parser.add_argument("--server-url", default="", help="使用已启动的服务器，不再启动替身服务器")
+    load_parser.add_argument("--save-baseline", default="", help="把结果保存为基线JSON")
+    load_parser.add_argument("--compare", default="", help="与基线JSON比较，超出容差时退出码为1")
+    load_parser.add_argument("--tolerance", type=float, default=0.15)
+    load_parser.add_argument("--max-in-flight", type=int, default=None, help="准入控制的在途请求上限，0为不限")
+    load_parser.add_argument("--no-rate-limit", action="store_true", help="关闭客户端令牌桶限速")
+    load_parser.add_argument("--verbose", action="store_true", help="显示节点日志")
+    mock_bizyair_server.add_server_arguments(load_parser)
+    load_parser.set_defaults(func=bench_load)
+
+    faults_parser = subparsers.add_parser("faults", help="故障注入下的下载结果一致性校验")
+    faults_parser.add_argument("--objects", type=int, default=6, help="每个场景下载的对象个数")
+    faults_parser.add_argument("--timeout", type=float, default=30.0, help="单个对象的下载总超时(秒)")
+    faults_parser.add_argument("--stall-timeout", type=float, default=1.0, help="判定停顿并续传的秒数")
+    faults_parser.add_argument("--attempts", type=int, default=12, help="每个对象最多发出的请求数（含续传）")
+    mock_bizyair_server.add_server_arguments(faults_parser)
+    faults_parser.set_defaults(func=bench_faults, output_size="512x512", variants=4, stall_seconds=3.0,
+                               stall_rate=0.3, header_stall_rate=0.3, truncate_rate=0.3)
+
+    child_parser = subparsers.add_parser("decode-child")
+    child_parser.add_argument("--method", choices=["legacy", "streaming"], required=True)
+    child_parser.add_argument("--url", required=True)
+    child_parser.add_argument("--width", type=int, required=True)
+    child_parser.add_argument("--height", type=int, required=True)
+    child_parser.add_argument("--repeat", type=int, default=3)
+    child_parser.set_defaults(func=decode_child)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
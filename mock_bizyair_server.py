@@ -0,0 +1,352 @@
+# BizyAIR 本地替身服务器：模拟任务创建/查询接口并提供输出对象，用于不消耗API额度的压测
+# 用法（在插件目录内）: python mock_bizyair_server.py --port 8765 --latency 1.0 --outputs 2
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from PIL import Image
+
+CREATE_PATH = "/w/v1/webapp/task/openapi/create"
+TASK_PATH_RE = re.compile(r"^/w/v1/webapp/task/(\w+)$")
+SCHEMA_PATH_RE = re.compile(r"^/w/v1/webapp/(\d+)/schema$")
+OBJECT_PATH_RE = re.compile(r"^/objects/(\w+)/(\d+)\.(\w+)$")
+
+
+class MockConfig:
+    """替身服务器的行为配置"""
+
+    def __init__(self, latency=1.0, jitter=0.2, failure_rate=0.0, error_rate=0.0, outputs=1,
+                 output_width=1024, output_height=1024, output_format="png", text_outputs=0,
+                 object_latency=0.0, variants=8, seed=0, rate_limit=0.0, stall_rate=0.0, header_stall_rate=0.0,
+                 truncate_rate=0.0, stall_seconds=30.0, input_schema=None):
+        self.latency = latency  # 任务从创建到完成的平均耗时(秒)
+        self.jitter = jitter  # 任务耗时的随机波动比例
+        self.failure_rate = failure_rate  # 任务以 Failed 状态结束的比例
+        self.error_rate = error_rate  # 接口直接返回HTTP 503的比例
+        self.outputs = outputs  # 每个任务的图像输出个数
+        self.output_width = output_width
+        self.output_height = output_height
+        self.output_format = output_format
+        self.text_outputs = text_outputs  # 每个任务的文本输出个数
+        self.object_latency = object_latency  # 输出对象响应前的延迟(秒)
+        self.variants = variants  # 预生成的不同输出对象数量
+        self.seed = seed
+        self.rate_limit = rate_limit  # 接口每秒请求数上限，超出返回429，0为不限
+        self.stall_rate = stall_rate  # 输出对象发送一半后停顿的比例
+        self.header_stall_rate = header_stall_rate  # 输出对象在发送响应头前停顿的比例
+        self.truncate_rate = truncate_rate  # 输出对象发送一半后直接断开连接的比例
+        self.stall_seconds = stall_seconds  # 停顿时长(秒)
+        self.input_schema = input_schema  # 所有web_app_id共用的输入模式，None时模式接口返回404
+
+    @classmethod
+    def from_args(cls, args):
+        width, height = (int(v) for v in args.output_size.lower().split("x"))
+        input_schema = None
+        if args.input_schema:
+            with open(args.input_schema, "r", encoding="utf-8") as f:
+                input_schema = json.load(f)
+        return cls(
+            latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, error_rate=args.error_rate,
+            outputs=args.outputs, output_width=width, output_height=height, output_format=args.output_format,
+            text_outputs=args.text_outputs, object_latency=args.object_latency, variants=args.variants, seed=args.seed,
+            rate_limit=args.rate_limit, stall_rate=args.stall_rate, header_stall_rate=args.header_stall_rate,
+            truncate_rate=args.truncate_rate, stall_seconds=args.stall_seconds, input_schema=input_schema,
+        )
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def add_server_arguments(parser):
+    """把替身服务器参数加到 argparse 解析器上，压测脚本复用同一组参数"""
+    parser.add_argument("--latency", type=float, default=1.0, help="任务平均耗时(秒)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="任务耗时随机波动比例")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="任务失败比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="接口返回HTTP 503的比例")
+    parser.add_argument("--outputs", type=int, default=1, help="每个任务的图像输出个数")
+    parser.add_argument("--output-size", default="1024x1024", help="输出图像尺寸 WxH")
+    parser.add_argument("--output-format", choices=["png", "webp", "jpg"], default="png")
+    parser.add_argument("--text-outputs", type=int, default=0, help="每个任务的文本输出个数")
+    parser.add_argument("--object-latency", type=float, default=0.0, help="输出对象响应延迟(秒)")
+    parser.add_argument("--variants", type=int, default=8, help="预生成的不同输出对象数量")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="接口每秒请求数上限，超出返回429")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="输出对象发送一半后停顿的比例")
+    parser.add_argument("--header-stall-rate", type=float, default=0.0, help="输出对象发送响应头前停顿的比例")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="输出对象发送一半后断开连接的比例")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="停顿时长(秒)")
+    parser.add_argument("--input-schema", default="", help="输入模式JSON文件，由模式接口返回")
+
+
+def make_output_objects(config):
+    """预生成若干张不同的噪声图像，返回 [(bytes, etag)]"""
+    rng = np.random.default_rng(config.seed)
+    pil_format = {"png": "PNG", "webp": "WEBP", "jpg": "JPEG"}[config.output_format]
+    objects = []
+    for _ in range(max(1, config.variants)):
+        pixels = rng.integers(0, 256, size=(config.output_height, config.output_width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        if pil_format == "PNG":
+            Image.fromarray(pixels).save(buffer, format=pil_format, compress_level=1)
+        else:
+            Image.fromarray(pixels).save(buffer, format=pil_format, quality=90)
+        data = buffer.getvalue()
+        objects.append((data, f'"{hashlib.md5(data).hexdigest()}"'))
+    return objects
+
+
+class MockBizyAIRServer:
+    """线程化的替身服务器，start() 后通过 url 访问"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self.objects = make_output_objects(self.config)
+        self.tasks = {}
+        self.stats = {"create": 0, "status": 0, "objects": 0, "errors": 0, "throttled": 0, "bytes_sent": 0,
+                      "range_requests": 0, "stalls": 0, "header_stalls": 0, "truncations": 0, "schema": 0}
+        self._window = []  # 最近一秒内的接口请求时间，用于 rate_limit
+        self._lock = threading.Lock()
+        self._rng = random.Random(self.config.seed)
+        handler = type("Handler", (_MockHandler,), {"mock": self})
+        self.httpd = http.server.ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, field, amount=1):
+        with self._lock:
+            self.stats[field] += amount
+
+    def _random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def over_rate_limit(self):
+        """滑动一秒窗口内的接口请求数超过 rate_limit 时返回True"""
+        if not self.config.rate_limit:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.config.rate_limit:
+                self.stats["throttled"] += 1
+                return True
+            self._window.append(now)
+            return False
+
+    def create_task(self):
+        config = self.config
+        duration = max(0.0, config.latency * (1 + config.jitter * (2 * self._random() - 1)))
+        task_id = uuid.uuid4().hex[:16]
+        task = {"created_at": time.time(), "duration": duration, "failed": self._random() < config.failure_rate}
+        with self._lock:
+            self.tasks[task_id] = task
+        return task_id, task
+
+    def task_result(self, task_id, task):
+        if time.time() - task["created_at"] < task["duration"]:
+            return {"request_id": task_id, "status": "Running"}
+        if task["failed"]:
+            return {
+                "request_id": task_id,
+                "status": "Failed",
+                "outputs": [{"error_type": "MockError", "error_msg": "mock failure injected by --failure-rate"}],
+            }
+        outputs = [
+            {"object_url": f"{self.url}/objects/{task_id}/{i}.{self.config.output_format}",
+             "output_ext": f".{self.config.output_format}"}
+            for i in range(self.config.outputs)
+        ]
+        outputs += [
+            {"object_url": f"{self.url}/objects/{task_id}/{self.config.outputs + i}.txt", "output_ext": ".txt"}
+            for i in range(self.config.text_outputs)
+        ]
+        return {"request_id": task_id, "status": "Success", "outputs": outputs}
+
+    def object_fault(self):
+        """按配置的比例为一次对象请求选择故障：header_stall / stall / truncate / None"""
+        config = self.config
+        roll = self._random()
+        for fault, rate in (("header_stall", config.header_stall_rate), ("stall", config.stall_rate),
+                            ("truncate", config.truncate_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+    def object_for(self, task_id, index):
+        digest = hashlib.md5(f"{task_id}/{index}".encode()).digest()
+        return self.objects[digest[0] % len(self.objects)]
+
+
+class _MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def _send(self, code, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.mock._count("bytes_sent", len(body))
+
+    def _inject_error(self):
+        if self.mock.over_rate_limit():
+            self._send(429, {"error": "mock rate limit exceeded"}, headers={"Retry-After": "1"})
+            return True
+        if self.mock._random() < self.mock.config.error_rate:
+            self.mock._count("errors")
+            self._send(503, {"error": "mock overload injected by --error-rate"}, headers={"Retry-After": "0"})
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path != CREATE_PATH:
+            return self._send(404, {"error": "not found"})
+        if self._inject_error():
+            return
+        try:
+            json.loads(body or b"{}")
+        except ValueError:
+            return self._send(400, {"error": "invalid json"})
+        self.mock._count("create")
+        task_id, task = self.mock.create_task()
+        if self.headers.get("X-Bizyair-Task-Async", "").lower() == "enable":
+            return self._send(200, {"request_id": task_id, "status": "Queuing"})
+        # 同步模式：等任务完成后一次返回结果
+        time.sleep(task["duration"])
+        self._send(200, self.mock.task_result(task_id, task))
+
+    def do_GET(self):
+        match = TASK_PATH_RE.match(self.path)
+        if match:
+            if self._inject_error():
+                return
+            self.mock._count("status")
+            task = self.mock.tasks.get(match.group(1))
+            if task is None:
+                return self._send(404, {"error": "task not found"})
+            return self._send(200, self.mock.task_result(match.group(1), task))
+
+        if SCHEMA_PATH_RE.match(self.path):
+            if self._inject_error():
+                return
+            self.mock._count("schema")
+            if self.mock.config.input_schema is None:
+                return self._send(404, {"error": "schema not found"})
+            return self._send(200, {"data": self.mock.config.input_schema})
+
+        match = OBJECT_PATH_RE.match(self.path)
+        if match:
+            task_id, index, ext = match.group(1), int(match.group(2)), match.group(3)
+            self.mock._count("objects")
+            if self.mock.config.object_latency:
+                time.sleep(self.mock.config.object_latency)
+            if ext == "txt":
+                return self._send(200, f"mock text output {task_id}/{index}\n".encode("utf-8"), "text/plain; charset=utf-8")
+            data, etag = self.mock.object_for(task_id, index)
+            content_type = "image/jpeg" if ext == "jpg" else f"image/{ext}"
+            return self._send_object(data, etag, content_type)
+
+        if self.path == "/_stats":
+            with self.mock._lock:
+                stats = dict(self.mock.stats)
+            return self._send(200, stats)
+        self._send(404, {"error": "not found"})
+
+    def _send_object(self, data, etag, content_type):
+        """发送输出对象：支持 Range/If-Range 续传，并按配置注入停顿和截断"""
+        status, start = 200, 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag:
+            self.mock._count("range_requests")
+            start = int(match.group(1))
+            if start >= len(data):
+                return self._send(416, b"", "text/plain", headers={"Content-Range": f"bytes */{len(data)}"})
+            status = 206
+        body = data[start:]
+        fault = self.mock.object_fault()
+        if fault == "header_stall":
+            self.mock._count("header_stalls")
+            time.sleep(self.mock.config.stall_seconds)
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.end_headers()
+        try:
+            if fault in ("stall", "truncate"):
+                half = len(body) // 2
+                self.wfile.write(body[:half])
+                self.wfile.flush()
+                self.mock._count("bytes_sent", half)
+                if fault == "truncate":
+                    # 声明了完整长度却提前断开
+                    self.mock._count("truncations")
+                    self.close_connection = True
+                    return
+                self.mock._count("stalls")
+                time.sleep(self.mock.config.stall_seconds)
+                body = body[half:]
+            self.wfile.write(body)
+            self.mock._count("bytes_sent", len(body))
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已放弃这个停顿的连接
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BizyAIR 本地替身服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockBizyAIRServer(MockConfig.from_args(args), args.host, args.port).start()
+    # 压测脚本读取这一行获得实际地址（--port 0 时随机端口）
+    print(f"READY {server.url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()